@@ -0,0 +1,105 @@
+"""
+Benchmark of the concurrent write throughput of the Episode DB, for each DB
+profile.
+
+A 'tracker' thread inserts batches of new episodes, each batch in a single
+transaction, while a 'downloader' thread updates the state of each of those
+episodes as soon as they are available, one transaction per update. This
+is the write pattern of the tracker and the downloader sharing the DB.
+
+Usage: python -m benchmarks.bench_db_profile [batches] [batch_size]
+"""
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+from queue import Queue
+from threading import Thread
+from types import SimpleNamespace
+
+from tveebot_tracker.episode import TVShow, Quality, Episode, EpisodeFile, \
+    State
+from tveebot_tracker.episode_db import EpisodeDB, connect
+
+TVSHOW = TVShow("1", "Benchmark Show")
+
+
+def track(db: EpisodeDB, queue: Queue, batches: int, batch_size: int):
+    for batch in range(batches):
+        episodes = [Episode(TVSHOW, f"Episode {number}", batch, number)
+                    for number in range(batch_size)]
+        files = [(episode, EpisodeFile(episode.title, "magnet:", Quality.SD))
+                 for episode in episodes]
+
+        with connect(db) as connection:
+            with connection.transaction():
+                connection.insert_episodes(episodes)
+                connection.insert_files(files)
+                connection.set_episode_states(
+                    (episode, State.QUEUED) for episode in episodes)
+
+        for episode in episodes:
+            queue.put(episode)
+
+    queue.put(None)
+
+
+def download(db: EpisodeDB, queue: Queue, errors: list):
+    episode = queue.get()
+    while episode is not None:
+        for state in (State.DOWNLOADING, State.DOWNLOADED):
+            try:
+                with connect(db) as connection:
+                    connection.set_episode_state(episode, state)
+            except sqlite3.OperationalError as error:
+                errors.append(error)
+
+        episode = queue.get()
+
+
+def run(profile: str, batches: int, batch_size: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        config = SimpleNamespace(db_file=Path(directory, "episodes.db"),
+                                 db_profile=profile)
+        db = EpisodeDB(config)
+        with connect(db) as connection:
+            connection.insert_tvshow(TVSHOW, Quality.SD)
+
+        queue, errors = Queue(), []
+        threads = [
+            Thread(target=track, args=(db, queue, batches, batch_size)),
+            Thread(target=download, args=(db, queue, errors)),
+        ]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        db.close()
+
+    # Each episode is written 3 times by the tracker and 2 by the downloader
+    writes = batches * batch_size * 5
+    return {
+        "profile": profile,
+        "seconds": round(elapsed, 3),
+        "writes_per_second": round(writes / elapsed),
+        "busy_errors": len(errors),
+    }
+
+
+def main():
+    batches = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    for profile in EpisodeDB.PROFILES:
+        result = run(profile, batches, batch_size)
+        print("{profile:>12}: {seconds:8.3f}s {writes_per_second:>8} writes/s"
+              " {busy_errors:>4} busy errors".format(**result))
+
+
+if __name__ == '__main__':
+    main()
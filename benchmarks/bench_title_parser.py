@@ -0,0 +1,136 @@
+"""
+Micro-benchmark of the title parser, over a corpus of feed item titles in
+the format used by ShowRSS (showrss_titles.txt).
+
+Each feed item goes through parse_item(), which parses its title once,
+and the resulting file gets its episode from the TitleInfo it keeps, as
+the tracker does. The single-pass parser is compared with the word-by-word
+parser it replaced, which is kept here as the baseline: it parses the
+title of each file again to get its episode. The batch APIs, parse_items()
+and Episode.from_infos(), are measured as well.
+
+Usage: python -m benchmarks.bench_title_parser [repeat]
+"""
+import re
+import sys
+import timeit
+from pathlib import Path
+
+from tveebot_tracker.episode import Episode, TVShow, Quality, EpisodeFile, \
+    title_info
+from tveebot_tracker.exceptions import ParseError
+from tveebot_tracker.showrss_source import parse_item, parse_items
+
+CORPUS = Path(__file__).parent / 'showrss_titles.txt'
+
+# Number of times the corpus is parsed in each measurement
+NUMBER = 100
+
+
+# region Baseline Parser
+
+_episode_pattern = re.compile(r'\d+x\d+\Z')
+_tags = {'PROPER', 'REPACK', 'TBA'}
+_quality_tags = {
+    '720p': Quality.HD,
+    '1080p': Quality.FHD,
+}
+
+
+def baseline_from_title(title: str, tvshow_id: str) -> Episode:
+    words = title.split(" ")
+    for index, word in enumerate(words):
+        match = _episode_pattern.match(word)
+        if match:
+            season, number = map(int, match.group().split('x'))
+            tvshow_name = " ".join(words[:index])
+
+            remainder = words[index + 1:]
+            while remainder and remainder[-1] in _tags:
+                remainder = remainder[:-1]
+
+            return Episode(TVShow(tvshow_id, tvshow_name),
+                           " ".join(remainder), season, number)
+
+    raise ParseError(f"failed to parse title '{title}'")
+
+
+def baseline_parse_item(item: dict) -> EpisodeFile:
+    file_quality = Quality.SD
+
+    words: list = item['title'].split(" ")
+    for tag, quality in _quality_tags.items():
+        try:
+            words.remove(tag)
+            file_quality = quality
+            break
+        except ValueError:
+            continue
+
+    return EpisodeFile(" ".join(words), item['link'], file_quality)
+
+
+# endregion
+
+
+def baseline(items: list):
+    for item in items:
+        file = baseline_parse_item(item)
+        baseline_from_title(file.title, "1")
+
+
+def single_pass(items: list):
+    for item in items:
+        file = parse_item(item)
+        Episode.from_info(title_info(file), "1")
+
+
+def batch(items: list):
+    files = parse_items(items)
+    Episode.from_infos([title_info(file) for file in files], "1")
+
+
+def check(items: list):
+    """ Checks that both parsers agree on every title of the corpus """
+    for item in items:
+        expected_file = baseline_parse_item(item)
+        expected = baseline_from_title(expected_file.title, "1")
+
+        file = parse_item(item)
+        episode = Episode.from_info(title_info(file), "1")
+
+        assert file == expected_file, (file, expected_file)
+        assert (episode.tvshow, episode.season, episode.number) == \
+            (expected.tvshow, expected.season, expected.number)
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    with open(CORPUS) as file:
+        items = [{'title': line.strip(), 'link': 'magnet:'}
+                 for line in file if line.strip()]
+
+    check(items)
+
+    parsers = [("baseline", baseline),
+               ("single-pass", single_pass),
+               ("batch", batch)]
+
+    # Measurements of the parsers are interleaved, so that any change in
+    # the load of the machine affects all of them alike
+    best = {name: float('inf') for name, _ in parsers}
+    for _ in range(repeat):
+        for name, parser in parsers:
+            seconds = timeit.timeit(lambda: parser(items), number=NUMBER)
+            best[name] = min(best[name], seconds)
+
+    print(f"{len(items)} titles, best of {repeat} runs of {NUMBER} passes")
+    for name, seconds in best.items():
+        per_title = seconds / (NUMBER * len(items)) * 1e6
+        print(f"{name:>12}: {per_title:6.2f} us/title "
+              f"({best['baseline'] / seconds:4.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
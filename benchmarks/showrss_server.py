@@ -0,0 +1,195 @@
+"""
+Local stand-in for the ShowRSS website, serving synthetic feeds to the
+benchmarks.
+
+The server hosts the feeds of *shows* TV shows, with IDs 1 to *shows*, at
+/show/<id>.rss. Each feed lists *items* files, newest first, alternating
+between an SD and a 720p file of each episode, as ShowRSS does. Feeds are
+generated deterministically, so every run serves the same bytes.
+
+Requests are answered after *latency* seconds. A fraction *error_rate* of
+them, picked by a generator seeded with *seed*, fails with a 503 response.
+Feeds carry an ETag, so conditional requests for a feed that did not
+change get a 304 response. New episodes are released to every feed with
+publish().
+
+Usage: python -m benchmarks.showrss_server [port] [shows] [items]
+"""
+import hashlib
+import random
+import sys
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Lock, Thread
+
+
+def feed_titles(tvshow_id: int, episodes: int) -> list:
+    """
+    Returns the titles of the items in the feed of TV show *tvshow_id*,
+    once it has *episodes* episodes, newest first
+    """
+    titles = []
+    for index in reversed(range(episodes)):
+        season, number = divmod(index, 20)
+        title = f"Show {tvshow_id} {season + 1}x{number + 1:02d} " \
+                f"Episode {number + 1}"
+        titles.append(f"{title} 720p")
+        titles.append(title)
+
+    return titles
+
+
+def build_feed(tvshow_id: int, episodes: int, items: int) -> bytes:
+    """ Builds the feed of TV show *tvshow_id* with its newest *items* """
+    entries = []
+    for title in feed_titles(tvshow_id, episodes)[:items]:
+        info_hash = hashlib.sha1(title.encode()).hexdigest()
+        entries.append(f"<item><title>{title}</title>"
+                       f"<link>magnet:?xt=urn:btih:{info_hash}</link>"
+                       f"<guid>{info_hash}</guid></item>")
+
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<rss version="2.0"><channel>'
+            f'<title>showRSS: feed for Show {tvshow_id}</title>'
+            f'{"".join(entries)}'
+            '</channel></rss>').encode()
+
+
+class ShowRSSServer:
+    """ Server of synthetic ShowRSS feeds, running in a background thread """
+
+    def __init__(self, shows: int = 50, items: int = 40, latency: float = 0.,
+                 error_rate: float = 0., seed: int = 0, port: int = 0):
+        """
+        :param shows:      number of TV shows served
+        :param items:      number of items in each feed
+        :param latency:    time each request takes to be answered, in seconds
+        :param error_rate: fraction of the requests answered with an error
+        :param seed:       seed of the generator picking failed requests
+        :param port:       port to listen on (any free port by default)
+        """
+        self.shows = shows
+        self.items = items
+        self.latency = latency
+        self.error_rate = error_rate
+
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self._version = 0
+        self._feeds = {}
+        self._episodes = items // 2
+        self._build_feeds()
+
+        self._server = _Server(('127.0.0.1', port), _Handler)
+        self._server.showrss = self
+        self._thread = None
+
+        # Requests received and requests answered with an error
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def url(self) -> str:
+        """ Base URL of the feeds, as expected by ShowRSSSource """
+        return "http://127.0.0.1:%d/show" % self._server.server_port
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever,
+                              args=(0.05,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._thread.join()
+        self._server.server_close()
+
+    def publish(self, episodes: int = 1):
+        """ Releases *episodes* new episodes of every TV show """
+        with self._lock:
+            self._episodes += episodes
+            self._version += 1
+            self._build_feeds()
+
+    def _build_feeds(self):
+        self._feeds = {
+            str(tvshow_id): build_feed(tvshow_id, self._episodes, self.items)
+            for tvshow_id in range(1, self.shows + 1)
+        }
+
+    def _respond(self, tvshow_id: str) -> (int, bytes, str):
+        """ Returns the status, body, and ETag of a request for a feed """
+        with self._lock:
+            self.requests += 1
+            if self._random.random() < self.error_rate:
+                self.errors += 1
+                return 503, b'', None
+
+            feed = self._feeds.get(tvshow_id)
+            if feed is None:
+                return 404, b'', None
+
+            return 200, feed, f'"{tvshow_id}-{self._version}"'
+
+
+class _Server(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    # Asynchronous clients open many connections at once, which would
+    # overflow the default backlog of 5 and stall in SYN retransmissions
+    request_queue_size = 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    # Send the head and the body of each response in a single segment, not
+    # to add the delay of Nagle's algorithm to the measurements
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        showrss = self.server.showrss
+        time.sleep(showrss.latency)
+
+        tvshow_id = self.path.rsplit('/', 1)[-1][:-len('.rss')]
+        status, body, etag = showrss._respond(tvshow_id)
+
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    shows = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    items = int(sys.argv[3]) if len(sys.argv) > 3 else 40
+
+    with ShowRSSServer(shows, items, port=port) as server:
+        print(f"serving {shows} feeds at {server.url}/<id>.rss")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
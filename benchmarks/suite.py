@@ -0,0 +1,403 @@
+"""
+Benchmark suite of the tracker's hot paths, against a local stand-in for
+ShowRSS (see showrss_server.py).
+
+The suite measures:
+  - track: Tracker.track() over every TV show of the server, on a fresh DB
+    (cold), when no feed changed (unchanged), and after a new episode of
+    every TV show was released (new_episode), with the blocking
+    ShowRSSSource (track), with the AsyncShowRSSSource (track_async), and
+    with the AsyncShowRSSSource in --shards worker processes (track_sharded,
+    whose cold runs include starting the workers)
+  - parse_feed: parsing the feeds of every TV show
+  - from_title: parsing the title of each file of those feeds into an
+    episode
+  - db: the Episode DB Connection methods used by the tracker and the
+    downloader, on a DB with the episodes of every TV show
+
+Each benchmark is run *repeat* times. The results report the median and
+the minimum time of a run, and the operations per second of the median run.
+They are printed and, with --save, written to a JSON file, together with
+the parameters of the run and the commit being measured. With --baseline,
+the results are compared with those in a JSON file saved before, e.g. from
+another commit, and the run fails if any median got slower than the
+--tolerance allows.
+
+Only compare results obtained with the same parameters on the same machine.
+
+Usage: python -m benchmarks.suite [--shows N] [--items N] [--latency S]
+           [--error-rate F] [--repeat N] [--save FILE] [--baseline FILE]
+"""
+import argparse
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from types import SimpleNamespace
+
+from benchmarks.showrss_server import ShowRSSServer, build_feed, feed_titles
+from tveebot_tracker.download_queue import DownloadQueue
+from tveebot_tracker.episode import TVShow, Quality, Episode, EpisodeFile, \
+    State
+from tveebot_tracker.episode_db import EpisodeDB, connect
+from tveebot_tracker.sharded_tracker import ShardedTracker
+from tveebot_tracker.showrss_source import ShowRSSSource, parse_feed, \
+    AsyncShowRSSSource
+from tveebot_tracker.tracker import Tracker
+
+# Version of the format of the results file
+FORMAT_VERSION = 1
+
+
+def measure(run, repeat: int, setup=None, teardown=None) -> list:
+    """
+    Times *repeat* calls to *run*. If a *setup* function is given, it is
+    called, untimed, before each run, and its result is passed to *run* and
+    then to *teardown*, also untimed.
+
+    :return: list with the duration of each run, in seconds
+    """
+    durations = []
+    for _ in range(repeat):
+        args = (setup(),) if setup is not None else ()
+        start = time.perf_counter()
+        run(*args)
+        durations.append(time.perf_counter() - start)
+
+        if teardown is not None:
+            teardown(*args)
+
+    return durations
+
+
+def summarize(durations: list, operations: int) -> dict:
+    median = statistics.median(durations)
+    return {
+        'operations': operations,
+        'median_seconds': median,
+        'min_seconds': min(durations),
+        'ops_per_second': operations / median if median > 0 else None,
+    }
+
+
+def temporary_db(directory: str, name: str) -> EpisodeDB:
+    config = SimpleNamespace(db_file=Path(directory, f"{name}.db"),
+                             db_profile='default')
+    return EpisodeDB(config)
+
+
+# region Benchmarks
+
+
+def bench_track(args, directory: str) -> dict:
+    config = SimpleNamespace(db_profile='default', track_period=5.0,
+                             max_track_period=86400.0,
+                             fetch_workers=args.fetch_workers,
+                             max_concurrent_fetches=args.fetch_workers)
+    config.shards = args.shards
+
+    def sharded(url: str, db: EpisodeDB, queue: DownloadQueue):
+        # Each worker keeps up to fetch_workers fetches in flight
+        return ShardedTracker(
+            partial(AsyncShowRSSSource, url,
+                    max_connections=args.fetch_workers),
+            db, queue, config)
+
+    trackers = {
+        'track': lambda url, db, queue: Tracker(
+            ShowRSSSource(url), db, queue, config),
+        'track_async': lambda url, db, queue: Tracker(
+            AsyncShowRSSSource(url, max_connections=args.fetch_workers),
+            db, queue, config),
+        'track_sharded': sharded,
+    }
+    results = {}
+
+    for benchmark, new_tracker in trackers.items():
+        with ShowRSSServer(args.shows, args.items, args.latency,
+                           args.error_rate, args.seed) as server:
+            runs = {'cold': [], 'unchanged': [], 'new_episode': []}
+
+            for run in range(args.repeat):
+                config.db_file = Path(directory, f"{benchmark}-{run}.db")
+                db = EpisodeDB(config)
+                tracker = new_tracker(server.url, db, DownloadQueue(db))
+                with connect(db) as connection:
+                    for tvshow_id in range(1, args.shows + 1):
+                        connection.insert_tvshow(
+                            TVShow(str(tvshow_id), f"Show {tvshow_id}"),
+                            Quality.HD)
+
+                runs['cold'].extend(measure(tracker.track, 1))
+                runs['unchanged'].extend(measure(tracker.track, 1))
+                server.publish()
+                runs['new_episode'].extend(measure(tracker.track, 1))
+                if isinstance(tracker, ShardedTracker):
+                    tracker.close()
+                db.close()
+
+            for name, durations in runs.items():
+                results[f'{benchmark}.{name}'] = \
+                    summarize(durations, args.shows)
+
+            results[f'{benchmark}.cold']['server_errors'] = server.errors
+
+    return results
+
+
+def bench_parsing(args, directory: str) -> dict:
+    feeds = [(str(tvshow_id), build_feed(tvshow_id, args.items // 2,
+                                         args.items))
+             for tvshow_id in range(1, args.shows + 1)]
+    titles = [(tvshow_id, file.title)
+              for tvshow_id, feed in feeds for file in parse_feed(feed)]
+
+    def parse_feeds():
+        for _, feed in feeds:
+            parse_feed(feed)
+
+    def from_title():
+        for tvshow_id, title in titles:
+            Episode.from_title(title, tvshow_id)
+
+    return {
+        'parse_feed': summarize(
+            measure(parse_feeds, args.repeat), len(feeds)),
+        'from_title': summarize(
+            measure(from_title, args.repeat), len(titles)),
+    }
+
+
+def bench_db(args, directory: str) -> dict:
+    tvshows = [TVShow(str(tvshow_id), f"Show {tvshow_id}")
+               for tvshow_id in range(1, args.shows + 1)]
+
+    # The files of each TV show, as selected by the tracker
+    files = []
+    for tvshow in tvshows:
+        for title in feed_titles(int(tvshow.id), args.items // 2)[::2]:
+            episode = Episode.from_title(title, tvshow.id)
+            files.append((episode, EpisodeFile(title, "magnet:", Quality.HD)))
+    episodes = [episode for episode, _ in files]
+
+    runs = 0
+
+    def new_db() -> EpisodeDB:
+        nonlocal runs
+        runs += 1
+        db = temporary_db(directory, f"db-{runs}")
+        with connect(db) as connection:
+            for tvshow in tvshows:
+                connection.insert_tvshow(tvshow, Quality.HD)
+        return db
+
+    def populated_db() -> EpisodeDB:
+        db = new_db()
+        with connect(db) as connection:
+            store(connection)
+        return db
+
+    def store(connection):
+        # As the tracker does, in a single transaction
+        with connection.transaction():
+            connection.insert_episodes(episodes)
+            connection.insert_files(files)
+            connection.set_episode_states(
+                (episode, State.QUEUED) for episode in episodes)
+            connection.enqueue_downloads(episodes)
+
+    def insert(db: EpisodeDB):
+        with connect(db) as connection:
+            store(connection)
+
+    def read_all(db: EpisodeDB):
+        with connect(db) as connection:
+            for _ in connection.episodes(include_state=True):
+                pass
+
+    def read_each_tvshow(db: EpisodeDB):
+        with connect(db) as connection:
+            for tvshow in tvshows:
+                for _ in connection.episodes_from(tvshow.id):
+                    pass
+
+    def download_all(db: EpisodeDB):
+        # As the downloader does, one transaction per state change
+        queue = DownloadQueue(db)
+        for episode, _ in queue.get_many():
+            with connect(db) as connection:
+                connection.set_episode_state(episode, State.DOWNLOADING)
+
+            with connect(db) as connection:
+                connection.set_episode_state(episode, State.DOWNLOADED)
+                connection.set_download_timestamp(episode, datetime.now())
+                connection.ack_download(episode)
+
+    def history(db: EpisodeDB):
+        with connect(db) as connection:
+            for _ in connection.downloads():
+                pass
+
+    def downloaded_db() -> EpisodeDB:
+        db = populated_db()
+        download_all(db)
+        return db
+
+    def run(benchmark, setup) -> list:
+        return measure(benchmark, args.repeat, setup, EpisodeDB.close)
+
+    count = len(episodes)
+    return {
+        'db.store': summarize(run(insert, new_db), count),
+        'db.episodes': summarize(run(read_all, populated_db), count),
+        'db.episodes_from': summarize(
+            run(read_each_tvshow, populated_db), len(tvshows)),
+        'db.download': summarize(run(download_all, populated_db), count),
+        'db.downloads': summarize(run(history, downloaded_db), count),
+    }
+
+
+BENCHMARKS = {
+    'track': bench_track,
+    'parsing': bench_parsing,
+    'db': bench_db,
+}
+
+# endregion
+
+# region Results
+
+
+def commit() -> str:
+    """ Returns the commit being measured, if it is known """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Prints the change of each median with respect to the *baseline*.
+
+    :return: list with the names of the benchmarks that got slower than
+             the *tolerance* allows
+    """
+    if results['parameters'] != baseline['parameters']:
+        print("warning: the baseline was obtained with other parameters: "
+              f"{baseline['parameters']}")
+
+    print(f"\ncompared with {baseline.get('commit') or 'the baseline'}:")
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        if before is None:
+            print(f"{name:>20}: not in the baseline")
+            continue
+
+        change = result['median_seconds'] / before['median_seconds'] - 1
+        slower = change > tolerance
+        if slower:
+            regressions.append(name)
+
+        print(f"{name:>20}: {before['median_seconds'] * 1000:10.3f} ms -> "
+              f"{result['median_seconds'] * 1000:10.3f} ms "
+              f"({change:+7.1%}){'  SLOWER' if slower else ''}")
+
+    return regressions
+
+
+# endregion
+
+
+def parse_args(argv: list):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.suite',
+        description="Benchmarks the tracker against a local ShowRSS "
+                    "stand-in")
+    parser.add_argument('--shows', type=int, default=50,
+                        help="TV shows served (default: %(default)s)")
+    parser.add_argument('--items', type=int, default=40,
+                        help="items per feed (default: %(default)s)")
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help="latency of the server, in seconds "
+                             "(default: %(default)s)")
+    parser.add_argument('--error-rate', type=float, default=0.,
+                        help="fraction of requests that fail "
+                             "(default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed picking the requests that fail")
+    parser.add_argument('--fetch-workers', type=int, default=8,
+                        help="fetches in flight at the same time "
+                             "(default: %(default)s)")
+    parser.add_argument('--shards', type=int, default=4,
+                        help="worker processes of the sharded tracker "
+                             "(default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="runs of each benchmark (default: %(default)s)")
+    parser.add_argument('--only', choices=BENCHMARKS, action='append',
+                        help="run only these benchmarks")
+    parser.add_argument('--save', metavar='FILE',
+                        help="save the results to a JSON file")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="compare with the results in a JSON file")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="slowdown allowed with respect to the baseline "
+                             "(default: %(default)s)")
+    return parser.parse_args(argv)
+
+
+def main(argv: list = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    # The tracker logs every fetch and every failed one, which would slow it
+    # down and flood the output
+    logging.getLogger('tracker').setLevel(logging.CRITICAL)
+
+    parameters = {name: getattr(args, name) for name in (
+        'shows', 'items', 'latency', 'error_rate', 'seed', 'fetch_workers',
+        'shards', 'repeat')}
+    results = {
+        'format': FORMAT_VERSION,
+        'commit': commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'benchmarks': {},
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, benchmark in BENCHMARKS.items():
+            if args.only and name not in args.only:
+                continue
+
+            results['benchmarks'].update(benchmark(args, directory))
+
+    for name, result in results['benchmarks'].items():
+        print(f"{name:>20}: {result['median_seconds'] * 1000:10.3f} ms "
+              f"(min {result['min_seconds'] * 1000:10.3f} ms) "
+              f"{result['ops_per_second'] or 0:12.1f} ops/s")
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,6 +12,7 @@ setup(
     packages=find_packages(),
 
     package_data={
-        'tveebot_tracker': ['config.ini', 'tables.sql'],
+        'tveebot_tracker': ['config.ini', 'tables.sql', 'indexes.sql',
+                            'validators.sql'],
     },
 )
@@ -0,0 +1,207 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from tveebot_tracker.episode import title_info
+from tveebot_tracker.exceptions import ParseError
+from tveebot_tracker.source import EpisodeSource, TVShowNotFoundError, \
+    Validators
+
+logger = logging.getLogger('composite_source')
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.DEBUG)
+
+
+class CompositeSource(EpisodeSource):
+    """
+    Source aggregating multiple sources, usually mirrors of the same feeds.
+
+    Each fetch is fanned out to all sources at once. Each source has its own
+    pool of *max_workers* threads, so that a source that hangs only takes
+    its own threads, and not those fetching from the other sources.
+
+    A fetch returns once the fastest source answers with its files. Sources
+    answering within *merge_window* seconds after it, and within their own
+    timeout, have their files merged too, in the order the sources
+    answered, so that the files of the fastest source come first. Sources
+    that take longer are not waited for: their files, if they arrive at
+    all, are discarded. The timeout of each source counts from the moment
+    its fetch starts running. A fetch waiting for a thread of its source for
+    longer than the timeout is given up before it starts.
+
+    The same file may be listed by more than one source. Files are
+    deduplicated by episode, quality, and flags: of the copies of a file,
+    only the one from the fastest source is kept. Files whose titles can
+    not be parsed are deduplicated by link.
+
+    A TV show must have the same reference in all sources.
+    """
+
+    # Time each source has to answer, if not specified for the source
+    DEFAULT_TIMEOUT = 30.0  # seconds
+
+    # Threads fetching from each source, if not specified
+    DEFAULT_MAX_WORKERS = 8
+
+    def __init__(self, sources: list, timeout: float = DEFAULT_TIMEOUT,
+                 max_workers: int = DEFAULT_MAX_WORKERS,
+                 merge_window: float = 0.):
+        """
+        :param sources:      sources to aggregate. Each may be given with its
+                             own timeout as a (source, timeout) pair
+        :param timeout:      time, in seconds, each source has to answer, if
+                             not given with the source
+        :param max_workers:  number of threads fetching from each source
+        :param merge_window: time, in seconds, the other sources have to
+                             answer after the fastest one did
+        """
+        self.sources = []
+        for source in sources:
+            if isinstance(source, EpisodeSource):
+                source = (source, timeout)
+
+            self.sources.append(source)
+
+        self.merge_window = merge_window
+
+        self._executors = [
+            ThreadPoolExecutor(max_workers,
+                               thread_name_prefix=f'composite_source_{index}')
+            for index in range(len(self.sources))
+        ]
+
+    def close(self):
+        """ Stops the threads fetching from the sources """
+        for executor in self._executors:
+            executor.shutdown(wait=False)
+
+    def fetch(self, tvshow_reference: str) -> list:
+        """
+        Fetches all the episode files available at any of the sources for
+        the specified TV show.
+
+        :return: list with the deduplicated files of the sources that
+                 answered in time, those of the fastest sources first
+        :raise TVShowNotFound: if no source answered with files in time, and
+                               at least one did not find the TV show
+        :raise ConnectionError: if no source answered in time, or the error
+                                of one of the sources that failed
+        """
+        return self._fan_out(lambda source: source.fetch(tvshow_reference))
+
+    def fetch_until(self, tvshow_reference: str, stop,
+                    validators: Validators = None) -> list:
+        """
+        Fetches the episode files of the specified TV show from all sources,
+        each until the first file for which *stop* returns True. See
+        fetch() and EpisodeSource.fetch_until().
+
+        The *validators* are ignored: each source has validators of its own,
+        so the feeds are always requested unconditionally.
+        """
+        return self._fan_out(
+            lambda source: source.fetch_until(tvshow_reference, stop))
+
+    def _fan_out(self, fetch) -> list:
+        """
+        Calls *fetch* with each source, in parallel, and merges the files
+        returned by the sources that answered in time
+        """
+        pending = {}
+        for executor, (source, timeout) in zip(self._executors,
+                                               self.sources):
+            call = _Call(source, timeout)
+            pending[executor.submit(call.run, fetch)] = call
+
+        results = []
+        errors = []
+        merge_deadline = None
+        while pending:
+            deadline = min(call.deadline() for call in pending.values())
+            if merge_deadline is not None:
+                deadline = min(deadline, merge_deadline)
+
+            timeout = max(0., deadline - time.monotonic())
+            done, _ = wait(pending, timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                call = pending.pop(future)
+                try:
+                    results.append(future.result())
+                except (ConnectionError, TVShowNotFoundError,
+                        ParseError) as error:
+                    logger.warning(f"{call.source} failed: {error}")
+                    errors.append(error)
+
+            now = time.monotonic()
+            if results and merge_deadline is None:
+                merge_deadline = now + self.merge_window
+
+            if merge_deadline is not None and merge_deadline <= now:
+                # The fastest sources already answered
+                for future in pending:
+                    future.cancel()
+                break
+
+            # Stop waiting for the sources that did not answer in time
+            for future, call in list(pending.items()):
+                if call.deadline() <= now:
+                    logger.warning(f"{call.source} did not answer in time")
+                    future.cancel()
+                    del pending[future]
+
+        if not results:
+            if not errors:
+                raise ConnectionError("no source answered in time")
+
+            # Not finding the TV show is not a problem of the sources
+            errors.sort(key=lambda e: not isinstance(e, TVShowNotFoundError))
+            raise errors[0]
+
+        return merge_files(results)
+
+
+class _Call:
+    """ Fetch from a single source, whose timeout starts once it runs """
+
+    def __init__(self, source: EpisodeSource, timeout: float):
+        self.source = source
+        self.timeout = timeout
+        self.submitted = time.monotonic()
+        self.started = None
+
+    def deadline(self) -> float:
+        """
+        Time by which the source must answer, or, until the fetch starts,
+        by which it must start
+        """
+        if self.started is None:
+            return self.submitted + self.timeout
+
+        return self.started + self.timeout
+
+    def run(self, fetch) -> list:
+        self.started = time.monotonic()
+        return fetch(self.source)
+
+
+def merge_files(results: list) -> list:
+    """
+    Merges the lists of files in *results*, keeping their order, and drops
+    the copies of files already in a previous list.
+    """
+    merged = []
+    seen = set()
+    for files in results:
+        for file in files:
+            try:
+                info = title_info(file)
+                key = (info.season, info.number, file.quality, info.flags)
+            except ParseError:
+                key = file.link
+
+            if key not in seen:
+                seen.add(key)
+                merged.append(file)
+
+    return merged
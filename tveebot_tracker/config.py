@@ -1,9 +1,33 @@
-from configparser import ConfigParser
+import logging
+import os
+from collections import namedtuple
+from configparser import ConfigParser, Error as ConfigParserError
 from os import PathLike
+from threading import Lock
 
 from pathlib import Path
 from pkg_resources import resource_filename
 
+from tveebot_tracker.stoppable_thread import StoppableThread
+
+logger = logging.getLogger('config')
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.DEBUG)
+
+# Snapshot of all configuration parameters, already converted to their types
+Settings = namedtuple("Settings", [
+    "track_period",
+    "max_track_period",
+    "fetch_workers",
+    "max_concurrent_fetches",
+    "shards",
+    "db_file",
+    "db_profile",
+    "download_dir",
+    "max_active_downloads",
+    "download_cache_size",
+])
+
 
 class Config:
     """
@@ -12,18 +36,43 @@ class Config:
     The components, such as the tracker or the downloader, should access the
     configuration parameters through a Config instance.
 
-    Configurations can be loaded from one or multiple files.
+    Configurations can be loaded from one or multiple files. Files loaded
+    later override the parameters of the ones loaded before. Every time a
+    file is loaded, all parameters are parsed into an immutable Settings
+    snapshot, which replaces the previous one at once. Components reading a
+    parameter get it from the current snapshot, without any parsing, and
+    never see a mix of old and new parameters.
 
     Configurations can be changed while the daemon is already running. To do
-    this, just ask config to reload and it will update every parameter for
-    all components immediately.
+    this, just ask config to reload, or have a ConfigWatcher reload it when
+    the files change, and it will update every parameter for all components
+    immediately. Components that need to react to a change may register a
+    listener with add_listener().
+
+    Some parameters, such as the DB file, are only read when a component
+    starts, so changing them requires a restart.
     """
-    # TODO improve documentation for this class
 
     DEFAULT_CONF = resource_filename(__name__, 'config.ini')
 
     def __init__(self):
-        self._config = ConfigParser()
+        self._files = []
+        self._settings = None
+        self._listeners = []
+
+        # Serializes loads, so that concurrent reloads do not interleave
+        self._lock = Lock()
+
+    @property
+    def files(self) -> list:
+        """ Files loaded, in the order they were loaded """
+        with self._lock:
+            return list(self._files)
+
+    @property
+    def settings(self) -> Settings:
+        """ Snapshot of the current configurations (None until loaded) """
+        return self._settings
 
     def load_defaults(self):
         """ Loads the default configurations """
@@ -36,20 +85,192 @@ class Config:
         kept with their current value.
 
         :param file: INI file to load configurations from
+        :raise ValueError: if a parameter is missing or has an invalid
+                           value, once all files loaded so far are combined.
+                           The configurations are then left unchanged
+        """
+        self._update(new_file=file)
+
+    def reload(self) -> bool:
+        """
+        Loads all files loaded so far again, in the same order.
+
+        :return: True if any parameter changed, False otherwise
+        :raise ValueError: if a parameter is missing or has an invalid value.
+                           The configurations are then left unchanged
+        """
+        return self._update()
+
+    def add_listener(self, listener):
+        """
+        Registers a *listener* to be called, as listener(old, new), with the
+        old and new Settings every time a load or a reload changes them. It
+        is called by the thread loading the configurations.
         """
-        with open(file) as f:
-            self._config.read_file(f)
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """ Unregisters a *listener* registered with add_listener() """
+        self._listeners.remove(listener)
+
+    def _update(self, new_file: PathLike = None) -> bool:
+        """
+        Parses the files loaded so far, followed by *new_file* if given,
+        into a new snapshot, which replaces the current one, and notifies
+        the listeners if it changed
+        """
+        with self._lock:
+            # The files are read under the lock, so that a concurrent load
+            # is not lost
+            files = self._files
+            if new_file is not None:
+                files = files + [new_file]
+
+            parser = ConfigParser()
+            for file in files:
+                with open(file) as f:
+                    parser.read_file(f)
+
+            old, new = self._settings, _parse(parser)
+            self._files = files
+            self._settings = new
+
+        if new == old:
+            return False
+
+        for listener in list(self._listeners):
+            try:
+                listener(old, new)
+            except Exception:
+                logger.exception(f"listener {listener!r} failed")
+
+        return True
 
     @property
     def track_period(self):
-        return float(self._config['tracker']['TrackPeriod'])
+        return self._settings.track_period
+
+    @property
+    def max_track_period(self):
+        return self._settings.max_track_period
+
+    @property
+    def fetch_workers(self):
+        return self._settings.fetch_workers
+
+    @property
+    def max_concurrent_fetches(self):
+        return self._settings.max_concurrent_fetches
+
+    @property
+    def shards(self):
+        """ Worker processes checking TV shows, when the tracker is sharded """
+        return self._settings.shards
 
     @property
     def db_file(self):
-        return Path(self._config['tracker']['Database'])
+        return self._settings.db_file
+
+    @property
+    def db_profile(self):
+        return self._settings.db_profile
 
     @property
     def download_dir(self):
-        return Path(self._config['downloader']['DownloadDirectory'])
+        return self._settings.download_dir
+
+    @property
+    def max_active_downloads(self):
+        return self._settings.max_active_downloads
+
+    @property
+    def download_cache_size(self):
+        """ Size of the torrent session's disk cache, in MiB """
+        return self._settings.download_cache_size
+
+
+def _parse(parser: ConfigParser) -> Settings:
+    """
+    Parses the parameters read by *parser* into a snapshot
+
+    :raise ValueError: if a parameter is missing or has an invalid value
+    """
+    try:
+        tracker = parser['tracker']
+        downloader = parser['downloader']
+
+        return Settings(
+            track_period=float(tracker['TrackPeriod']),
+            max_track_period=float(tracker['MaxTrackPeriod']),
+            fetch_workers=int(tracker['FetchWorkers']),
+            max_concurrent_fetches=int(tracker['MaxConcurrentFetches']),
+            shards=int(tracker['Shards']),
+            db_file=Path(tracker['Database']),
+            db_profile=tracker['DatabaseProfile'],
+            download_dir=Path(downloader['DownloadDirectory']),
+            max_active_downloads=int(downloader['MaxActiveDownloads']),
+            download_cache_size=int(downloader['CacheSize']),
+        )
+
+    except KeyError as error:
+        raise ValueError(f"missing configuration {error}")
+
+    except (ValueError, ConfigParserError) as error:
+        raise ValueError(f"invalid configuration: {error}")
+
+
+class ConfigWatcher(StoppableThread):
+    """
+    Thread reloading a Config whenever one of its files changes.
+
+    Files are polled every *period* seconds: a file changed if its
+    modification time or its size did. Reloads that fail, e.g. because a
+    file is being written or has an invalid value, are logged and leave the
+    configurations unchanged, and are retried once the file changes again.
+    """
+
+    def __init__(self, config: Config, period: float = 1.0):
+        """
+        :param config: configurations to reload
+        :param period: time between checks of the files, in seconds
+        """
+        super().__init__(daemon=True)
+        self._config = config
+        self.period = period
+        self._stats = self._stat_files()
+
+    def run(self):
+        while not self.wait_on_stop(self.period):
+            self.check()
+
+    def check(self) -> bool:
+        """
+        Reloads the configurations if any of the files changed since the
+        last check.
+
+        :return: True if the configurations were reloaded, False otherwise
+        """
+        stats = self._stat_files()
+        if stats == self._stats:
+            return False
+        self._stats = stats
+
+        try:
+            if self._config.reload():
+                logger.info("reloaded configurations")
+        except (OSError, ValueError) as error:
+            logger.error(f"failed to reload configurations: {error}")
+            return False
+
+        return True
 
+    def _stat_files(self) -> list:
+        stats = []
+        for file in self._config.files:
+            try:
+                stat = os.stat(file)
+                stats.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                stats.append(None)
 
+        return stats
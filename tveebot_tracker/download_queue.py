@@ -0,0 +1,177 @@
+import time
+from queue import Empty
+from threading import Event
+
+from tveebot_tracker import metrics
+from tveebot_tracker.episode import Episode
+from tveebot_tracker.episode_db import EpisodeDB, connect
+
+queue_depth = metrics.gauge(
+    'tveebot_download_queue_depth',
+    "Episodes in the download queue, including those downloading")
+
+
+class DownloadQueue:
+    """
+    Queue of episodes to download, shared by the tracker, which puts new
+    episodes in it, and the downloader, which downloads them.
+
+    The queue is stored in the Episode DB, so no queued episode is lost if
+    the application stops. Episodes are consumed with lease/ack semantics:
+    getting an episode leases it, and the episode only leaves the queue once
+    it is acknowledged, after it finishes downloading. On restart,
+    recover() makes every episode that was not acknowledged available again.
+
+    In front of the DB there is an in-memory fast path: producers notify the
+    queue when they put episodes in it, which wakes up blocked consumers and
+    lets the others skip querying the DB while there is nothing new. The
+    notifications are only a hint: episodes put through another instance, or
+    another process, are not notified, so once the queue is found empty the
+    DB is still queried again every *poll_period* seconds.
+    """
+
+    def __init__(self, database: EpisodeDB, poll_period: float = 1.0):
+        """
+        :param database: DB storing the queue
+        :param poll_period: maximum time, in seconds, during which consumers
+                            skip querying the DB for episodes that were not
+                            notified
+        """
+        self._database = database
+        self.poll_period = poll_period
+
+        # Set when the DB may contain episodes that were not leased yet
+        self._available = Event()
+        self._available.set()
+
+        # Time at which the DB was last found without available episodes
+        self._found_empty = 0.
+
+    def __len__(self):
+        """ Number of episodes in the queue, including leased ones """
+        with connect(self._database) as connection:
+            return connection.download_queue_size()
+
+    def put(self, episodes):
+        """
+        Puts *episodes* at the end of the queue. Their files must already be
+        stored in the DB.
+
+        Producers writing to the DB can instead put episodes in the queue as
+        part of their own transaction, with Connection.enqueue_downloads(),
+        and then call notify() once that transaction is committed.
+        """
+        with connect(self._database) as connection:
+            connection.enqueue_downloads(episodes)
+            queue_depth.set(connection.download_queue_size())
+
+        self.notify()
+
+    def notify(self):
+        """ Notifies consumers that new episodes were put in the queue """
+        self._available.set()
+
+    def get(self, timeout: float = None) -> tuple:
+        """
+        Leases the episode at the front of the queue, blocking until one is
+        available or the *timeout* (in seconds) expires.
+
+        :return: (episode, file) pair
+        :raise Empty: if no episode became available before the timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            leased = self._lease(limit=1)
+            if leased:
+                return leased[0]
+
+            if deadline is None:
+                wait = self.poll_period
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Empty
+                wait = min(remaining, self.poll_period)
+
+            self._available.wait(wait)
+
+    def get_nowait(self) -> tuple:
+        """
+        Leases the episode at the front of the queue, if any is available.
+
+        :return: (episode, file) pair
+        :raise Empty: if no episode is available
+        """
+        leased = self.get_many(limit=1)
+        if not leased:
+            raise Empty
+
+        return leased[0]
+
+    def get_many(self, limit: int = None) -> list:
+        """
+        Leases up to *limit* episodes from the front of the queue, without
+        blocking. The DB is only queried if new episodes were notified since
+        the last time it was found empty, or if that was at least
+        *poll_period* seconds ago.
+
+        :param limit: maximum number of episodes to lease (no limit if None)
+        :return: list of (episode, file) pairs, in queue order
+        """
+        if not self._available.is_set() and \
+                time.monotonic() - self._found_empty < self.poll_period:
+            return []
+
+        return self._lease(limit)
+
+    def _lease(self, limit: int = None) -> list:
+        """
+        Leases up to *limit* episodes from the DB, updating the fast path
+        """
+        # Clear before querying, not to miss notifications made meanwhile
+        self._available.clear()
+        with connect(self._database) as connection:
+            leased = connection.lease_downloads(limit)
+
+        if limit is not None and len(leased) == limit:
+            # There may be more episodes available
+            self._available.set()
+        else:
+            self._found_empty = time.monotonic()
+
+        return leased
+
+    def ack(self, episode: Episode):
+        """
+        Acknowledges that *episode* was downloaded, removing it from the
+        queue. Consumers updating the DB can instead do this as part of their
+        own transaction, with Connection.ack_download().
+        """
+        with connect(self._database) as connection:
+            connection.ack_download(episode)
+            queue_depth.set(connection.download_queue_size())
+
+    def release(self, episode: Episode):
+        """
+        Releases the lease of *episode*, which failed to download, putting it
+        back at the end of the queue. Consumers updating the DB can instead
+        do this as part of their own transaction, with
+        Connection.release_download(), and then call notify().
+        """
+        with connect(self._database) as connection:
+            connection.release_download(episode)
+
+        self.notify()
+
+    def recover(self):
+        """
+        Makes every episode in the queue available again, including the
+        ones leased before a restart. Episodes QUEUED or DOWNLOADING in the
+        DB, but missing from the queue, are put back in it as well.
+        """
+        with connect(self._database) as connection:
+            connection.recover_downloads()
+            queue_depth.set(connection.download_queue_size())
+
+        self.notify()
@@ -1,10 +1,12 @@
 import logging
+import time
 from datetime import datetime
-from queue import Queue, Empty
 
 import libtorrent as lt
 
+from tveebot_tracker import metrics
 from tveebot_tracker.config import Config
+from tveebot_tracker.download_queue import DownloadQueue, queue_depth
 from tveebot_tracker.episode import Episode, EpisodeFile, State
 from tveebot_tracker.episode_db import EpisodeDB, connect
 from tveebot_tracker.stoppable_thread import StoppableThread
@@ -13,6 +15,16 @@ logger = logging.getLogger('downloader')
 logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.DEBUG)
 
+active_torrents = metrics.gauge(
+    'tveebot_active_torrents', "Torrents being downloaded")
+download_rate = metrics.gauge(
+    'tveebot_download_rate_bytes', "Payload download rate of all torrents, "
+                                   "in bytes per second")
+downloaded_bytes = metrics.counter(
+    'tveebot_downloaded_bytes_total', "Payload bytes downloaded")
+downloads_finished = metrics.counter(
+    'tveebot_downloads_finished_total', "Episodes finished downloading")
+
 
 class Downloader(StoppableThread):
     """
@@ -25,13 +37,21 @@ class Downloader(StoppableThread):
     implemented by the subclasses.
     """
 
-    QUEUE_TIMEOUT = 5.0  # seconds
+    # Maximum time the downloader waits for an alert from the torrent session
+    # before checking the queue again
+    ALERT_TIMEOUT = 0.5  # seconds
+
+    # Size of the blocks in the session's disk cache
+    CACHE_BLOCK_SIZE = 16 * 1024  # bytes
+
+    # Minimum time between updates of the download metrics
+    METRICS_PERIOD = 1.0  # seconds
 
     state_str = ['queued', 'checking', 'downloading metadata',
                  'downloading', 'finished', 'seeding', 'allocating']
 
     def __init__(self, database: EpisodeDB, config: Config,
-                 queue: Queue = Queue()):
+                 queue: DownloadQueue):
         super().__init__()
         self._database = database
         self._config = config
@@ -45,41 +65,67 @@ class Downloader(StoppableThread):
         self.session = lt.session()
         self.session.listen_on(6881, 6891)
 
-        self._handles = []  # holds episode, file, and handle
+        # The downloader reacts to the alerts posted by the session, instead
+        # of polling the status of each torrent
+        self.session.set_alert_mask(lt.alert.category_t.status_notification |
+                                    lt.alert.category_t.error_notification)
+
+        # Maps the info-hash of each active torrent to its episode, file,
+        # and handle
+        self._handles = {}
+
+        # Session settings last applied, from the configuration
+        self._settings = {}
+
+        # Payload bytes downloaded and payload download rate of each active
+        # torrent, as of the last status update posted by the session
+        self._downloaded = {}
+        self._rates = {}
+        self._metrics_updated = 0.
 
     @property
     def download_dir(self):
         """ Download queue, including the episodes to be downloaded """
         return self._config.download_dir
 
+    @property
+    def max_active_downloads(self):
+        """ Maximum number of episodes downloading at the same time """
+        return self._config.max_active_downloads
+
+    @property
+    def cache_size(self):
+        """ Size of the session's disk cache, in MiB """
+        return self._config.download_cache_size
+
     @property
     def queue(self):
         """ Download queue, including the episodes to be downloaded """
         return self._queue
 
     def run(self):
-        # TODO restart downloads for episodes ser as DOWNLOADING
+        # Restart the downloads that did not finish before the last stop
+        self.queue.recover()
 
         while not self.stopped():
-            logger.debug("looking for finished downloads")
-            finished = []
-            for episode, file, handle in self._handles:
-                if handle.status().is_seeding:
-                    finished.append((episode, file, handle))
-                    logger.debug(f"found finished download: {episode}")
-
-            # Remove handles corresponding to finished downloads
-            for episode, file, handle in finished:
-                logger.info(f"finished downloading {episode}")
-                self._download_finished(episode, file)
-                self.session.remove_torrent(handle)
-                self._handles.remove((episode, file, handle))
-
-            try:
-                episode, file = self.queue.get(timeout=self.QUEUE_TIMEOUT)
-                self.download(episode, file)
-            except Empty:
-                pass  # go check if the stop() method was called
+            self._apply_settings()
+
+            # Episodes are only taken from the queue as downloads finish, so
+            # that new episodes do not share the bandwidth with the whole
+            # backlog. The queue gives the episodes by priority of their TV
+            # show and then oldest first
+            free_slots = self.max_active_downloads - len(self._handles)
+            if free_slots > 0:
+                for episode, file in self.queue.get_many(limit=free_slots):
+                    self.download(episode, file)
+
+            # Wakes up as soon as the session posts an alert
+            timeout = int(self.ALERT_TIMEOUT * 1000)
+            if self.session.wait_for_alert(timeout) is not None:
+                for alert in self.session.pop_alerts():
+                    self._handle_alert(alert)
+
+            self._update_metrics()
 
     def download(self, episode: Episode, file: EpisodeFile):
         """
@@ -97,7 +143,7 @@ class Downloader(StoppableThread):
             'storage_mode': lt.storage_mode_t.storage_mode_sparse
         }
         handle = lt.add_magnet_uri(self.session, file.link, params)
-        self._handles.append((episode, file, handle))
+        self._handles[str(handle.info_hash())] = episode, file, handle
 
         logger.info(f"started downloading {episode}")
 
@@ -106,16 +152,107 @@ class Downloader(StoppableThread):
             connection.set_episode_state(episode, State.DOWNLOADING)
         logger.debug("set episode's state as 'downloading'")
 
+    def _apply_settings(self):
+        """
+        Applies the configured limits to the session, if they changed. Those
+        bound the number of active torrents and the memory used to cache
+        pieces.
+        """
+        settings = {
+            'active_downloads': self.max_active_downloads,
+            'cache_size': self.cache_size * 1024 * 1024 //
+                          self.CACHE_BLOCK_SIZE,
+        }
+
+        if settings != self._settings:
+            self.session.apply_settings(settings)
+            self._settings = settings
+
+    def _update_metrics(self):
+        """
+        Asks the session for the status of the active torrents, at most once
+        every METRICS_PERIOD seconds. The session posts the status of the
+        torrents that changed since the last request in a single alert,
+        which updates the download metrics.
+        """
+        now = time.monotonic()
+        if now - self._metrics_updated < self.METRICS_PERIOD:
+            return
+        self._metrics_updated = now
+
+        self.session.post_torrent_updates()
+        active_torrents.set(len(self._handles))
+
+    def _update_status(self, statuses: list):
+        """
+        Updates the download metrics with the *statuses* posted by the
+        session. Torrents missing from *statuses* did not change since the
+        last update.
+        """
+        for status in statuses:
+            info_hash = str(status.info_hash)
+            if info_hash not in self._handles:
+                continue  # torrent was already removed
+
+            self._rates[info_hash] = status.download_payload_rate
+            self._count_downloaded(info_hash, status)
+
+        download_rate.set(sum(self._rates.values()))
+
+    def _count_downloaded(self, info_hash: str, status):
+        """ Counts the bytes a torrent downloaded since it was last counted """
+        downloaded = status.total_payload_download
+        previous = self._downloaded.get(info_hash, 0)
+        if downloaded > previous:
+            downloaded_bytes.inc(downloaded - previous)
+        self._downloaded[info_hash] = downloaded
+
     def state_info(self):
         # TODO improve the information provided by this method
         state_info = []
 
-        for episode, file, handle in self._handles:
+        for episode, file, handle in self._handles.values():
             status = handle.status()
             state_info.append((episode, status))
 
         return state_info
 
+    def _handle_alert(self, alert):
+        """ Handles an *alert* posted by the torrent session """
+        if isinstance(alert, lt.state_update_alert):
+            self._update_status(alert.status)
+            return
+
+        if not isinstance(alert, lt.torrent_alert):
+            logger.debug(alert.message())
+            return
+
+        info_hash = str(alert.handle.info_hash())
+        if info_hash not in self._handles:
+            return  # torrent was already removed
+
+        episode, file, handle = self._handles[info_hash]
+
+        if isinstance(alert, lt.torrent_finished_alert):
+            logger.info(f"finished downloading {episode}")
+            self._download_finished(episode, file)
+            self._count_downloaded(info_hash, handle.status())
+            self.session.remove_torrent(handle)
+            del self._handles[info_hash]
+            self._downloaded.pop(info_hash, None)
+            self._rates.pop(info_hash, None)
+
+        elif isinstance(alert, lt.metadata_received_alert):
+            logger.debug(f"received metadata for {episode}")
+
+        elif isinstance(alert, lt.torrent_error_alert):
+            logger.error(f"failed downloading {episode}: {alert.message()}")
+            self.session.remove_torrent(handle)
+            del self._handles[info_hash]
+            self._downloaded.pop(info_hash, None)
+            self._rates.pop(info_hash, None)
+            self._download_failed(episode)
+
     def _download_finished(self, episode: Episode, file: EpisodeFile):
         """
         Changes the *episode*'s state to 'downloaded' and updates its
@@ -125,7 +262,26 @@ class Downloader(StoppableThread):
         :param episode: episode that finished downloading
         :param file:    actual file that has been downloaded
         """
+        # The file's quality was already stored by the tracker
+        # The episode leaves the download queue only once it is stored as
+        # downloaded
         with connect(self._database) as connection:
             connection.set_episode_state(episode, State.DOWNLOADED)
-            connection.set_episode_quality(episode, file.quality)
-            connection.set_episode_download_timestamp(episode, datetime.now())
+            connection.set_download_timestamp(episode, datetime.now())
+            connection.ack_download(episode)
+            queue_depth.set(connection.download_queue_size())
+
+        downloads_finished.inc()
+
+    def _download_failed(self, episode: Episode):
+        """
+        Puts an *episode* whose download failed back in the queue, at the
+        end, to be downloaded again once its turn comes.
+
+        :param episode: episode that failed downloading
+        """
+        with connect(self._database) as connection:
+            connection.set_episode_state(episode, State.QUEUED)
+            connection.release_download(episode)
+
+        self.queue.notify()
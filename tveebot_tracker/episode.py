@@ -5,7 +5,38 @@ from enum import Enum
 from tveebot_tracker.exceptions import ParseError
 
 TVShow = namedtuple("TVShow", "id name")
-EpisodeFile = namedtuple("EpisodeFile", "title link quality")
+
+
+class EpisodeFile(namedtuple("EpisodeFile", "title link quality info",
+                             defaults=(None,))):
+    """
+    Data class representing an episode file, as listed in a feed. Files are
+    immutable.
+
+    Sources parsing the full title of the file keep the TitleInfo obtained
+    in *info*, so that the title is not parsed again by the tracker. It is
+    None if the source did not parse the title, or if the title could not
+    be parsed. The info is not part of the identity of a file: two files
+    with the same title, link, and quality are equal.
+    """
+
+    # Files are tuples, without a __dict__ for each instance
+    __slots__ = ()
+
+    def __eq__(self, other):
+        if not isinstance(other, EpisodeFile):
+            return NotImplemented
+
+        return self[:3] == other[:3]
+
+    def __ne__(self, other):
+        if not isinstance(other, EpisodeFile):
+            return NotImplemented
+
+        return self[:3] != other[:3]
+
+    def __hash__(self):
+        return hash(self[:3])
 
 
 class Quality(Enum):
@@ -58,20 +89,36 @@ _state_from_tag = {
 }
 
 
-class Episode:
-    """ Data class representing an Episode """
+class Episode(namedtuple("Episode", "tvshow title season number")):
+    """
+    Data class representing an Episode. Episodes are immutable.
+
+    An episode is identified by its key (tvshow_id, season, number): two
+    episodes with the same key are equal, even if their titles differ, and
+    episodes can be stored in sets and used as dict keys.
+    """
+
+    # Episodes are tuples, without a __dict__ for each instance
+    __slots__ = ()
 
-    def __init__(self, tvshow: TVShow, title: str, season: int, number: int):
-        self.tvshow = tvshow
-        self.title = title
-        self.season = season
-        self.number = number
+    @property
+    def key(self) -> (str, int, int):
+        return self.tvshow.id, self.season, self.number
 
     def __eq__(self, other):
-        return self.tvshow == other.tvshow and \
-               self.title == other.title and \
-               self.season == other.season and \
-               self.number == other.number
+        if not isinstance(other, Episode):
+            return NotImplemented
+
+        return self.key == other.key
+
+    def __ne__(self, other):
+        if not isinstance(other, Episode):
+            return NotImplemented
+
+        return self.key != other.key
+
+    def __hash__(self):
+        return hash(self.key)
 
     def __str__(self):
         return f"Episode({self.tvshow}, {self.title}, {self.season}, " \
@@ -80,9 +127,6 @@ class Episode:
     def __repr__(self):
         return str(self)
 
-    _episode_pattern = re.compile('\d+x\d+\Z')
-    _tags = {'PROPER', 'REPACK', 'TBA'}
-
     @staticmethod
     def from_title(title: str, tvshow_id: str):
         """
@@ -93,29 +137,192 @@ class Episode:
         :param title: full episode title to parse
         :param tvshow_id: ID of the tv show the episode belongs to
         :return: episode parsed from the given title
+        :raise ParseError: if the title does not include a season and number
+        """
+        return Episode.from_info(parse_title(title), tvshow_id)
+
+    @staticmethod
+    def from_info(info, tvshow_id: str):
+        """
+        Obtains the episode of the TitleInfo *info*, parsed from the title
+        of an episode of the TV show with ID *tvshow_id*.
         """
-        words = title.split(" ")
-        for index, word in enumerate(words):
-            match = Episode._episode_pattern.match(word)
-            if match:
-                # Parse season and number from this word
-                season, number = map(int, match.group().split('x'))
+        return Episode(TVShow(tvshow_id, info.tvshow_name), info.title,
+                       info.season, info.number)
 
-                # The previous words compose the TV Show name
-                tvshow_name = " ".join(words[:index])
+    @staticmethod
+    def from_titles(titles, tvshow_id: str) -> list:
+        """
+        Parses multiple *titles* of episodes from the same TV show. See
+        from_title().
+
+        :return: list with the episode parsed from each title, in order
+        :raise ParseError: if one of the titles can not be parsed
+        """
+        return Episode.from_infos(parse_titles(titles), tvshow_id)
+
+    @staticmethod
+    def from_infos(infos, tvshow_id: str) -> list:
+        """
+        Obtains the episodes of the TitleInfos *infos*, parsed from titles
+        of episodes from the same TV show.
+
+        :return: list with the episode of each TitleInfo, in order
+        """
+        tvshows = {}
+        episodes = []
+        for info in infos:
+            # Episodes with the same TV show name share the same TVShow
+            tvshow = tvshows.get(info.tvshow_name)
+            if tvshow is None:
+                tvshow = tvshows[info.tvshow_name] = \
+                    TVShow(tvshow_id, info.tvshow_name)
 
-                # The remainder corresponds to the episode's title
-                # except some flags
-                remainder = words[index + 1:]
+            episodes.append(Episode(tvshow, info.title, info.season,
+                                    info.number))
 
-                # Remove flags
-                while remainder and remainder[-1] in Episode._tags:
-                    remainder = remainder[:-1]
+        return episodes
 
-                # join the remainder without the flags to complete the title
-                episode_title = " ".join(remainder)
 
-                return Episode(TVShow(tvshow_id, tvshow_name),
-                               episode_title, season, number)
+# Information parsed from the title of an episode file
+TitleInfo = namedtuple("TitleInfo",
+                       "tvshow_name season number title quality flags")
 
+# Tags that may follow the title of an episode
+QUALITY_TAGS = {
+    '720p': Quality.HD,
+    '1080p': Quality.FHD,
+}
+FLAGS = frozenset({'PROPER', 'REPACK', 'TBA'})
+_NO_FLAGS = frozenset()
+
+# The tags of titles with a quality tag only, as matched by _title_pattern
+_SINGLE_QUALITY_TAGS = {f" {tag}": quality
+                        for tag, quality in QUALITY_TAGS.items()}
+
+# Titles have the form "<TV show name> <season>x<number> <title> <tags>",
+# where the TV show name, the title, and the tags are optional. The season
+# and number are taken from the first word of the form <int>x<int>. Tags
+# are only taken from the end of the title
+# The pattern goes through the title word by word: the TV show name keeps
+# its trailing space and the title its leading space
+_title_pattern = re.compile(r"""
+    (?P<tvshow_name>(?:[^\ ]*\ )*?)
+    (?P<season>\d+)x(?P<number>\d+)
+    (?P<title>(?:\ [^\ ]*)*?)
+    (?P<tags>(?:\ (?:%s))*)
+    \Z
+""" % "|".join(list(QUALITY_TAGS) + sorted(FLAGS)), re.VERBOSE)
+
+
+def parse_title(title: str) -> TitleInfo:
+    """
+    Parses the full *title* of an episode file in a single pass, obtaining
+    the TV show name, the season and number of the episode, its title, and
+    the quality and flags given by the tags at the end of the title. Files
+    without a quality tag have SD quality.
+
+    :raise ParseError: if the title does not include a season and number
+    """
+    match = _title_pattern.match(title)
+    if match is None:
         raise ParseError(f"failed to parse title '{title}'")
+
+    return _title_info(match)
+
+
+def parse_titles(titles) -> list:
+    """
+    Parses multiple *titles*. See parse_title().
+
+    :return: list with the information parsed from each title, in order
+    :raise ParseError: if one of the titles can not be parsed
+    """
+    match = _title_pattern.match
+    infos = []
+    for title in titles:
+        title_match = match(title)
+        if title_match is None:
+            raise ParseError(f"failed to parse title '{title}'")
+
+        infos.append(_title_info(title_match))
+
+    return infos
+
+
+def title_info(file: EpisodeFile) -> TitleInfo:
+    """
+    Returns the TitleInfo of *file*, parsing its title only if the source of
+    the file did not already. See parse_title().
+
+    :raise ParseError: if the title does not include a season and number
+    """
+    if file.info is not None:
+        return file.info
+
+    return parse_title(file.title)
+
+
+def parse_file_title(title: str) -> (str, Quality, TitleInfo):
+    """
+    Parses the full *title* of an episode file, as listed in a feed, in a
+    single pass: splits the quality tag from it and obtains the information
+    of the episode. Files without a quality tag have SD quality.
+
+    :return: tuple with the title without the quality tag, the quality, and
+             the TitleInfo of the title (None if the title does not include
+             a season and number)
+    """
+    match = _title_pattern.match(title)
+    if match is None:
+        # Not an episode title, the quality tag may be any word
+        title, quality = _remove_quality_tag(title, 0, title.split(" "))
+        return title, quality, None
+
+    info = _title_info(match)
+
+    tags = match.group('tags')
+    if not tags:
+        return title, info.quality, info
+
+    tags_start = match.start('tags')
+    if tags in _SINGLE_QUALITY_TAGS:
+        return title[:tags_start], info.quality, info
+
+    title, _ = _remove_quality_tag(title, tags_start, tags.split())
+    return title, info.quality, info
+
+
+def _remove_quality_tag(title: str, tags_start: int, tags: list) -> \
+        (str, Quality):
+    """
+    Removes the first quality tag among the *tags* of *title*, which start
+    at index *tags_start*
+    """
+    for index, tag in enumerate(tags):
+        if tag in QUALITY_TAGS:
+            other_tags = tags[:index] + tags[index + 1:]
+            title = " ".join([title[:tags_start].rstrip()] + other_tags)
+            return title.lstrip(), QUALITY_TAGS[tag]
+
+    return title, Quality.SD
+
+
+def _title_info(match) -> TitleInfo:
+    tvshow_name, season, number, title, tags = match.groups()
+
+    quality = Quality.SD
+    flags = _NO_FLAGS
+    if tags in _SINGLE_QUALITY_TAGS:
+        # The quality tag is the only tag, as in most titles
+        quality = _SINGLE_QUALITY_TAGS[tags]
+    elif tags:
+        tags = tags.split()
+        flags = FLAGS.intersection(tags)
+        for tag in tags:
+            if tag in QUALITY_TAGS:
+                quality = QUALITY_TAGS[tag]
+                break
+
+    return TitleInfo(tvshow_name[:-1], int(season), int(number), title[1:],
+                     quality, flags)
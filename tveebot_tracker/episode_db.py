@@ -1,13 +1,21 @@
+import inspect
 import sqlite3
+from contextlib import contextmanager
 from datetime import datetime
 from functools import wraps
 from pathlib import Path
+from threading import Lock
 
 from pkg_resources import resource_filename
 
+from tveebot_tracker import metrics
 from tveebot_tracker.config import Config
 from tveebot_tracker.episode import TVShow, Quality, Episode, State, EpisodeFile
 
+db_seconds = metrics.histogram(
+    'tveebot_db_seconds', "Time spent in each Episode DB connection method",
+    ['method'])
+
 
 # region Errors/Exceptions
 
@@ -48,33 +56,219 @@ def EntryErrors(func):
     return convert_errors
 
 
+def TimedMethods(*untimed):
+    """
+    Class decorator observing the time each call to a public method of the
+    class takes in the db_seconds histogram, labeled with the name of the
+    method. The methods named in *untimed* are left as they are.
+    """
+
+    def decorator(cls):
+        for name, value in list(vars(cls).items()):
+            if name.startswith('_') or name in untimed or \
+                    not inspect.isfunction(value):
+                continue
+
+            setattr(cls, name, metrics.timed(db_seconds, method=name)(value))
+
+        return cls
+
+    return decorator
+
+
 # endregion
 
 
+class EpisodeIndex:
+    """
+    In-memory index of the episodes stored in the DB. It allows checking
+    whether the DB contains an episode without querying the DB.
+
+    Episodes are identified by the key (tvshow_id, season, number). The
+    index maps each TV show ID to the set of (season, number) pairs of its
+    episodes.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._episodes = {}
+
+    def __contains__(self, key):
+        tvshow_id, season, number = key
+        return (season, number) in self._episodes.get(tvshow_id, ())
+
+    def __len__(self):
+        return sum(len(episodes) for episodes in self._episodes.values())
+
+    def add(self, keys):
+        """ Adds the episodes identified by each key in *keys* """
+        with self._lock:
+            for tvshow_id, season, number in keys:
+                self._episodes.setdefault(tvshow_id, set()).add(
+                    (season, number))
+
+    def discard_tvshow(self, tvshow_id: str):
+        """ Removes all episodes of the TV show with ID *tvshow_id* """
+        with self._lock:
+            self._episodes.pop(tvshow_id, None)
+
+
 class EpisodeDB:
-    """ Abstraction for the Episode DB """
+    """
+    Abstraction for the Episode DB.
+
+    The DB owns a small pool of SQLite connections, which are configured
+    once and then lent to each Connection obtained with connect(). Those
+    may be obtained from multiple threads at the same time.
+    """
 
     TABLES_SCRIPT = Path(resource_filename(__name__, 'tables.sql'))
+    INDEXES_SCRIPT = Path(resource_filename(__name__, 'indexes.sql'))
+    VALIDATORS_SCRIPT = Path(resource_filename(__name__, 'validators.sql'))
+
+    # Maximum number of idle SQLite connections kept open by the pool
+    MAX_IDLE_CONNECTIONS = 4
+
+    # SQLite pragmas set on every connection, for each of the profiles that
+    # can be selected in the configuration
+    # The 'performance' profile uses a write-ahead log, which lets readers
+    # and a writer access the DB concurrently. With WAL, synchronous=NORMAL
+    # is still safe against application crashes, but the last transactions
+    # may be lost on a power failure
+    PROFILES = {
+        'default': {},
+        'performance': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 10000,  # milliseconds
+            'mmap_size': 256 * 1024 * 1024,  # bytes
+            'cache_size': -16 * 1024,  # negative values are in KiB
+        },
+    }
 
     def __init__(self, config: Config):
         """
         Initializes the database. It creates the database file if it does
-        not exist and creates the necessary tables. If the file already exists
-        and the tables are created then nothing changes in the DB.
+        not exist and migrates it to the latest schema version, creating the
+        necessary tables and indexes. If the DB is already in the latest
+        version then nothing changes in the DB.
 
-        :param config: the config instance used to obtain the DB file
+        :param config: the config instance used to obtain the DB file and
+                       the DB profile
+        :raise ValueError: if the configured DB profile does not exist
         """
+        if config.db_profile not in self.PROFILES:
+            raise ValueError(f"unknown DB profile '{config.db_profile}'")
+
         self._config = config
+        self._index = EpisodeIndex()
+
+        self._pool_lock = Lock()
+        self._idle_connections = []
+        self._closed = False
 
-        # Create the DB file and the tables if necessary
+        # Create the DB file and migrate it if necessary
         with connect(self) as conn:
+            conn.migrate(self.migrations())
+
+            # Load the index with all the episodes in the DB
+            self._index.add(conn.episode_keys())
+
+    def migrations(self) -> list:
+        """
+        Returns the migrations of the DB schema, in order. Each migration is
+        a function taking a Connection. Migration N takes the DB from schema
+        version N - 1 to version N. Once released, a migration must not
+        change: changes to the schema always go in a new migration.
+        """
+        def create_tables(conn: Connection):
             conn.execute_script(self.TABLES_SCRIPT)
 
+            # DBs created before schemas had versions have the tables
+            # already, but those may lack the TV show priority
+            if 'priority' not in conn.table_columns('tvshow'):
+                conn.add_column('tvshow',
+                                'priority INTEGER NOT NULL DEFAULT 0')
+
+        def create_indexes(conn: Connection):
+            conn.execute_script(self.INDEXES_SCRIPT)
+
+        def create_validators_table(conn: Connection):
+            conn.execute_script(self.VALIDATORS_SCRIPT)
+
+        return [create_tables, create_indexes, create_validators_table]
+
+    @property
+    def index(self) -> EpisodeIndex:
+        """
+        Index of the episodes in the DB. It is kept up to date by the
+        connections every time they commit, which assumes that this instance
+        is the only one writing to the DB.
+        """
+        return self._index
+
     @property
     def db_file(self):
         return self._config.db_file
 
+    @property
+    def profile(self) -> dict:
+        """ SQLite pragmas of the configured DB profile """
+        return self.PROFILES[self._config.db_profile]
+
+    def close(self):
+        """
+        Closes all idle connections in the pool. Connections still in use
+        are closed once they are returned, and so are any connections opened
+        afterwards: the pool no longer keeps idle connections.
+        """
+        with self._pool_lock:
+            self._closed = True
+            idle, self._idle_connections = self._idle_connections, []
+
+        for sqlite_conn in idle:
+            sqlite_conn.close()
+
+    def _acquire(self) -> sqlite3.Connection:
+        """ Lends an idle SQLite connection, opening a new one if needed """
+        with self._pool_lock:
+            if self._idle_connections:
+                return self._idle_connections.pop()
 
+        # Connections may be returned to the pool and then lent to a
+        # different thread, but never to two threads at the same time
+        sqlite_conn = sqlite3.connect(self.db_file, check_same_thread=False)
+
+        with sqlite_conn:
+            # Enable foreign keys
+            sqlite_conn.execute('PRAGMA foreign_keys=ON')
+
+            for pragma, value in self.profile.items():
+                sqlite_conn.execute(f'PRAGMA {pragma}={value}')
+
+            # Use a row factory to return the query results
+            # This allows columns to be accessed by name
+            sqlite_conn.row_factory = sqlite3.Row
+
+        return sqlite_conn
+
+    def _release(self, sqlite_conn: sqlite3.Connection):
+        """ Returns a connection lent by _acquire() back to the pool """
+        # Never return a connection with a pending transaction
+        if sqlite_conn.in_transaction:
+            sqlite_conn.rollback()
+
+        with self._pool_lock:
+            if not self._closed and \
+                    len(self._idle_connections) < self.MAX_IDLE_CONNECTIONS:
+                self._idle_connections.append(sqlite_conn)
+                return
+
+        sqlite_conn.close()
+
+
+# Methods that do not query the DB are not timed
+@TimedMethods('transaction', 'close', 'episode_exists')
 class Connection:
     """ Abstraction for a connection for the Episode DB """
 
@@ -83,56 +277,93 @@ class Connection:
 
     def __init__(self, database: EpisodeDB):
         """
-        Initializes a new connection. This initializer should not be called
-        from outside of this module.
+        Initializes a new connection, borrowing an SQLite connection from the
+        *database*'s pool. This initializer should not be called from outside
+        of this module.
 
         :param database: the database to which the connection is referred
         """
-        self._conn = sqlite3.connect(database.db_file)
-
-        with self._conn:
-            # Enable foreign keys
-            self._conn.execute('PRAGMA foreign_keys=ON')
+        self._database = database
+        self._conn = database._acquire()
+        self._index = database.index
 
-            # Use a row factory to return the query results
-            # This allows columns to be accessed by name
-            self._conn.row_factory = sqlite3.Row
+        # Changes to the index made by the current transaction
+        # They are only applied to the index if the transaction is committed
+        self._inserted = set()
+        self._deleted_tvshows = set()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        # Changes are only kept if the block using the connection succeeds
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
         self.close()
 
     def commit(self):
         """ Commits the current transaction """
         self._conn.commit()
 
+        for tvshow_id in self._deleted_tvshows:
+            self._index.discard_tvshow(tvshow_id)
+        self._index.add(self._inserted)
+        self._clear_pending()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Context manager grouping all the changes made inside it in a single
+        transaction. The transaction is committed when the context exits, or
+        rolled back if the context exits with an exception.
+        """
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+
+        self.commit()
+
     def rollback(self):
         """ Rolls back the current transaction """
         self._conn.rollback()
+        self._clear_pending()
 
     def close(self):
         """
-        Closes the connection.
+        Closes the connection. Uncommitted changes are discarded and the
+        underlying SQLite connection returns to the DB's pool.
         After calling this method the connection is no longer valid.
         """
-        self._conn.close()
+        self._database._release(self._conn)
+        self._conn = None
+        self._clear_pending()
+
+    def _clear_pending(self):
+        self._inserted.clear()
+        self._deleted_tvshows.clear()
 
     # region TV Show Table Methods
 
     @EntryErrors
-    def insert_tvshow(self, tvshow: TVShow, quality: Quality):
+    def insert_tvshow(self, tvshow: TVShow, quality: Quality,
+                      priority: int = 0):
         """
         Inserts a new TV Show in the DB. It associates the TV Show with a
-        video quality.
+        video quality and a download priority. Episodes of TV shows with
+        higher priority are downloaded first.
 
         :raise EntryExistsError: if DB already contains a TV show with the
                                  same ID as *tvshow*
         """
         self._conn.cursor().execute(
-            'INSERT INTO tvshow VALUES (?, ?, ?)',
-            (tvshow.id, tvshow.name, quality.tag))
+            'INSERT INTO tvshow (id, name, quality, priority) '
+            'VALUES (?, ?, ?, ?)',
+            (tvshow.id, tvshow.name, quality.tag, priority))
 
     def delete_tvshow(self, tvshow_id: str):
         """
@@ -149,6 +380,9 @@ class Connection:
             raise EntryNotFoundError(f"DB does not contain TV Show with the "
                                      f"ID {tvshow_id}")
 
+        self._deleted_tvshows.add(tvshow_id)
+        self._inserted = {key for key in self._inserted if key[0] != tvshow_id}
+
     def tvshows(self):
         """ Yields each TV Show in the DB (including the video quality) """
         cursor = self._conn.cursor()
@@ -172,6 +406,86 @@ class Connection:
             raise EntryNotFoundError(f"DB does not contain TV Show with the "
                                      f"ID {tvshow_id}")
 
+    def set_tvshow_priority(self, tvshow_id: str, priority: int):
+        """
+        Sets the download priority for the specified TV Show.
+
+        :raise EntryNotFoundError: if the DB does not contain a TV Show with
+                                   the specified ID
+        """
+        cursor = self._conn.cursor()
+        cursor.execute('UPDATE tvshow SET priority = ? WHERE id = ?',
+                       (priority, tvshow_id))
+
+        if cursor.rowcount == 0:
+            raise EntryNotFoundError(f"DB does not contain TV Show with the "
+                                     f"ID {tvshow_id}")
+
+    def watermarks(self) -> dict:
+        """
+        Retrieves the watermark of each TV Show: the link of the newest
+        episode file already seen by the tracker.
+
+        :return: dict mapping the ID of each TV Show to its watermark. TV
+                 Shows without a watermark are not included.
+        """
+        cursor = self._conn.cursor()
+        cursor.execute('SELECT tvshow_id, link FROM watermark')
+
+        return {row['tvshow_id']: row['link'] for row in _iter_rows(cursor)}
+
+    @EntryErrors
+    def set_watermark(self, tvshow_id: str, link: str):
+        """
+        Sets the watermark of the specified TV Show to *link*.
+
+        :raise EntryNotFoundError: if the DB does not contain a TV Show with
+                                   the specified ID
+        """
+        self.set_watermarks([(tvshow_id, link)])
+
+    @EntryErrors
+    def set_watermarks(self, watermarks):
+        """
+        Sets multiple watermarks at once.
+
+        :param watermarks: iterable of (tvshow_id, link) pairs
+        :raise EntryNotFoundError: if the DB does not contain one of the TV
+                                   Shows
+        """
+        self._conn.cursor().executemany(
+            'INSERT OR REPLACE INTO watermark VALUES (?, ?)', watermarks)
+
+    def validators(self) -> dict:
+        """
+        Retrieves the HTTP cache validators of the feed of each TV Show, as
+        returned by the last fetch of that feed whose files were stored.
+
+        :return: dict mapping the ID of each TV Show to its (etag,
+                 last_modified) pair. TV Shows without validators are not
+                 included.
+        """
+        cursor = self._conn.cursor()
+        cursor.execute('SELECT tvshow_id, etag, last_modified FROM validator')
+
+        return {row['tvshow_id']: (row['etag'], row['last_modified'])
+                for row in _iter_rows(cursor)}
+
+    @EntryErrors
+    def set_validators(self, validators):
+        """
+        Sets the validators of multiple TV Shows at once.
+
+        :param validators: iterable of (tvshow_id, (etag, last_modified))
+                           pairs
+        :raise EntryNotFoundError: if the DB does not contain one of the TV
+                                   Shows
+        """
+        self._conn.cursor().executemany(
+            'INSERT OR REPLACE INTO validator VALUES (?, ?, ?)',
+            ((tvshow_id, etag, last_modified)
+             for tvshow_id, (etag, last_modified) in validators))
+
     # endregion
 
     # region Episode Table Methods
@@ -186,10 +500,27 @@ class Connection:
         :raise EntryNotFoundError: if the DB does not contain the TV Show
                                    this episode belongs to
         """
-        self._conn.cursor().execute(
-            'INSERT INTO episode VALUES (?, ?, ?, ?, ?)',
-            (episode.tvshow.id, episode.season, episode.number,
-             episode.title, None))
+        self.insert_episodes([episode])
+
+    @EntryErrors
+    def insert_episodes(self, episodes):
+        """
+        Inserts multiple episodes at once. Either all episodes are inserted
+        or none is.
+
+        :param episodes: iterable of the episodes to insert
+        :raise EntryExistsError: if DB already contains one of the *episodes*
+        :raise EntryNotFoundError: if the DB does not contain the TV Show
+                                   one of the episodes belongs to
+        """
+        rows = [(episode.tvshow.id, episode.season, episode.number,
+                 episode.title, None) for episode in episodes]
+
+        with self._savepoint():
+            self._conn.cursor().executemany(
+                'INSERT INTO episode VALUES (?, ?, ?, ?, ?)', rows)
+
+        self._inserted.update(row[:3] for row in rows)
 
     def episodes(self, include_state: bool = False):
         """
@@ -197,32 +528,43 @@ class Connection:
         it yields, for each episode, a tuple including the episode and the
         respective state.
         """
-        cursor = self._conn.cursor()
+        cursor = self._tuple_cursor()
         cursor.execute(
-            'SELECT id, name, season, number, title, state '
+            'SELECT id, name, title, season, number, state '
             'FROM episode JOIN tvshow ON tvshow_id == tvshow.id')
 
-        for row in _iter_rows(cursor):
-            if include_state:
-                yield _episode_from_row(row), row['state']
-            else:
-                yield _episode_from_row(row)
+        if include_state:
+            yield from _iter_episodes(cursor)
+        else:
+            for episode, _ in _iter_episodes(cursor):
+                yield episode
+
+    def episodes_in_state(self, state: State):
+        """ Yields each episode in the DB with the specified *state* """
+        cursor = self._tuple_cursor()
+        cursor.execute(
+            'SELECT id, name, title, season, number, NULL '
+            'FROM episode JOIN tvshow ON tvshow_id == tvshow.id '
+            'WHERE state = ?', (state.tag,))
+
+        for episode, _ in _iter_episodes(cursor):
+            yield episode
 
     def episodes_from(self, tvshow_id: str):
         """
-        Retrieves from the DB all episodes from TV show with ID matching
+        Yields from the DB each episode from TV show with ID matching
         *tvshow_id*.
 
         :param tvshow_id: ID of TV Show to get episodes from
-        :return: list containing all episodes
         """
-        cursor = self._conn.cursor()
+        cursor = self._tuple_cursor()
         cursor.execute(
-            'SELECT id, name, season, number, title '
+            'SELECT id, name, title, season, number, NULL '
             'FROM episode JOIN tvshow ON tvshow_id == tvshow.id '
             'WHERE id = ?', (tvshow_id,))
 
-        return [_episode_from_row(row) for row in _iter_rows(cursor)]
+        for episode, _ in _iter_episodes(cursor):
+            yield episode
 
     def set_episode_state(self, episode: Episode, state: State):
         """
@@ -230,30 +572,52 @@ class Connection:
 
         :raise EntryNotFoundError: if the DB does not contain *episode*
         """
-        cursor = self._conn.cursor()
-        cursor.execute(
-            'UPDATE episode SET state = ? '
-            'WHERE tvshow_id = ? AND season = ? AND number = ?',
-            (state.tag,
-             episode.tvshow.id, episode.season, episode.number))
+        self.set_episode_states([(episode, state)])
 
-        if cursor.rowcount == 0:
-            raise EntryNotFoundError(f"DB does not contain {episode}")
+    def set_episode_states(self, states):
+        """
+        Sets the states of multiple episodes at once. Either all states are
+        set or none is.
+
+        :param states: iterable of (episode, state) pairs
+        :raise EntryNotFoundError: if the DB does not contain one of the
+                                   episodes
+        """
+        rows = [(state.tag, episode.tvshow.id, episode.season, episode.number)
+                for episode, state in states]
+
+        with self._savepoint():
+            cursor = self._conn.cursor()
+            cursor.executemany(
+                'UPDATE episode SET state = ? '
+                'WHERE tvshow_id = ? AND season = ? AND number = ?', rows)
+
+            if cursor.rowcount < len(rows):
+                raise EntryNotFoundError(f"DB does not contain some of the "
+                                         f"episodes")
 
     def episode_exists(self, episode: Episode) -> bool:
         """
-        Checks whether the DB contains *episode* or not.
+        Checks whether the DB contains *episode* or not. This is checked
+        against the DB's index, without querying the DB, and includes the
+        episodes inserted by the current transaction.
 
         :param episode: episode to check
         :return: True if DB contains *episode* or False if otherwise
         """
-        cursor = self._conn.cursor()
-        cursor.execute(
-            'SELECT * FROM episode '
-            'WHERE tvshow_id = ? AND season = ? AND number = ?',
-            (episode.tvshow.id, episode.season, episode.number))
+        key = episode.key
+
+        if key in self._inserted:
+            return True
 
-        return cursor.rowcount > 0
+        return key in self._index and key[0] not in self._deleted_tvshows
+
+    def episode_keys(self):
+        """ Yields the key (tvshow_id, season, number) of each episode """
+        cursor = self._tuple_cursor()
+        cursor.execute('SELECT tvshow_id, season, number FROM episode')
+
+        yield from _iter_rows(cursor)
 
     # endregion
 
@@ -270,10 +634,27 @@ class Connection:
         :raise EntryExistsError: if *episode* is already associated with a file
         :raise EntryNotFoundError: if the DB does not contain *episode*
         """
-        self._conn.cursor().execute(
-            'INSERT INTO file VALUES (?, ?, ?, ?, ?, ?)',
-            (episode.tvshow.id, episode.season, episode.number,
-             file.link, file.quality.tag, None))
+        self.insert_files([(episode, file)])
+
+    @EntryErrors
+    def insert_files(self, files):
+        """
+        Inserts multiple files at once. Either all files are inserted or
+        none is.
+
+        :param files: iterable of (episode, file) pairs
+        :raise EntryExistsError: if one of the episodes is already associated
+                                 with a file
+        :raise EntryNotFoundError: if the DB does not contain one of the
+                                   episodes
+        """
+        rows = [(episode.tvshow.id, episode.season, episode.number,
+                 file.link, file.quality.tag, None)
+                for episode, file in files]
+
+        with self._savepoint():
+            self._conn.cursor().executemany(
+                'INSERT INTO file VALUES (?, ?, ?, ?, ?, ?)', rows)
 
     def set_download_timestamp(self, episode: Episode, timestamp: datetime):
         """
@@ -288,44 +669,286 @@ class Connection:
         cursor.execute(
             'UPDATE file SET download_timestamp = ? '
             'WHERE tvshow_id = ? AND season = ? AND number = ?',
-            (episode.tvshow.id, episode.season, episode.number,
-             timestamp.strftime(self.DATETIME_FORMAT)))
+            (timestamp.strftime(self.DATETIME_FORMAT),
+             episode.tvshow.id, episode.season, episode.number))
 
         if cursor.rowcount == 0:
             raise EntryNotFoundError(f"DB does not contain file for {episode}")
 
+    def downloads(self, since: datetime = None):
+        """
+        Yields the download history: an (episode, download timestamp) pair
+        for each episode downloaded, most recent first.
+
+        :param since: only episodes downloaded at or after this time are
+                      included (all by default)
+        """
+        since = '' if since is None else since.strftime(self.DATETIME_FORMAT)
+
+        cursor = self._tuple_cursor()
+        cursor.execute(
+            'SELECT id, name, title, season, number, download_timestamp '
+            'FROM file '
+            'JOIN episode USING (tvshow_id, season, number) '
+            'JOIN tvshow ON tvshow_id = tvshow.id '
+            'WHERE download_timestamp >= ? '
+            'ORDER BY download_timestamp DESC', (since,))
+
+        for episode, timestamp in _iter_episodes(cursor):
+            yield episode, datetime.strptime(timestamp, self.DATETIME_FORMAT)
+
+    # endregion
+
+    # region Download Queue Methods
+
+    @EntryErrors
+    def enqueue_downloads(self, episodes):
+        """
+        Appends *episodes* to the download queue. Episodes already in the
+        queue keep their current position.
+
+        :param episodes: iterable of the episodes to download
+        :raise EntryNotFoundError: if the DB does not contain one of the
+                                   episodes
+        """
+        self._conn.cursor().executemany(
+            'INSERT OR IGNORE INTO download_queue (tvshow_id, season, number) '
+            'VALUES (?, ?, ?)',
+            (episode.key for episode in episodes))
+
+    def lease_downloads(self, limit: int = None) -> list:
+        """
+        Leases the episodes at the front of the download queue, which are not
+        leased yet. Leased episodes stay in the queue, but are not leased
+        again until they are released, and leave the queue once acknowledged.
+
+        Episodes of TV shows with higher priority are at the front of the
+        queue. Episodes with the same priority are in the order they were
+        queued.
+
+        :param limit: maximum number of episodes to lease (no limit if None)
+        :return: list of (episode, file) pairs, in queue order
+        """
+        cursor = self._conn.cursor()
+        cursor.execute(
+            'SELECT position, tvshow.id, name, episode.season, '
+            '       episode.number, title, link, file.quality '
+            'FROM download_queue '
+            'JOIN episode USING (tvshow_id, season, number) '
+            'JOIN file USING (tvshow_id, season, number) '
+            'JOIN tvshow ON tvshow_id = tvshow.id '
+            'WHERE NOT leased ORDER BY priority DESC, position LIMIT ?',
+            (-1 if limit is None else limit,))
+        rows = cursor.fetchall()
+
+        with self._savepoint():
+            cursor.executemany(
+                'UPDATE download_queue SET leased = 1 WHERE position = ?',
+                ((row['position'],) for row in rows))
+
+        tvshows = {}
+        return [(_episode_from_row(row, tvshows), _file_from_row(row))
+                for row in rows]
+
+    def ack_download(self, episode: Episode):
+        """
+        Acknowledges that *episode* was downloaded, removing it from the
+        download queue.
+
+        :raise EntryNotFoundError: if *episode* is not in the download queue
+        """
+        cursor = self._conn.cursor()
+        cursor.execute(
+            'DELETE FROM download_queue '
+            'WHERE tvshow_id = ? AND season = ? AND number = ?',
+            episode.key)
+
+        if cursor.rowcount == 0:
+            raise EntryNotFoundError(f"download queue does not contain "
+                                     f"{episode}")
+
+    def release_download(self, episode: Episode):
+        """
+        Releases the lease of *episode*, which failed to download, moving it
+        to the end of the download queue: other episodes are leased before
+        it is retried.
+
+        :raise EntryNotFoundError: if *episode* is not in the download queue
+        """
+        with self._savepoint():
+            self.ack_download(episode)
+            self.enqueue_downloads([episode])
+
+    def release_downloads(self):
+        """ Releases all leases, making every queued episode leasable """
+        self._conn.cursor().execute('UPDATE download_queue SET leased = 0')
+
+    def recover_downloads(self):
+        """
+        Releases all leases and appends to the download queue every episode
+        that is still QUEUED or DOWNLOADING but missing from the queue.
+        """
+        self.release_downloads()
+
+        # The state is not a parameter: the query must match the condition
+        # of the episode_not_downloaded index for SQLite to use that index
+        self._conn.cursor().execute(
+            'INSERT OR IGNORE INTO download_queue (tvshow_id, season, number) '
+            'SELECT tvshow_id, season, number '
+            'FROM episode JOIN file USING (tvshow_id, season, number) '
+            f"WHERE state != '{State.DOWNLOADED.tag}' "
+            'ORDER BY tvshow_id, season, number')
+
+    def download_queue_size(self) -> int:
+        """ Returns the number of episodes in the download queue """
+        cursor = self._conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM download_queue')
+
+        return cursor.fetchone()[0]
+
     # endregion
 
+    @contextmanager
+    def _savepoint(self):
+        """
+        Makes the statements executed inside the context atomic, without
+        ending the current transaction
+        """
+        # Releasing a savepoint that started a transaction would commit it
+        if not self._conn.in_transaction:
+            self._conn.execute('BEGIN')
+
+        self._conn.execute('SAVEPOINT batch')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK TO batch')
+            raise
+        finally:
+            self._conn.execute('RELEASE batch')
+
+    def _tuple_cursor(self) -> sqlite3.Cursor:
+        """
+        Returns a cursor returning rows as plain tuples, which are faster to
+        build and to unpack than rows with named columns. It is meant for
+        queries returning many rows.
+        """
+        cursor = self._conn.cursor()
+        cursor.row_factory = None
+        cursor.arraysize = FETCH_SIZE
+
+        return cursor
+
+    def table_columns(self, table: str) -> list:
+        """ Returns the names of the columns of a *table* """
+        cursor = self._conn.cursor()
+        cursor.execute(f'PRAGMA table_info({table})')
+
+        return [row['name'] for row in cursor.fetchall()]
+
+    def add_column(self, table: str, column: str):
+        """ Adds a *column*, given by its definition, to a *table* """
+        self._conn.cursor().execute(f'ALTER TABLE {table} ADD COLUMN {column}')
+
+    def schema_version(self) -> int:
+        """ Returns the version of the DB schema (0 for a new DB) """
+        return self._conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self, migrations: list):
+        """
+        Migrates the DB schema to the latest version, applying the
+        *migrations* the DB is missing, in order. Each migration is applied
+        and committed in its own transaction, together with the new schema
+        version. See EpisodeDB.migrations().
+        """
+        version = self.schema_version()
+        for version, migration in enumerate(migrations[version:],
+                                            start=version + 1):
+            with self._savepoint():
+                migration(self)
+                self._conn.execute(f'PRAGMA user_version = {version}')
+
+            self.commit()
+
     def execute_script(self, script: Path):
-        """ Executes an SQL script """
+        """
+        Executes the statements of an SQL script, one at a time, within the
+        current transaction
+        """
         with open(script) as file:
-            self._conn.cursor().executescript(file.read())
+            statement = ""
+            for line in file:
+                statement += line
+                if sqlite3.complete_statement(statement):
+                    self._conn.execute(statement)
+                    statement = ""
 
 
 # region Helper Functions
 
 
+# Number of rows fetched at a time by _iter_rows()
+FETCH_SIZE = 256
+
+
 def _iter_rows(cursor):
-    """ Yields each row fetchable from a cursor """
-    row = cursor.fetchone()
-    while row:
-        yield row
-        row = cursor.fetchone()
+    """
+    Yields each row fetchable from a cursor. Rows are fetched in batches,
+    which keeps memory use constant for results of any size.
+    """
+    rows = cursor.fetchmany(FETCH_SIZE)
+    while rows:
+        yield from rows
+        rows = cursor.fetchmany(FETCH_SIZE)
+
+
+def _iter_episodes(cursor):
+    """
+    Yields an (episode, column) pair for each row fetchable from a cursor
+    returning tuples, selecting the columns: tvshow id, tvshow name, title,
+    season, number, and one more column of any value.
+
+    Episodes of the same TV show share a single TVShow object.
+    """
+    tvshows = {}
+    make_episode = Episode._make
+
+    for tvshow_id, name, title, season, number, column in _iter_rows(cursor):
+        tvshow = tvshows.get(tvshow_id)
+        if tvshow is None:
+            tvshow = tvshows[tvshow_id] = TVShow(tvshow_id, name)
+
+        yield make_episode((tvshow, title, season, number)), column
 
 
 def _tvshow_from_row(row) -> (TVShow, Quality):
     return TVShow(row['id'], row['name']), Quality.from_tag(row['quality'])
 
 
-def _episode_from_row(row) -> Episode:
+def _episode_from_row(row, tvshows: dict) -> Episode:
+    """ Builds an episode from a row, reusing the TVShow in *tvshows* """
+    tvshow = tvshows.get(row['id'])
+    if tvshow is None:
+        tvshow = tvshows[row['id']] = TVShow(row['id'], row['name'])
+
     return Episode(
-        tvshow=TVShow(row['id'], row['name']),
+        tvshow=tvshow,
         title=row['title'],
         season=row['season'],
         number=row['number']
     )
 
 
+def _file_from_row(row) -> EpisodeFile:
+    # The DB does not store the title of the file, so build the one
+    # ShowRSS would use: "<TV show name> <season>x<number> <episode title>"
+    title = "%s %dx%02d %s" % (row['name'], row['season'], row['number'],
+                               row['title'])
+
+    return EpisodeFile(title.strip(), row['link'],
+                       Quality.from_tag(row['quality']))
+
+
 # endregion
 
 
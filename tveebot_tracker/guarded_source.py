@@ -0,0 +1,223 @@
+import logging
+import time
+from threading import Lock
+
+from tveebot_tracker.source import EpisodeSource, Validators
+
+logger = logging.getLogger('guarded_source')
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.DEBUG)
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    Raised instead of calling a source while its circuit breaker is open
+    """
+
+
+class TokenBucket:
+    """
+    Rate limiter allowing *rate* operations per second on average, with
+    bursts of up to *capacity* operations.
+
+    The bucket holds up to *capacity* tokens and is refilled with *rate*
+    tokens per second. Each operation takes one token, waiting for it if
+    the bucket is empty. The bucket may be shared by multiple threads.
+    """
+
+    def __init__(self, rate: float, capacity: int = 1, clock=time.monotonic,
+                 sleep=time.sleep):
+        """
+        :param rate:     tokens added to the bucket per second
+        :param capacity: maximum number of tokens in the bucket, which
+                         starts full
+        :param clock:    function returning the current time, in seconds
+        :param sleep:    function waiting for a number of seconds
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+
+        self._lock = Lock()
+        self._tokens = float(capacity)
+        self._updated = clock()
+
+    def acquire(self):
+        """ Takes a token from the bucket, waiting for one if necessary """
+        with self._lock:
+            self._refill()
+
+            # Take the token right away, even if it is not in the bucket yet,
+            # so that threads waiting for tokens get them in order
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.
+
+        if wait > 0:
+            self._sleep(wait)
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class CircuitBreaker:
+    """
+    Stops calls to an upstream service after it fails repeatedly, giving it
+    time to recover.
+
+    The breaker starts closed, letting all calls through. After
+    *failure_threshold* consecutive failures, it opens and rejects all calls
+    for *reset_timeout* seconds. Then, it becomes half-open: a single call
+    goes through, as a probe. If the probe succeeds, the breaker closes;
+    otherwise, it opens again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold: int = 5,
+                 reset_timeout: float = 60.0, clock=time.monotonic):
+        """
+        :param failure_threshold: consecutive failures that open the breaker
+        :param reset_timeout:     seconds the breaker stays open before
+                                  letting a probe through
+        :param clock:             function returning the current time, in
+                                  seconds
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+
+        self._lock = Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return self.CLOSED
+
+            if self._probing or \
+                    self._clock() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+
+            return self.OPEN
+
+    def allow(self) -> bool:
+        """
+        Checks whether a call may go through. Each call allowed must be
+        reported back with success() or failure().
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            if self._probing or \
+                    self._clock() - self._opened_at < self.reset_timeout:
+                return False
+
+            # Half-open: this call is the probe
+            self._probing = True
+            return True
+
+    def success(self):
+        """ Reports that a call succeeded, closing the breaker """
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def failure(self) -> bool:
+        """
+        Reports that a call failed, which may open the breaker.
+
+        :return: True if the breaker opened, False otherwise
+        """
+        with self._lock:
+            self._failures += 1
+
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+                self._probing = False
+                return True
+
+            return False
+
+
+class GuardedSource(EpisodeSource):
+    """
+    Source guarding the calls to another source with a rate limiter and a
+    circuit breaker.
+
+    Fetches are rate limited, so that the upstream host does not throttle
+    the tracker. Connection errors count as failures of the upstream host,
+    and so do the UpstreamErrors raised when the host answers with an error
+    of its own: once the circuit breaker opens, fetches fail right away with
+    a CircuitOpenError, until the breaker lets a probe through. Any other
+    outcome, including not finding a TV show, means the host is up.
+
+    Each source should be guarded separately, since the limits apply to a
+    single upstream host.
+    """
+
+    def __init__(self, source: EpisodeSource, rate_limiter: TokenBucket,
+                 breaker: CircuitBreaker = None):
+        """
+        :param source:       source to guard
+        :param rate_limiter: rate limiter of the fetches from *source*
+        :param breaker:      circuit breaker of *source* (by default, one with
+                             the default thresholds)
+        """
+        self.source = source
+        self.rate_limiter = rate_limiter
+        self.breaker = breaker or CircuitBreaker()
+
+    def __repr__(self):
+        return f"GuardedSource({self.source!r})"
+
+    def fetch(self, tvshow_reference: str) -> list:
+        """
+        Fetches the episode files of the specified TV show from the guarded
+        source. See EpisodeSource.fetch().
+
+        :raise CircuitOpenError: if the circuit breaker of the source is open
+        """
+        return self._guard(lambda: self.source.fetch(tvshow_reference))
+
+    def fetch_until(self, tvshow_reference: str, stop,
+                    validators: Validators = None) -> list:
+        """
+        Fetches the episode files of the specified TV show from the guarded
+        source, until *stop*. See EpisodeSource.fetch_until().
+
+        :raise CircuitOpenError: if the circuit breaker of the source is open
+        """
+        return self._guard(lambda: self.source.fetch_until(
+            tvshow_reference, stop, validators))
+
+    def _guard(self, fetch) -> list:
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.source!r} is failing, not "
+                                   f"fetching from it for now")
+
+        self.rate_limiter.acquire()
+
+        try:
+            files = fetch()
+        except ConnectionError:
+            if self.breaker.failure():
+                logger.warning(f"{self.source!r} is failing, stopped "
+                               f"fetching from it for "
+                               f"{self.breaker.reset_timeout:.0f} seconds")
+            raise
+        except Exception:
+            # The source answered, even if with an error
+            self.breaker.success()
+            raise
+
+        self.breaker.success()
+        return files
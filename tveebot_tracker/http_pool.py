@@ -0,0 +1,500 @@
+import asyncio
+import io
+import re
+import zlib
+from contextlib import contextmanager, asynccontextmanager
+from http.client import HTTPConnection, HTTPSConnection, HTTPException, \
+    HTTPResponse, IncompleteRead, InvalidURL, RemoteDisconnected, \
+    parse_headers
+from threading import Lock
+from urllib.parse import urlsplit
+
+
+class Response:
+    """
+    Response obtained from a connection pool. The body is transparently
+    decoded if the server compressed it with gzip or deflate.
+    """
+
+    CHUNK_SIZE = 16 * 1024  # bytes
+
+    def __init__(self, response: HTTPResponse):
+        self._response = response
+        self.status = response.status
+        self.headers = response.headers
+
+        encoding = self.headers.get('Content-Encoding', '').lower()
+        if encoding in ('gzip', 'deflate'):
+            # wbits=47 detects both the gzip and the zlib headers
+            self._decoder = zlib.decompressobj(wbits=47)
+        else:
+            self._decoder = None
+
+        if response.length == 0:
+            # Consume empty bodies (e.g. 304 responses) right away
+            response.read()
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads up to *size* bytes of the decoded body, or all the remaining
+        body if *size* is negative. Returns an empty bytes object once the
+        body has been completely read.
+        """
+        if self._decoder is None:
+            return self._response.read(None if size < 0 else size)
+
+        if size < 0:
+            data = self._decoder.decompress(self._response.read())
+            return data + self._decoder.flush()
+
+        # Compressed chunks may decode to nothing: keep reading until there
+        # is some data to return or the body is over
+        data = b''
+        while not data:
+            chunk = self._response.read(self.CHUNK_SIZE)
+            if not chunk:
+                return self._decoder.flush()
+
+            data = self._decoder.decompress(chunk)
+
+        return data
+
+    def discard(self):
+        """ Reads and discards the rest of the body without decoding it """
+        while self._response.read(self.CHUNK_SIZE):
+            pass
+
+    @property
+    def reusable(self) -> bool:
+        """
+        Indicates whether the connection can be used for another request,
+        which requires the whole body to have been read
+        """
+        return self._response.isclosed() and not self._response.will_close
+
+
+class HTTPConnectionPool:
+    """
+    Thread-safe pool of persistent (keep-alive) connections to a single
+    host. Connections are reused across requests, so the TCP and TLS
+    handshakes are only paid when a new connection is needed.
+
+    Unlike urlopen(), the pool does not follow redirects, which are returned
+    as any other response, and always connects to the host directly,
+    ignoring the proxies configured in the environment (http_proxy, etc.).
+    """
+
+    def __init__(self, url: str, max_idle: int = 8, timeout: float = 30.0):
+        """
+        :param url:      URL of the host to connect to (the path is ignored)
+        :param max_idle: maximum number of idle connections kept open
+        :param timeout:  timeout in seconds for each connection
+        """
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.secure = parts.scheme == 'https'
+        self.max_idle = max_idle
+        self.timeout = timeout
+
+        self._lock = Lock()
+        self._idle = []
+
+    @contextmanager
+    def request(self, path: str, headers: dict = None):
+        """
+        Sends a GET request for *path* and provides the response. Must be
+        used as a context manager. The connection returns to the pool when
+        the context exits, as long as the response was completely read.
+
+        :param path:    path of the resource to request
+        :param headers: additional headers to send with the request
+        :return: the Response to the request
+        :raise OSError: if the connection to the host fails
+        :raise HTTPException: if the host sends an invalid response
+        """
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip, deflate')
+
+        connection, response = self._send(path, headers)
+
+        try:
+            response = Response(response)
+            yield response
+
+        except BaseException:
+            connection.close()
+            raise
+
+        if response.reusable:
+            self._release(connection)
+        else:
+            connection.close()
+
+    def close(self):
+        """ Closes all idle connections """
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection in idle:
+            connection.close()
+
+    def _send(self, path: str, headers: dict):
+        connection, reused = self._acquire()
+
+        try:
+            connection.request('GET', path, headers=headers)
+            return connection, connection.getresponse()
+
+        except (OSError, HTTPException):
+            connection.close()
+            if not reused:
+                raise
+
+        # The server may have dropped an idle connection in the meantime
+        # In that case, retry once with a brand new connection
+        connection = self._new_connection()
+        try:
+            connection.request('GET', path, headers=headers)
+            return connection, connection.getresponse()
+
+        except BaseException:
+            connection.close()
+            raise
+
+    def _acquire(self) -> (HTTPConnection, bool):
+        """ Returns an idle connection, or a new one if none is idle """
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+
+        return self._new_connection(), False
+
+    def _release(self, connection: HTTPConnection):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+
+        connection.close()
+
+    def _new_connection(self) -> HTTPConnection:
+        if self.secure:
+            return HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        else:
+            return HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+
+class AsyncResponse:
+    """
+    Response obtained from an asynchronous connection pool. As with
+    Response, the body is transparently decoded if the server compressed it
+    with gzip or deflate.
+    """
+
+    CHUNK_SIZE = 16 * 1024  # bytes
+
+    def __init__(self, reader: asyncio.StreamReader, status: int, headers,
+                 will_close: bool, timeout: float):
+        self._reader = reader
+        self._timeout = timeout
+        self.status = status
+        self.headers = headers
+
+        encoding = headers.get('Content-Encoding', '').lower()
+        if encoding in ('gzip', 'deflate'):
+            self._decoder = zlib.decompressobj(wbits=47)
+        else:
+            self._decoder = None
+
+        # The body is framed by its length, by chunks, or by the end of the
+        # connection (length is None and chunked is False)
+        self._chunked = 'chunked' in \
+            headers.get('Transfer-Encoding', '').lower()
+        self._chunk_left = 0
+        self._length = None
+        self._done = False
+
+        if status in (204, 304) or 100 <= status < 200:
+            self._length = 0
+        elif not self._chunked and 'Content-Length' in headers:
+            length = headers['Content-Length']
+            try:
+                self._length = int(length)
+            except ValueError:
+                raise HTTPException(f"invalid content length {length!r}")
+
+            if self._length < 0:
+                raise HTTPException(f"invalid content length {length!r}")
+
+        if self._length == 0:
+            self._done = True
+
+        # Without length nor chunks, the body ends with the connection
+        self.will_close = will_close or \
+            (self._length is None and not self._chunked)
+
+    async def read(self, size: int = -1) -> bytes:
+        """
+        Reads up to *size* bytes of the decoded body, or all the remaining
+        body if *size* is negative. Returns an empty bytes object once the
+        body has been completely read.
+        """
+        if size < 0:
+            parts = []
+            while True:
+                part = await self.read(self.CHUNK_SIZE)
+                if not part:
+                    return b''.join(parts)
+                parts.append(part)
+
+        if self._decoder is None:
+            return await self._read_raw(size)
+
+        # Compressed chunks may decode to nothing: keep reading until there
+        # is some data to return or the body is over
+        data = b''
+        while not data:
+            chunk = await self._read_raw(self.CHUNK_SIZE)
+            if not chunk:
+                return self._decoder.flush()
+
+            data = self._decoder.decompress(chunk)
+
+        return data
+
+    async def discard(self):
+        """ Reads and discards the rest of the body without decoding it """
+        while await self._read_raw(self.CHUNK_SIZE):
+            pass
+
+    @property
+    def reusable(self) -> bool:
+        """
+        Indicates whether the connection can be used for another request,
+        which requires the whole body to have been read
+        """
+        return self._done and not self.will_close
+
+    async def _read_raw(self, size: int) -> bytes:
+        """ Reads up to *size* bytes of the body, as sent by the server """
+        if self._done:
+            return b''
+
+        if self._chunked:
+            if self._chunk_left == 0:
+                self._chunk_left = await self._next_chunk()
+                if self._chunk_left == 0:
+                    self._done = True
+                    return b''
+
+            data = await self._read(min(size, self._chunk_left))
+            self._chunk_left -= len(data)
+            if self._chunk_left == 0:
+                await self._readline()  # CRLF ending the chunk
+            return data
+
+        if self._length is None:
+            data = await self._read(size, eof_ok=True)
+            self._done = not data
+            return data
+
+        data = await self._read(min(size, self._length))
+        self._length -= len(data)
+        self._done = self._length == 0
+        return data
+
+    async def _next_chunk(self) -> int:
+        """ Reads the header of the next chunk, returning its size """
+        line = await self._readline()
+        try:
+            size = int(line.split(b';', 1)[0], 16)
+        except ValueError:
+            raise HTTPException(f"invalid chunk header {line!r}")
+
+        if size == 0:
+            # Skip the trailers, up to the empty line ending the body
+            while await self._readline() not in (b'\r\n', b'\n'):
+                pass
+
+        return size
+
+    async def _read(self, size: int, eof_ok: bool = False) -> bytes:
+        data = await asyncio.wait_for(self._reader.read(size), self._timeout)
+        if not data and not eof_ok:
+            raise IncompleteRead(b'')
+        return data
+
+    async def _readline(self) -> bytes:
+        line = await asyncio.wait_for(self._reader.readline(), self._timeout)
+        if not line.endswith(b'\n'):
+            raise IncompleteRead(line)
+        return line
+
+
+class AsyncHTTPConnectionPool:
+    """
+    Pool of persistent (keep-alive) connections to a single host, for use
+    from asyncio coroutines. It keeps many requests in flight on a single
+    thread, each on its own connection, up to *max_connections* at a time.
+
+    A pool may only be used from one event loop at a time. Idle connections
+    opened by another event loop are dropped. As the HTTPConnectionPool, it
+    does not follow redirects nor use proxies.
+    """
+
+    def __init__(self, url: str, max_connections: int = 100,
+                 max_idle: int = 8, timeout: float = 30.0):
+        """
+        :param url:             URL of the host to connect to (the path is
+                                ignored)
+        :param max_connections: maximum number of connections open at the
+                                same time, further requests wait for one
+        :param max_idle:        maximum number of idle connections kept open
+        :param timeout:         timeout in seconds for each network operation
+        """
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.secure = parts.scheme == 'https'
+        self.port = parts.port or (443 if self.secure else 80)
+        self.max_connections = max_connections
+        self.max_idle = max_idle
+        self.timeout = timeout
+
+        self._loop = None
+        self._slots = None
+        self._idle = []
+
+    @asynccontextmanager
+    async def request(self, path: str, headers: dict = None):
+        """
+        Sends a GET request for *path* and provides the response. Must be
+        used as an asynchronous context manager. The connection returns to
+        the pool when the context exits, as long as the response was
+        completely read.
+
+        :param path:    path of the resource to request
+        :param headers: additional headers to send with the request
+        :return: the AsyncResponse to the request
+        :raise OSError: if the connection to the host fails
+        :raise HTTPException: if the host sends an invalid response
+        """
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        headers['Host'] = self.host if self.port in (80, 443) else \
+            f"{self.host}:{self.port}"
+
+        self._bind_loop()
+        async with self._slots:
+            connection, response = await self._send(path, headers)
+
+            try:
+                yield response
+
+            except BaseException:
+                connection[1].close()
+                raise
+
+            if response.reusable:
+                self._release(connection)
+            else:
+                connection[1].close()
+
+    def close(self):
+        """ Closes all idle connections """
+        idle, self._idle = self._idle, []
+
+        for _, writer in idle:
+            writer.close()
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # The transports of idle connections belong to the old loop
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.max_connections)
+            self._idle = []
+
+    async def _send(self, path: str, headers: dict):
+        if self._idle:
+            connection = self._idle.pop()
+            try:
+                return connection, await self._exchange(connection, path,
+                                                        headers)
+            except (OSError, HTTPException, asyncio.TimeoutError):
+                # The server may have dropped the idle connection in the
+                # meantime. In that case, retry once with a new connection
+                connection[1].close()
+
+        connection = await asyncio.wait_for(self._open(), self.timeout)
+        try:
+            return connection, await self._exchange(connection, path,
+                                                    headers)
+        except BaseException:
+            connection[1].close()
+            raise
+
+    async def _open(self):
+        if self.secure:
+            return await asyncio.open_connection(
+                self.host, self.port, ssl=True, server_hostname=self.host)
+        else:
+            return await asyncio.open_connection(self.host, self.port)
+
+    async def _exchange(self, connection, path: str,
+                        headers: dict) -> AsyncResponse:
+        """ Sends a request on *connection* and reads the response's head """
+        reader, writer = connection
+
+        # The request is built by hand: reject anything that would let the
+        # path or a header inject lines into it, as http.client does
+        if _invalid_path_char(path):
+            raise InvalidURL(f"invalid path {path!r}")
+        for name, value in headers.items():
+            if not _valid_header_name(name) or \
+                    _invalid_header_value_char(str(value)):
+                raise ValueError(f"invalid header {name!r}: {value!r}")
+
+        lines = [f"GET {path} HTTP/1.1"]
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+        await asyncio.wait_for(writer.drain(), self.timeout)
+
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'),
+                                          self.timeout)
+        except asyncio.IncompleteReadError as error:
+            raise RemoteDisconnected(
+                "remote end closed connection without response") from error
+        except asyncio.LimitOverrunError as error:
+            raise HTTPException("response head is too long") from error
+
+        status_line, _, header_lines = head.partition(b'\r\n')
+        try:
+            version, status, *_ = status_line.decode('latin-1').split(' ', 2)
+            status = int(status)
+        except ValueError:
+            raise HTTPException(f"invalid status line {status_line!r}")
+
+        message = parse_headers(io.BytesIO(header_lines))
+
+        connection_header = message.get('Connection', '').lower()
+        will_close = connection_header == 'close' or \
+            (version == 'HTTP/1.0' and connection_header != 'keep-alive')
+
+        return AsyncResponse(reader, status, message, will_close,
+                             self.timeout)
+
+    def _release(self, connection):
+        if len(self._idle) < self.max_idle:
+            self._idle.append(connection)
+        else:
+            connection[1].close()
+
+
+# Control characters and spaces may not appear in a request's path
+_invalid_path_char = re.compile(r'[\x00-\x20\x7f]').search
+
+# Header names are tokens, and header values may not contain line breaks
+_valid_header_name = re.compile(r"[!#$%&'*+\-.^_`|~0-9A-Za-z]+\Z").match
+_invalid_header_value_char = re.compile(r'[\r\n\x00]').search
@@ -0,0 +1,11 @@
+CREATE INDEX IF NOT EXISTS episode_state ON episode (state);
+
+
+-- Episodes still to download, which are the ones looked up on restart
+CREATE INDEX IF NOT EXISTS episode_not_downloaded
+  ON episode (tvshow_id, season, number)
+  WHERE state != 'downloaded';
+
+
+CREATE INDEX IF NOT EXISTS file_download_timestamp
+  ON file (download_timestamp);
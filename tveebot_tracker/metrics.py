@@ -0,0 +1,409 @@
+import inspect
+import json
+import math
+import os
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from os import PathLike
+from threading import Lock, Thread
+from time import perf_counter
+
+
+class Metric:
+    """
+    Base class of all metrics. A metric has a set of samples, one for each
+    combination of values of its labels. The values of all labels must be
+    given, as keyword arguments, every time the metric is updated.
+    """
+
+    type = None
+
+    def __init__(self, name: str, help: str, labels=()):
+        """
+        :param name:   name of the metric, as exposed
+        :param help:   description of the metric
+        :param labels: names of the labels of the metric
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        self._lock = Lock()
+        self._samples = {}
+
+    def _key(self, labels: dict) -> tuple:
+        if len(labels) != len(self.labels):
+            raise ValueError(f"metric {self.name} takes the labels "
+                             f"{self.labels}, got {tuple(labels)}")
+
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> list:
+        """
+        Returns a snapshot of the samples of the metric, as a list of (labels,
+        value) pairs, where labels is a dict mapping each label to its value
+        """
+        with self._lock:
+            return [(dict(zip(self.labels, key)), self._snapshot(value))
+                    for key, value in self._samples.items()]
+
+    @staticmethod
+    def _snapshot(value):
+        return value
+
+
+class Counter(Metric):
+    """ Metric that only goes up, such as the number of requests made """
+
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        """ Increments the counter by *amount*, which must not be negative """
+        if amount < 0:
+            raise ValueError("counters can not be decremented")
+
+        key = self._key(labels)
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """ Metric that goes up and down, such as the size of a queue """
+
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        """ Sets the gauge to *value* """
+        key = self._key(labels)
+        with self._lock:
+            self._samples[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        """ Increments the gauge by *amount* """
+        key = self._key(labels)
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        """ Decrements the gauge by *amount* """
+        self.inc(-amount, **labels)
+
+
+class _HistogramSample:
+    """ Observations of a histogram for one combination of label values """
+
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self, buckets: int):
+        self.counts = [0] * buckets  # not cumulative
+        self.sum = 0.
+
+
+class Histogram(Metric):
+    """
+    Metric counting observations, such as the duration of requests, in
+    buckets. The bucket of an observation is the first one whose upper bound
+    is not less than the observed value.
+    """
+
+    type = 'histogram'
+
+    # Upper bounds of the default buckets, in seconds. The lowest ones are
+    # meant for DB queries, the highest for fetching feeds
+    DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025,
+                       .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+
+    def __init__(self, name: str, help: str, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets: upper bounds of the buckets, in increasing order. A
+                        last bucket, with no upper bound, is always added
+        """
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        """ Records an observation of *value* """
+        key = self._key(labels)
+        bucket = bisect_left(self.buckets, value)
+
+        with self._lock:
+            sample = self._samples.get(key)
+            if sample is None:
+                sample = _HistogramSample(len(self.buckets) + 1)
+                self._samples[key] = sample
+
+            sample.counts[bucket] += 1
+            sample.sum += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Context manager observing the time, in seconds, it takes to exit
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def _snapshot(self, sample: _HistogramSample) -> dict:
+        buckets = {}
+        count = 0
+        for bound, bucket_count in zip(self.buckets + (math.inf,),
+                                       sample.counts):
+            count += bucket_count
+            buckets[_format_value(bound)] = count
+
+        return {'buckets': buckets, 'sum': sample.sum, 'count': count}
+
+
+class Registry:
+    """
+    Set of metrics exposed together. Metrics are obtained from a registry by
+    name, creating them the first time they are asked for, much like loggers.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics = {}
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._metrics.values()))
+
+    def get(self, metric_class, name: str, help: str, labels=(), **kwargs):
+        """
+        Returns the metric with the specified *name*, creating an instance
+        of *metric_class* if the registry does not have it yet.
+
+        :raise ValueError: if the registry has a metric with the same name,
+                           but of a different type or with other labels
+        """
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, help, labels, **kwargs)
+                self._metrics[name] = metric
+
+        if type(metric) is not metric_class or \
+                metric.labels != tuple(labels):
+            raise ValueError(f"metric {name} was already registered as a "
+                             f"{metric.type} with labels {metric.labels}")
+
+        return metric
+
+    def snapshot(self) -> dict:
+        """
+        Returns a snapshot of all the metrics, in a JSON serializable dict,
+        mapping the name of each metric to its type, help, and samples
+        """
+        return {
+            metric.name: {
+                'type': metric.type,
+                'help': metric.help,
+                'samples': [{'labels': labels, 'value': value}
+                            for labels, value in metric.samples()],
+            }
+            for metric in self
+        }
+
+    def to_json(self) -> str:
+        """ Returns a snapshot of all the metrics in JSON format """
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """
+        Returns a snapshot of all the metrics in the Prometheus text format
+        """
+        lines = []
+        for metric in self:
+            lines.append(f"# HELP {metric.name} {_escape_help(metric.help)}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+
+            for labels, value in metric.samples():
+                if metric.type != 'histogram':
+                    lines.append(f"{metric.name}{_format_labels(labels)} "
+                                 f"{_format_value(value)}")
+                    continue
+
+                for bound, count in value['buckets'].items():
+                    bucket_labels = dict(labels, le=bound)
+                    lines.append(f"{metric.name}_bucket"
+                                 f"{_format_labels(bucket_labels)} {count}")
+
+                lines.append(f"{metric.name}_sum{_format_labels(labels)} "
+                             f"{_format_value(value['sum'])}")
+                lines.append(f"{metric.name}_count{_format_labels(labels)} "
+                             f"{value['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, file: PathLike):
+        """
+        Dumps a snapshot of all the metrics to *file*, in JSON format if its
+        name ends with '.json' or in the Prometheus text format otherwise.
+        The file is replaced atomically, so readers never see partial dumps.
+        """
+        if str(file).endswith('.json'):
+            content = self.to_json()
+        else:
+            content = self.to_prometheus()
+
+        tmp_file = f"{file}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(content)
+        os.replace(tmp_file, file)
+
+
+# Registry of the metrics of the whole application
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, labels=(),
+            registry: Registry = REGISTRY) -> Counter:
+    """ Returns the counter with the specified *name* from *registry* """
+    return registry.get(Counter, name, help, labels)
+
+
+def gauge(name: str, help: str, labels=(),
+          registry: Registry = REGISTRY) -> Gauge:
+    """ Returns the gauge with the specified *name* from *registry* """
+    return registry.get(Gauge, name, help, labels)
+
+
+def histogram(name: str, help: str, labels=(),
+              buckets=Histogram.DEFAULT_BUCKETS,
+              registry: Registry = REGISTRY) -> Histogram:
+    """ Returns the histogram with the specified *name* from *registry* """
+    return registry.get(Histogram, name, help, labels, buckets=buckets)
+
+
+def timed(histogram: Histogram, **labels):
+    """
+    Decorator observing in *histogram* the time each call to the decorated
+    function takes. For generator functions, the time observed is the time
+    spent producing all the items, which excludes the time spent by the
+    caller consuming them.
+    """
+
+    def decorator(func):
+        if not inspect.isgeneratorfunction(inspect.unwrap(func)):
+            @wraps(func)
+            def timed_call(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    histogram.observe(perf_counter() - start, **labels)
+
+            return timed_call
+
+        @wraps(func)
+        def timed_generator(*args, **kwargs):
+            elapsed = 0.
+            start = perf_counter()
+            generator = func(*args, **kwargs)
+            try:
+                for item in generator:
+                    elapsed += perf_counter() - start
+                    yield item
+                    start = perf_counter()
+
+                elapsed += perf_counter() - start
+            finally:
+                generator.close()
+                histogram.observe(elapsed, **labels)
+
+        return timed_generator
+
+    return decorator
+
+
+class MetricsServer:
+    """
+    Local HTTP endpoint exposing the metrics of a registry. The metrics are
+    served in the Prometheus text format at /metrics and in JSON format at
+    /metrics.json.
+    """
+
+    def __init__(self, address: tuple = ('127.0.0.1', 9100),
+                 registry: Registry = REGISTRY):
+        """
+        :param address:  (host, port) pair to listen on. With port 0, any
+                         free port is used
+        :param registry: registry of the metrics to serve
+        """
+        self._server = ThreadingHTTPServer(address, _MetricsHandler)
+        self._server.daemon_threads = True
+        self._server.registry = registry
+        self._thread = None
+
+    @property
+    def address(self) -> tuple:
+        """ (host, port) pair the server is listening on """
+        return self._server.server_address
+
+    def start(self):
+        """ Starts serving the metrics, in a background thread """
+        self._thread = Thread(target=self._server.serve_forever,
+                              name='metrics_server', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stops serving the metrics and closes the server's socket """
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+
+        self._server.server_close()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        registry = self.server.registry
+
+        if self.path == '/metrics':
+            body = registry.to_prometheus().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path == '/metrics.json':
+            body = registry.to_json().encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # scrapes are too frequent to be logged
+
+
+def _format_value(value: float) -> str:
+    return "+Inf" if value == math.inf else repr(value)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+
+    pairs = ",".join(f'{name}="{_escape_label(value)}"'
+                     for name, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+def _escape_help(text: str) -> str:
+    return text.replace('\\', r'\\').replace('\n', r'\n')
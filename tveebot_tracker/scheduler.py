@@ -0,0 +1,183 @@
+import heapq
+
+
+class _Schedule:
+    """ Scheduling state of a single TV show """
+
+    def __init__(self, interval: float):
+        self.interval = interval  # current time between checks
+        self.next_check = None  # time of the next check
+        self.last_change = None  # time at which the feed last changed
+        self.change_period = None  # estimated time between changes
+        self.expected_change = None  # time at which the next change is due
+
+
+class PollScheduler:
+    """
+    Decides when each TV show should be checked for new episodes.
+
+    Each TV show is checked at its own interval, which adapts to how often
+    its feed actually changes. Every time a check finds nothing new, the
+    interval of that TV show grows exponentially, up to *max_period*. When a
+    check finds something new, the interval goes back to *min_period*.
+
+    The scheduler also learns the time between changes of each TV show
+    (usually, the time between the air dates of its episodes). Once a change
+    is expected, the TV show is checked at that time and then again at
+    *min_period*, backing off from there. Changes less than *max_period*
+    apart are considered to belong to the same release.
+
+    Checks that fail, e.g. because the source is unreachable, say nothing
+    about the feed: they leave the interval of the TV show as it was, and
+    the check is retried after that interval.
+
+    Times are given by the caller, as seconds in any monotonic clock.
+    """
+
+    def __init__(self, min_period: float, max_period: float,
+                 backoff: float = 2.0):
+        """
+        :param min_period: minimum time between checks of a TV show
+        :param max_period: maximum time between checks of a TV show
+        :param backoff:    factor by which the interval of a TV show grows
+                           each time a check finds nothing new
+        """
+        self.min_period = min_period
+        self.max_period = max_period
+        self.backoff = backoff
+
+        self._schedules = {}
+
+        # Heap of (next check time, tvshow_id) entries. Entries become stale
+        # when a TV show is rescheduled or removed: those are skipped
+        self._heap = []
+
+    def __contains__(self, tvshow_id: str):
+        return tvshow_id in self._schedules
+
+    def __iter__(self):
+        return iter(self._schedules)
+
+    def add(self, tvshow_id: str, now: float):
+        """ Schedules a new TV show to be checked right away """
+        if tvshow_id not in self._schedules:
+            self._schedules[tvshow_id] = _Schedule(self.min_period)
+            self._schedule(tvshow_id, check_time=now)
+
+    def remove(self, tvshow_id: str):
+        """ Stops scheduling the checks of a TV show """
+        self._schedules.pop(tvshow_id, None)
+
+    def set_periods(self, min_period: float, max_period: float, now: float):
+        """
+        Changes the minimum and maximum time between checks at time *now*.
+        The interval of each TV show is bounded by the new periods, and
+        checks scheduled later than that interval from *now* are brought
+        forward.
+        """
+        self.min_period = min_period
+        self.max_period = max_period
+
+        for tvshow_id, schedule in self._schedules.items():
+            schedule.interval = min(max(schedule.interval, min_period),
+                                    max_period)
+
+            if schedule.next_check is not None and \
+                    schedule.next_check > now + schedule.interval:
+                self._schedule(tvshow_id, now + schedule.interval)
+
+    def due(self, now: float) -> list:
+        """
+        Returns the IDs of the TV shows that are due to be checked at time
+        *now*. Each of them must be reported back with checked().
+        """
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            check_time, tvshow_id = heapq.heappop(self._heap)
+
+            schedule = self._schedules.get(tvshow_id)
+            if schedule is not None and schedule.next_check == check_time:
+                schedule.next_check = None
+                due.append(tvshow_id)
+
+        return due
+
+    def next_check(self):
+        """
+        Returns the time of the next scheduled check, or None if no check is
+        scheduled
+        """
+        while self._heap:
+            check_time, tvshow_id = self._heap[0]
+
+            schedule = self._schedules.get(tvshow_id)
+            if schedule is not None and schedule.next_check == check_time:
+                return check_time
+
+            heapq.heappop(self._heap)  # discard stale entry
+
+        return None
+
+    def checked(self, tvshow_id: str, changed: bool, now: float):
+        """
+        Reports that a TV show was checked at time *now*, indicating whether
+        its feed *changed*, and schedules its next check.
+        """
+        schedule = self._schedules.get(tvshow_id)
+        if schedule is None:
+            return  # it was removed in the meantime
+
+        if changed:
+            schedule.interval = self.min_period
+
+            if schedule.last_change is None:
+                schedule.last_change = now
+
+            elif now - schedule.last_change >= self.max_period:
+                # Changes closer together than max_period are taken as part of
+                # the same release (e.g. files in other qualities)
+                period = now - schedule.last_change
+                if schedule.change_period is None:
+                    schedule.change_period = period
+                else:
+                    # Moving average, tolerating delays in some air dates
+                    schedule.change_period = \
+                        (schedule.change_period + period) / 2
+
+                schedule.last_change = now
+
+            if schedule.change_period is not None:
+                schedule.expected_change = \
+                    schedule.last_change + schedule.change_period
+
+        elif schedule.expected_change is not None and \
+                now >= schedule.expected_change:
+            # A change is due but it did not happen yet: check it often
+            schedule.interval = self.min_period
+            while schedule.expected_change <= now:
+                schedule.expected_change += schedule.change_period
+
+        else:
+            schedule.interval = min(schedule.interval * self.backoff,
+                                    self.max_period)
+
+        check_time = now + schedule.interval
+        if schedule.expected_change is not None:
+            check_time = min(check_time, max(now, schedule.expected_change))
+
+        self._schedule(tvshow_id, check_time)
+
+    def failed(self, tvshow_id: str, now: float):
+        """
+        Reports that the check of a TV show at time *now* failed, and
+        schedules it to be checked again, without backing off.
+        """
+        schedule = self._schedules.get(tvshow_id)
+        if schedule is None:
+            return  # it was removed in the meantime
+
+        self._schedule(tvshow_id, now + schedule.interval)
+
+    def _schedule(self, tvshow_id: str, check_time: float):
+        self._schedules[tvshow_id].next_check = check_time
+        heapq.heappush(self._heap, (check_time, tvshow_id))
@@ -0,0 +1,268 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from tveebot_tracker.config import Config
+from tveebot_tracker.download_queue import DownloadQueue
+from tveebot_tracker.episode_db import EpisodeDB
+from tveebot_tracker.source import EpisodeSource, AsyncSourceAdapter
+from tveebot_tracker.tracker import AsyncTracker, Tracker, check_tvshow
+
+logger = logging.getLogger('sharded_tracker')
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.DEBUG)
+
+
+def shard_of(tvshow_id: str, shards: int) -> int:
+    """
+    Returns the shard, from 0 to *shards* - 1, of the TV show with ID
+    *tvshow_id*. Unlike hash(), the result is the same in every process and
+    across restarts.
+    """
+    return zlib.crc32(tvshow_id.encode()) % shards
+
+
+class AsyncShardedTracker(AsyncTracker):
+    """
+    Asynchronous tracker partitioning the TV shows in shards, by a hash of
+    their IDs, and checking each shard in a worker process of its own.
+
+    Fetching and parsing feeds, and parsing the titles of their files, is
+    CPU-bound and limited by the GIL to a single core in a single process.
+    Here, each of the *shards* worker processes fetches the feeds of its
+    shard concurrently, up to *max_concurrent_fetches* at a time, parses
+    them, and selects the files of the new episodes. This process remains
+    the coordinator: it is the only one accessing the DB and the download
+    queue, and stores the episodes found by all workers in a single
+    transaction, as the AsyncTracker does.
+
+    Each worker creates its own source by calling *source_factory* once,
+    when it starts. The factory must be picklable, e.g. a source class or a
+    functools.partial of one, and return an EpisodeSource or an
+    AsyncEpisodeSource. Workers are started by the first track and are
+    restarted if they crash. The number of shards is read when the workers
+    start.
+
+    Workers keep no state of their own between tracks, besides their
+    connections: the watermarks and feed validators of each TV show are
+    sent with every check and are stored by the coordinator, in the DB,
+    only along with the episodes found. The sources created by the workers
+    must not persist any state either, e.g. to files, since all workers
+    would write to the same ones.
+
+    The metrics of fetches and of parsing are recorded by the workers, in
+    their own registries, and are not visible to the coordinator.
+    """
+
+    def __init__(self, source_factory, episode_db: EpisodeDB,
+                 download_queue: DownloadQueue, config: Config):
+        """
+        Initialize the tracker with the necessary components.
+
+        :param source_factory: picklable function called by each worker to
+                               create the source it obtains episode files
+                               from
+        :param episode_db:     DB used to track episodes
+        :param download_queue: queue shared with downloader to place new
+                               episodes to be downloaded
+        :param config:         configuration used for the whole application
+        """
+        super().__init__(None, episode_db, download_queue, config)
+        self.source_factory = source_factory
+        self._workers = []
+
+    @property
+    def shards(self):
+        return self._config.shards
+
+    @property
+    def fetch_workers(self):
+        return self._config.fetch_workers
+
+    def close(self):
+        """
+        Stops the worker processes, once they finish the checks they are
+        running. They are started again by the next track.
+        """
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.shutdown(cancel_futures=True)
+
+    def _start_worker(self) -> ProcessPoolExecutor:
+        # Workers are spawned, rather than forked, since this process runs
+        # other threads, whose locks a fork would copy in any state
+        return ProcessPoolExecutor(
+            1, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(self.source_factory, self.max_concurrent_fetches,
+                      self.fetch_workers))
+
+    def _start_checks(self, tvshows: list, watermarks: dict,
+                      validators: dict) -> list:
+        """
+        Sends each shard of the *tvshows* to be checked by its worker, with
+        their *watermarks* and *validators*.
+
+        :return: list with a future for each TV show, in the same order,
+                 resolving to the CheckResult of that TV show
+        """
+        if not self._workers:
+            self._workers = [self._start_worker()
+                             for _ in range(self.shards)]
+
+        loop = asyncio.get_running_loop()
+        checks = [loop.create_future() for _ in tvshows]
+
+        shards = [[] for _ in self._workers]
+        for (tvshow, quality), check in zip(tvshows, checks):
+            shard = shards[shard_of(tvshow.id, len(shards))]
+            shard.append(((tvshow.id, quality, watermarks.get(tvshow.id),
+                           validators.get(tvshow.id)), check))
+
+        for index, shard in enumerate(shards):
+            if not shard:
+                continue
+
+            worker = self._workers[index]
+            batch = worker.submit(_check_shard,
+                                  [tvshow for tvshow, _ in shard])
+            batch.add_done_callback(functools.partial(
+                self._batch_done, loop, index, worker, shard))
+
+        return checks
+
+    def _batch_done(self, loop, index: int, worker, shard: list, batch):
+        # Called by a thread of the worker's executor
+        try:
+            loop.call_soon_threadsafe(self._resolve, index, worker, shard,
+                                      batch)
+        except RuntimeError:
+            # The event loop was closed, so nothing waits for these checks
+            pass
+
+    def _resolve(self, index: int, worker, shard: list, batch):
+        """
+        Resolves the check of each TV show in *shard* with the result of the
+        *batch* sent to the *worker* of shard *index*
+        """
+        try:
+            results = batch.result()
+        except BrokenProcessPool as error:
+            # The TV shows of this shard are not checked in this track, as
+            # if their source was not reachable, but the worker is replaced
+            # for the next one
+            logger.error(f"worker of shard {index} failed: {error}")
+            if index < len(self._workers) and \
+                    self._workers[index] is worker:
+                worker.shutdown(wait=False)
+                self._workers[index] = self._start_worker()
+
+            error = ConnectionAbortedError(f"worker of shard {index} failed")
+            results = [error] * len(shard)
+        except BaseException as error:
+            # E.g. the batch was cancelled by close() or could not be pickled
+            results = [error] * len(shard)
+
+        for (_, check), result in zip(shard, results):
+            # Checks are cancelled when the track is
+            if check.done():
+                continue
+
+            if isinstance(result, BaseException):
+                check.set_exception(result)
+            else:
+                check.set_result(result)
+
+
+class ShardedTracker(Tracker):
+    """
+    Threaded interface of the AsyncShardedTracker, which checks the TV
+    shows in multiple worker processes. See Tracker and
+    AsyncShardedTracker.
+
+    The worker processes are stopped when the tracker stops. If track() is
+    called instead, they must be stopped with close().
+    """
+
+    def __init__(self, source_factory, episode_db: EpisodeDB,
+                 download_queue: DownloadQueue, config: Config):
+        """
+        Initialize the tracker with the necessary components.
+
+        :param source_factory: picklable function called by each worker to
+                               create the source it obtains episode files
+                               from
+        :param episode_db:     DB used to track episodes
+        :param download_queue: queue shared with downloader to place new
+                               episodes to be downloaded
+        :param config:         configuration used for the whole application
+        """
+        super().__init__(source_factory, episode_db, download_queue, config)
+
+    def _new_engine(self, source_factory) -> AsyncShardedTracker:
+        return AsyncShardedTracker(source_factory, self.database,
+                                   self._queue, self._config)
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self.close()
+
+    def close(self):
+        """ Stops the worker processes. See AsyncShardedTracker.close() """
+        self._engine.close()
+
+
+# region Worker Process
+
+# Set once in each worker process, by _init_worker()
+_worker_loop = None
+_worker_source = None
+_worker_max_concurrent_fetches = None
+
+
+def _init_worker(source_factory, max_concurrent_fetches: int,
+                 fetch_workers: int):
+    """
+    Initializes a worker process, creating its source and the event loop in
+    which it checks every batch, so that the source keeps its connections
+    between tracks
+    """
+    global _worker_loop, _worker_source, _worker_max_concurrent_fetches
+
+    source = source_factory()
+    if isinstance(source, EpisodeSource):
+        source = AsyncSourceAdapter(source)
+
+    _worker_loop = asyncio.new_event_loop()
+    _worker_loop.set_default_executor(ThreadPoolExecutor(
+        fetch_workers, thread_name_prefix='tracker'))
+    _worker_source = source
+    _worker_max_concurrent_fetches = max_concurrent_fetches
+
+
+def _check_shard(tvshows: list) -> list:
+    """
+    Checks the *tvshows* of a shard, given as (tvshow_id, quality,
+    watermark, validators) tuples, in the worker process.
+
+    :return: list with the CheckResult of each TV show, in the same order,
+             or the exception raised while checking it
+    """
+    return _worker_loop.run_until_complete(_check_all(tvshows))
+
+
+async def _check_all(tvshows: list) -> list:
+    slots = asyncio.Semaphore(_worker_max_concurrent_fetches)
+    return await asyncio.gather(
+        *(check_tvshow(_worker_source, tvshow_id, quality, watermark,
+                       validators, slots)
+          for tvshow_id, quality, watermark, validators in tvshows),
+        return_exceptions=True)
+
+# endregion
@@ -1,18 +1,49 @@
-from urllib.error import HTTPError, URLError
-from urllib.request import urlopen
+import asyncio
+from http.client import HTTPException
+from time import perf_counter
+from urllib.parse import urlsplit, quote
 from xml.etree import ElementTree
 
-from tveebot_tracker.episode import Quality, EpisodeFile
+from tveebot_tracker import metrics
+from tveebot_tracker.episode import EpisodeFile, parse_file_title
 from tveebot_tracker.exceptions import ParseError
-from tveebot_tracker.source import TVShowNotFoundError, EpisodeSource
+from tveebot_tracker.http_pool import HTTPConnectionPool, \
+    AsyncHTTPConnectionPool
+from tveebot_tracker.source import TVShowNotFoundError, EpisodeSource, \
+    AsyncEpisodeSource, Feed, Validators, UpstreamError
+
+feed_parse_seconds = metrics.histogram(
+    'tveebot_feed_parse_seconds', "Time spent parsing each feed, excluding "
+                                  "the time spent reading it")
 
 
 class ShowRSSSource(EpisodeSource):
-    """ Source based on the ShowRSS website """
+    """
+    Source based on the ShowRSS website.
+
+    The feeds are fetched through a pool of persistent connections to the
+    ShowRSS host, which may be used by multiple threads at the same time.
+
+    Feeds are requested conditionally, with the validators given by the
+    caller, and are returned as Feeds carrying the validators to give in
+    the next fetch. The source does not keep any validators itself.
+    """
 
     SHOW_RSS_URL = "https://showrss.info/show"
 
-    def fetch(self, tvshow_reference: str) -> list:
+    def __init__(self, url: str = SHOW_RSS_URL):
+        """
+        :param url: base URL of the feeds of each TV show
+        """
+        self.url = url
+        self._path = urlsplit(url).path
+        self._pool = HTTPConnectionPool(url)
+
+    def __repr__(self):
+        return f"ShowRSSSource({self.url!r})"
+
+    def fetch(self, tvshow_reference: str,
+              validators: Validators = None) -> Feed:
         """
         Fetches all the episode files available at the source for the specified
         TV show.
@@ -21,25 +52,214 @@ class ShowRSSSource(EpisodeSource):
         correspond to that ID. This ID is absolutely necessary to be able to
         fetch the episode file from this source.
 
+        If *validators* are given, the feed is requested conditionally. If it
+        did not change since the fetch that returned those validators, it is
+        not downloaded again and no files are returned.
+
         :param tvshow_reference: the TV Show id
-        :return: list containing the episode files fetched
+        :param validators: validators of the Feed returned by the last fetch
+        :return: Feed with the episode files fetched (empty if the feed did
+                 not change) and the validators for the next fetch
         :raise TVShowNotFound: if the specified reference does not match to any
                                TV show available
+        :raise UpstreamError: if ShowRSS answers with an error, e.g. because
+                              it is unavailable or throttling requests
         :raises ConnectionRefusedError: if it can not connect to ShowRSS
         """
-        tvshow_url = "%s/%s.rss" % (self.SHOW_RSS_URL, tvshow_reference)
+        return self.fetch_until(tvshow_reference, stop=lambda file: False,
+                                validators=validators)
+
+    def fetch_until(self, tvshow_reference: str, stop,
+                    validators: Validators = None) -> Feed:
+        """
+        Same as fetch(), but the feed is parsed while it is downloaded and
+        no more items are parsed once *stop* returns True for one of them.
+        """
+        headers = _validator_headers(validators)
+
+        files = []
+        try:
+            path = _feed_path(self._path, tvshow_reference)
+            with self._pool.request(path, headers) as response:
+                if response.status == 304:
+                    # The feed was not modified: there is nothing new
+                    return Feed([], _response_validators(response,
+                                                         validators))
+
+                _check_status(response, tvshow_reference)
+
+                for file in iter_feed(response):
+                    if stop(file):
+                        break
+                    files.append(file)
+
+                # Skip the rest of the feed without parsing it, which allows
+                # the connection to be reused
+                response.discard()
+
+                validators = _response_validators(response)
+
+        except UpstreamError:
+            raise
+
+        except (OSError, HTTPException):
+            raise ConnectionRefusedError("connection with ShowRSS failed")
+
+        return Feed(files, validators)
+
+
+class AsyncShowRSSSource(AsyncEpisodeSource):
+    """
+    Asynchronous source based on the ShowRSS website. It behaves as the
+    ShowRSSSource, but fetches are coroutines, which allows a single thread
+    to keep up to *max_connections* feed requests in flight.
+
+    The feeds are fetched through a pool of persistent connections to the
+    ShowRSS host, which must be used from a single event loop at a time.
+    """
+
+    def __init__(self, url: str = ShowRSSSource.SHOW_RSS_URL,
+                 max_connections: int = 100):
+        """
+        :param url:             base URL of the feeds of each TV show
+        :param max_connections: maximum number of connections to ShowRSS
+                                open at the same time
+        """
+        self.url = url
+        self._path = urlsplit(url).path
+        self._pool = AsyncHTTPConnectionPool(url, max_connections)
+
+    def __repr__(self):
+        return f"AsyncShowRSSSource({self.url!r})"
 
+    def close(self):
+        """ Closes the idle connections to ShowRSS """
+        self._pool.close()
+
+    async def fetch(self, tvshow_reference: str,
+                    validators: Validators = None) -> Feed:
+        """
+        Fetches all the episode files available at the source for the specified
+        TV show. See ShowRSSSource.fetch().
+        """
+        return await self.fetch_until(tvshow_reference,
+                                      stop=lambda file: False,
+                                      validators=validators)
+
+    async def fetch_until(self, tvshow_reference: str, stop,
+                          validators: Validators = None) -> Feed:
+        """
+        Same as fetch(), but the feed is parsed while it is downloaded and
+        no more items are parsed once *stop* returns True for one of them.
+        """
+        headers = _validator_headers(validators)
+
+        files = []
+        parser = FeedParser()
         try:
-            with urlopen(tvshow_url) as response:
-                feed = response.read()
+            path = _feed_path(self._path, tvshow_reference)
+            async with self._pool.request(path, headers) as response:
+                if response.status == 304:
+                    # The feed was not modified: there is nothing new
+                    return Feed([], _response_validators(response,
+                                                         validators))
+
+                _check_status(response, tvshow_reference)
+
+                stopped = False
+                while not stopped:
+                    chunk = await response.read(FEED_CHUNK_SIZE)
+                    if not chunk:
+                        parser.close()
+                        break
+
+                    parser.feed(chunk)
+                    for file in parser.files():
+                        if stop(file):
+                            stopped = True
+                            break
+                        files.append(file)
+
+                # Skip the rest of the feed without parsing it, which allows
+                # the connection to be reused
+                await response.discard()
 
-        except HTTPError:
-            raise TVShowNotFoundError(f"ShowRSS source did not find TV Show "
-                                      f"with reference '{tvshow_reference}'")
-        except URLError:
+                validators = _response_validators(response)
+
+        except UpstreamError:
+            raise
+
+        except (OSError, HTTPException, asyncio.TimeoutError):
             raise ConnectionRefusedError("connection with ShowRSS failed")
 
-        return parse_feed(feed)
+        finally:
+            feed_parse_seconds.observe(parser.elapsed)
+
+        return Feed(files, validators)
+
+
+def _feed_path(base_path: str, tvshow_reference: str) -> str:
+    """
+    Returns the path of the feed of a TV show. The reference is quoted, so
+    that it can only ever name a single feed under *base_path*.
+    """
+    return "%s/%s.rss" % (base_path, quote(tvshow_reference, safe=''))
+
+
+def _check_status(response, tvshow_reference: str):
+    """
+    Checks the status of the *response* to a feed request, other than 304
+
+    :raise TVShowNotFound: if ShowRSS has no feed for *tvshow_reference*
+    :raise UpstreamError: if ShowRSS answered with an error of its own, or
+                          redirected the request
+    """
+    status = response.status
+    if status in (404, 410):
+        raise TVShowNotFoundError(
+            f"ShowRSS source did not find TV Show with reference "
+            f"'{tvshow_reference}'")
+
+    # The connection pools do not follow redirects
+    if 300 <= status < 400:
+        raise UpstreamError(f"ShowRSS redirected the feed to "
+                            f"{response.headers.get('Location')!r}")
+
+    # Any other error, e.g. 429 (Too Many Requests) or 503 (Service
+    # Unavailable), says nothing about the TV show
+    if status != 200:
+        raise UpstreamError(f"ShowRSS answered with status {status}")
+
+
+def _validator_headers(validators: Validators) -> dict:
+    """ Returns the headers making a request conditional on *validators* """
+    headers = {}
+    if validators is not None:
+        if validators.etag is not None:
+            headers['If-None-Match'] = validators.etag
+        if validators.last_modified is not None:
+            headers['If-Modified-Since'] = validators.last_modified
+
+    return headers
+
+
+def _response_validators(response, sent: Validators = None) -> Validators:
+    """
+    Returns the validators of a *response*. A 'not modified' response may
+    omit them, in which case the validators *sent* in the request still
+    apply.
+    """
+    validators = Validators(response.headers.get('ETag'),
+                            response.headers.get('Last-Modified'))
+
+    if validators == (None, None):
+        return sent
+
+    return validators
+
+
+# Size of the chunks read from a feed stream
+FEED_CHUNK_SIZE = 16 * 1024  # bytes
 
 
 def parse_feed(feed: str) -> list:
@@ -49,42 +269,128 @@ def parse_feed(feed: str) -> list:
     :param feed: the feed to parse
     :return: list of episode files included in *feed*
     """
+    return list(iter_feed(feed))
+
+
+def iter_feed(feed):
+    """
+    Parses a TV Show *feed* incrementally, yielding each episode file included
+    in that feed as soon as its item is parsed. Items are discarded once
+    parsed, so memory usage does not depend on the size of the feed.
+
+    :param feed: the feed to parse, either as a string or as a binary stream
+                 (any object with a read(size) method)
+    :raise ParseError: if the feed is not valid
+    """
+    if isinstance(feed, (str, bytes)):
+        chunks = (feed,)
+    else:
+        chunks = iter(lambda: feed.read(FEED_CHUNK_SIZE), b'')
+
+    parser = FeedParser()
     try:
-        root = ElementTree.fromstring(feed)
-    except ElementTree.ParseError as error:
-        raise ParseError(str(error))
+        for chunk in chunks:
+            parser.feed(chunk)
+            yield from parser.files()
 
-    channel = root.find('channel')
+        parser.close()
 
-    if channel is None:
-        raise ParseError("feed's format is invalid: missing 'channel' element")
+    finally:
+        feed_parse_seconds.observe(parser.elapsed)
 
-    # This function is used multiple times in the loop below
-    def attr(item, attribute):
-        """ Fetches the text of *attribute* from *item* element """
-        attribute = item.find(attribute)
 
-        if attribute is None:
-            raise ParseError(f"item is missing required attribute {attribute}")
+class FeedParser:
+    """
+    Incremental parser of TV show feeds. The feed is fed to the parser in
+    chunks, as it arrives, and the episode file of each item is obtained as
+    soon as the item is complete. Items are discarded once parsed, so memory
+    usage does not depend on the size of the feed.
+
+    The parser does not read the feed itself, so it may be used with both
+    blocking and asynchronous streams.
+    """
 
-        return attribute.text
+    def __init__(self):
+        self._parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        self._parents = []  # elements enclosing the element being parsed
+        self._channel = None
 
-    files = []
-    for item in channel.findall('item'):
-        item = {
-            "title": attr(item, 'title'),
-            "link": attr(item, 'link')
-        }
+        # Time spent parsing, which excludes the time spent reading chunks
+        # and the time spent by the caller between files
+        self.elapsed = 0.
 
-        files.append(parse_item(item))
+    def feed(self, chunk):
+        """ Feeds the next *chunk* of the feed, as a string or as bytes """
+        start = perf_counter()
+        self._parser.feed(chunk)
+        self.elapsed += perf_counter() - start
 
-    return files
+    def files(self):
+        """
+        Yields the episode file of each item completed by the chunks fed so
+        far, which was not yielded before
+
+        :raise ParseError: if the feed is not valid
+        """
+        start = perf_counter()
+        parents = self._parents
+        try:
+            for event, element in self._parser.read_events():
+                if event == 'start':
+                    if self._channel is None and len(parents) == 1 and \
+                            element.tag == 'channel':
+                        self._channel = element
 
+                    parents.append(element)
+                    continue
 
-quality_tags = {
-    '720p': Quality.HD,
-    '1080p': Quality.FHD,
-}
+                parents.pop()
+                if self._channel is None or not parents or \
+                        parents[-1] is not self._channel:
+                    continue
+
+                if element.tag == 'item':
+                    file = parse_item({
+                        "title": _attr(element, 'title'),
+                        "link": _attr(element, 'link')
+                    })
+
+                    self.elapsed += perf_counter() - start
+                    yield file
+                    start = perf_counter()
+
+                # Children of the channel are no longer needed
+                self._channel.remove(element)
+
+        except ElementTree.ParseError as error:
+            raise ParseError(str(error))
+
+        self.elapsed += perf_counter() - start
+
+    def close(self):
+        """
+        Signals the end of the feed
+
+        :raise ParseError: if the feed is incomplete or invalid
+        """
+        try:
+            self._parser.close()
+        except ElementTree.ParseError as error:
+            raise ParseError(str(error))
+
+        if self._channel is None:
+            raise ParseError("feed's format is invalid: missing 'channel' "
+                             "element")
+
+
+def _attr(item, attribute: str) -> str:
+    """ Fetches the text of *attribute* from *item* element """
+    element = item.find(attribute)
+
+    if element is None:
+        raise ParseError(f"item is missing required attribute {attribute}")
+
+    return element.text
 
 
 def parse_item(item: dict) -> EpisodeFile:
@@ -98,21 +404,17 @@ def parse_item(item: dict) -> EpisodeFile:
     :param item: a dict with the keys specified in the description
     :return: episode file parsed from *item*
     """
-    file_quality = Quality.SD  # may change
+    # The file title does not include the quality tag. The title is parsed
+    # only here: the tracker reuses the info kept with the file
+    file_title, file_quality, info = parse_file_title(item['title'])
 
-    words: list = item['title'].split(" ")
-    for tag, quality in quality_tags.items():
-        try:
-            words.remove(tag)
-            file_quality = quality
-            break
-        except ValueError:
-            # Tag is not in words
-            continue
+    return EpisodeFile(file_title, item['link'], file_quality, info)
 
-    # The file title does not include the quality tags
-    # Those are removed from 'words' at this point
-    file_title = " ".join(words)
 
-    return EpisodeFile(file_title, item['link'], file_quality)
+def parse_items(items) -> list:
+    """
+    Parses multiple *items*. See parse_item().
 
+    :return: list with the episode file parsed from each item, in order
+    """
+    return [parse_item(item) for item in items]
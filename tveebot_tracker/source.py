@@ -1,10 +1,43 @@
+import asyncio
 from abc import ABC, abstractmethod
+from collections import namedtuple
+from itertools import takewhile
 
 
 class TVShowNotFoundError(Exception):
     """ Raised when a reference does not match any TV Show available """
 
 
+class UpstreamError(ConnectionError):
+    """
+    Raised when the host of a source answers with an error of its own, such
+    as being unavailable or throttling requests, rather than with a feed
+    """
+
+
+# HTTP cache validators of a feed, which make the next request for that feed
+# conditional: the ETag and the Last-Modified date (either may be None)
+Validators = namedtuple("Validators", "etag last_modified")
+
+
+class Feed(list):
+    """
+    List of the episode files fetched from a feed, returned by sources that
+    request feeds conditionally. Along with the files, it carries the
+    *validators* of the feed, to be given back to the source in the next
+    fetch of the same feed. If the feed did not change by then, the source
+    does not download it again and returns no files.
+
+    Sources do not keep the validators themselves. The caller should only
+    keep them once it has processed the files: if it gave back validators
+    of files it then discarded, those files would never be fetched again.
+    """
+
+    def __init__(self, files=(), validators: Validators = None):
+        super().__init__(files)
+        self.validators = validators
+
+
 class EpisodeSource(ABC):
     """
     Abstract base class to define the interface for and episode source.
@@ -33,7 +66,93 @@ class EpisodeSource(ABC):
         :param tvshow_reference: reference that uniquely identifies the TV show
                                  to get the episodes for
         :return: a list containing all episode files available for the specified
-                 TV Show. An empty list if none is found.
+                 TV Show. An empty list if none is found or if the source
+                 knows that none changed since the last fetch.
+        :raise TVShowNotFound: if the specified reference does not match to any
+                               TV show available
+        """
+
+    def fetch_until(self, tvshow_reference: str, stop,
+                    validators: Validators = None) -> list:
+        """
+        Fetches the episode files of the specified TV show, in the order they
+        are listed by the source, until the first file for which *stop*
+        returns True. That file and all files after it are not included.
+
+        Sources listing files from newest to oldest can use this to stop
+        obtaining files once they reach files already known. By default,
+        all files are fetched and then the ones after the stop are dropped.
+
+        Sources requesting feeds conditionally return a Feed, with the
+        validators to give back as *validators* in the next fetch. Other
+        sources ignore the *validators*.
+
+        :param tvshow_reference: reference that uniquely identifies the TV show
+                                 to get the episodes for
+        :param stop: function called with each episode file, returning True
+                     to stop fetching files
+        :param validators: validators of the Feed returned by the last fetch
+                           of the TV show, if any
+        :return: a list containing the episode files fetched before the stop
         :raise TVShowNotFound: if the specified reference does not match to any
                                TV show available
         """
+        files = self.fetch(tvshow_reference)
+        return list(takewhile(lambda file: not stop(file), files))
+
+
+class AsyncEpisodeSource(ABC):
+    """
+    Abstract base class to define the interface for asynchronous episode
+    sources, used by the AsyncTracker.
+
+    This is the same interface as EpisodeSource's, but fetches are
+    coroutines, so that a single thread can wait for many of them at once.
+    Implementations must not block the event loop while waiting for the
+    network.
+    """
+
+    @abstractmethod
+    async def fetch(self, tvshow_reference: str) -> list:
+        """
+        Fetches all available episode files, corresponding to the specified
+        TV show. See EpisodeSource.fetch().
+        """
+
+    async def fetch_until(self, tvshow_reference: str, stop,
+                          validators: Validators = None) -> list:
+        """
+        Fetches the episode files of the specified TV show, in the order they
+        are listed by the source, until the first file for which *stop*
+        returns True. See EpisodeSource.fetch_until().
+        """
+        files = await self.fetch(tvshow_reference)
+        return list(takewhile(lambda file: not stop(file), files))
+
+
+class AsyncSourceAdapter(AsyncEpisodeSource):
+    """
+    Asynchronous source running the fetches of a blocking EpisodeSource in
+    the *executor* (by default, the event loop's default executor). This
+    allows the AsyncTracker to use any EpisodeSource, although each fetch in
+    flight then takes a thread.
+    """
+
+    def __init__(self, source: EpisodeSource, executor=None):
+        self.source = source
+        self.executor = executor
+
+    def __repr__(self):
+        return f"AsyncSourceAdapter({self.source!r})"
+
+    async def fetch(self, tvshow_reference: str) -> list:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self.source.fetch, tvshow_reference)
+
+    async def fetch_until(self, tvshow_reference: str, stop,
+                          validators: Validators = None) -> list:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, self.source.fetch_until, tvshow_reference, stop,
+            validators)
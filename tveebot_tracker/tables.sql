@@ -1,7 +1,8 @@
 CREATE TABLE IF NOT EXISTS tvshow (
-  id      TEXT PRIMARY KEY,
-  name    TEXT,
-  quality TEXT
+  id                 TEXT PRIMARY KEY,
+  name               TEXT,
+  quality            TEXT,
+  priority           INTEGER NOT NULL DEFAULT 0
 );
 
 
@@ -31,3 +32,24 @@ CREATE TABLE IF NOT EXISTS file (
   PRIMARY KEY (tvshow_id, season, number)
 );
 
+
+CREATE TABLE IF NOT EXISTS watermark (
+  tvshow_id          TEXT PRIMARY KEY,
+  link               TEXT NOT NULL,
+
+  FOREIGN KEY (tvshow_id) REFERENCES tvshow ON DELETE CASCADE
+);
+
+
+CREATE TABLE IF NOT EXISTS download_queue (
+  position           INTEGER PRIMARY KEY AUTOINCREMENT,
+  tvshow_id          TEXT NOT NULL,
+  season             INTEGER NOT NULL,
+  number             INTEGER NOT NULL,
+  leased             INTEGER NOT NULL DEFAULT 0,
+
+  FOREIGN KEY (tvshow_id, season, number) REFERENCES episode
+    ON DELETE CASCADE,
+
+  UNIQUE (tvshow_id, season, number)
+);
@@ -0,0 +1,32 @@
+from unittest.mock import MagicMock
+
+from pytest import fixture
+
+from tveebot_tracker.episode_db import EpisodeDB
+
+
+@fixture
+def config(tmpdir):
+    """
+    Configuration with a database in *tmpdir* and small limits for the
+    tracker and the downloader. Modules needing other values override
+    this fixture with one that changes them.
+    """
+    config = MagicMock()
+    config.db_file = str(tmpdir.join("episodes.db"))
+    config.db_profile = "default"
+    config.track_period = 5.0
+    config.max_track_period = 60.0
+    config.fetch_workers = 4
+    config.max_concurrent_fetches = 8
+    config.shards = 2
+    config.download_dir = str(tmpdir)
+    config.max_active_downloads = 2
+    config.download_cache_size = 16
+    return config
+
+
+@fixture
+def db(config):
+    # noinspection PyTypeChecker
+    return EpisodeDB(config)
@@ -0,0 +1,174 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+
+import pytest
+
+from tveebot_tracker.composite_source import CompositeSource
+from tveebot_tracker.episode import EpisodeFile, Quality
+from tveebot_tracker.showrss_source import ShowRSSSource
+from tveebot_tracker.source import TVShowNotFoundError
+
+
+def feed(*titles: str) -> bytes:
+    items = "".join(f"<item><title>{title}</title>"
+                    f"<link>magnet:{title}</link></item>" for title in titles)
+    return f"<rss><channel>{items}</channel></rss>".encode()
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    """
+    Serves the feed of the server for TV show '1', after the delay of the
+    server
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+
+        if self.path != "/show/1.rss":
+            self.send_error(404)
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(self.server.feed)))
+            self.end_headers()
+            self.wfile.write(self.server.feed)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mirrors():
+    servers = []
+
+    def start(body: bytes, delay: float = 0.) -> ShowRSSSource:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), MirrorHandler)
+        server.feed = body
+        server.delay = delay
+        servers.append(server)
+
+        # Poll often, not to slow down the shutdown of each test
+        Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        return ShowRSSSource("http://127.0.0.1:%d/show" % server.server_port)
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_FilesFromAllMirrors_AreMergedWithoutCopies(mirrors):
+    source = CompositeSource([
+        mirrors(feed("Show 1x02 720p", "Show 1x01 720p")),
+        mirrors(feed("Show 1x02 720p", "Show 1x02", "Show 1x01 720p"),
+                delay=0.2),
+    ], merge_window=1.0)
+
+    files = source.fetch("1")
+
+    assert files == [
+        EpisodeFile("Show 1x02", "magnet:Show 1x02 720p", Quality.HD),
+        EpisodeFile("Show 1x01", "magnet:Show 1x01 720p", Quality.HD),
+        EpisodeFile("Show 1x02", "magnet:Show 1x02", Quality.SD),
+    ]
+
+
+def test_SlowMirror_DoesNotStallTheFetch(mirrors):
+    source = CompositeSource([
+        mirrors(feed("Show 1x02"), delay=1.0),
+        mirrors(feed("Show 1x01")),
+    ], timeout=0.3)
+
+    start = time.monotonic()
+    files = source.fetch("1")
+
+    assert time.monotonic() - start < 0.9
+    assert [file.title for file in files] == ["Show 1x01"]
+
+
+def test_MirrorWithLongerTimeout_IsWaitedFor(mirrors):
+    source = CompositeSource([
+        (mirrors(feed("Show 1x02"), delay=0.5), 5.0),
+        mirrors(feed("Show 1x01")),
+    ], timeout=0.1, merge_window=1.0)
+
+    files = source.fetch("1")
+
+    assert [file.title for file in files] == ["Show 1x01", "Show 1x02"]
+
+
+def test_FastestMirrorAnswered_SlowerMirrorsAreNotWaitedFor(mirrors):
+    source = CompositeSource([
+        mirrors(feed("Show 1x02"), delay=1.0),
+        mirrors(feed("Show 1x01")),
+    ])
+
+    start = time.monotonic()
+    files = source.fetch("1")
+
+    assert time.monotonic() - start < 0.9
+    assert [file.title for file in files] == ["Show 1x01"]
+
+
+def test_HangingMirror_DoesNotTakeTheWorkersOfOtherMirrors(mirrors):
+    source = CompositeSource([
+        (mirrors(feed("Show 1x01")), 1.0),
+        (mirrors(feed("Show 1x02"), delay=1.0), 0.1),
+    ], max_workers=2)
+
+    def fetch_many() -> list:
+        return [source.fetch("1") for _ in range(5)]
+
+    try:
+        with ThreadPoolExecutor(8) as callers:
+            results = [files for fetches in
+                       callers.map(lambda _: fetch_many(), range(8))
+                       for files in fetches]
+    finally:
+        source.close()
+
+    assert all([file.title for file in files] == ["Show 1x01"]
+               for files in results)
+    assert len(results) == 40
+
+
+def test_MirrorRefusingConnections_OtherMirrorsAreStillUsed(mirrors):
+    source = CompositeSource([
+        ShowRSSSource("http://127.0.0.1:1/show"),
+        mirrors(feed("Show 1x01")),
+    ])
+
+    assert [file.title for file in source.fetch("1")] == ["Show 1x01"]
+
+
+def test_TVShowNotFoundInAnyMirror_RaisesTVShowNotFoundError(mirrors):
+    source = CompositeSource([
+        mirrors(feed("Show 1x01")),
+        ShowRSSSource("http://127.0.0.1:1/show"),
+    ])
+
+    with pytest.raises(TVShowNotFoundError):
+        source.fetch("2")
+
+
+def test_NoMirrorAnswersInTime_RaisesConnectionError(mirrors):
+    source = CompositeSource([mirrors(feed("Show 1x01"), delay=1.0)],
+                             timeout=0.1)
+
+    with pytest.raises(ConnectionError):
+        source.fetch("1")
+
+
+def test_FetchUntil_StopsEachMirrorAtTheStopFile(mirrors):
+    source = CompositeSource([
+        mirrors(feed("Show 1x03", "Show 1x02", "Show 1x01")),
+        mirrors(feed("Show 1x04", "Show 1x02"), delay=0.2),
+    ], merge_window=1.0)
+
+    files = source.fetch_until("1", stop=lambda f: f.title == "Show 1x02")
+
+    assert [file.title for file in files] == ["Show 1x03", "Show 1x04"]
@@ -0,0 +1,121 @@
+import os
+from pathlib import Path
+from threading import Thread
+
+import pytest
+from pytest import fixture
+
+from tveebot_tracker.config import Config, ConfigWatcher
+
+
+@fixture
+def config_file(tmpdir):
+    return tmpdir.join("config.ini")
+
+
+@fixture
+def config(config_file):
+    config_file.write("[tracker]\nTrackPeriod = 10.0\n")
+    config = Config()
+    config.load_defaults()
+    config.load(str(config_file))
+    return config
+
+
+def test_LoadedFile_OverridesTheDefaults(config):
+    assert config.track_period == 10.0
+    assert config.max_track_period == 86400.0
+    assert config.db_file == Path("episodes.db")
+
+
+def test_Settings_IsAnImmutableSnapshot(config):
+    settings = config.settings
+
+    with pytest.raises(AttributeError):
+        settings.track_period = 1.0
+
+    assert config.settings is settings
+
+
+def test_Reload_UpdatesTheSettingsAndNotifiesTheListeners(config,
+                                                          config_file):
+    changes = []
+    config.add_listener(lambda old, new: changes.append(
+        (old.track_period, new.track_period)))
+
+    config_file.write("[tracker]\nTrackPeriod = 20.0\n")
+
+    assert config.reload()
+    assert config.track_period == 20.0
+    assert changes == [(10.0, 20.0)]
+
+
+def test_ReloadWithoutChanges_ListenersAreNotNotified(config):
+    changes = []
+    config.add_listener(lambda old, new: changes.append(new))
+
+    assert not config.reload()
+    assert changes == []
+
+
+def test_InvalidValue_RaisesValueErrorAndKeepsTheSettings(config,
+                                                          config_file):
+    settings = config.settings
+    config_file.write("[tracker]\nTrackPeriod = soon\n")
+
+    with pytest.raises(ValueError):
+        config.reload()
+
+    assert config.settings is settings
+
+
+def test_ConcurrentLoadsAndReloads_KeepEveryFileLoaded(config, tmpdir):
+    files = []
+    for index in range(8):
+        file = tmpdir.join(f"config{index}.ini")
+        file.write(f"[tracker]\nTrackPeriod = {index + 1}.0\n")
+        files.append(str(file))
+
+    threads = [Thread(target=config.load, args=(file,)) for file in files]
+    threads += [Thread(target=config.reload) for _ in files]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(config.files[2:]) == sorted(files)
+
+
+def test_MissingParameter_RaisesValueError(config_file):
+    config_file.write("[tracker]\nTrackPeriod = 10.0\n")
+
+    with pytest.raises(ValueError):
+        Config().load(str(config_file))
+
+
+def test_Watcher_ReloadsOnlyWhenAFileChanges(config, config_file):
+    watcher = ConfigWatcher(config)
+    assert not watcher.check()
+
+    config_file.write("[tracker]\nTrackPeriod = 30.0\n")
+    # Make sure the change is seen even if it happened within the same tick
+    # of the file system's clock
+    stat = os.stat(str(config_file))
+    os.utime(str(config_file), ns=(stat.st_atime_ns,
+                                   stat.st_mtime_ns + 10 ** 9))
+
+    assert watcher.check()
+    assert config.track_period == 30.0
+    assert not watcher.check()
+
+
+def test_Watcher_InvalidFile_KeepsTheSettings(config, config_file):
+    watcher = ConfigWatcher(config)
+
+    config_file.write("[tracker]\nTrackPeriod = soon\n")
+    stat = os.stat(str(config_file))
+    os.utime(str(config_file), ns=(stat.st_atime_ns,
+                                   stat.st_mtime_ns + 10 ** 9))
+
+    assert not watcher.check()
+    assert config.track_period == 10.0
@@ -0,0 +1,125 @@
+import time
+from queue import Empty
+from threading import Thread
+
+from pytest import fixture, raises
+
+from tveebot_tracker.download_queue import DownloadQueue
+from tveebot_tracker.episode import TVShow, Quality, Episode, EpisodeFile
+from tveebot_tracker.episode_db import connect
+
+
+class TestDownloadQueue:
+    @fixture
+    def queue(self, db):
+        return DownloadQueue(db)
+
+    @fixture
+    def episodes(self, db):
+        tvshow = TVShow("#1", "My Show")
+        episodes = [Episode(tvshow, f"Episode {i}", 1, i) for i in range(1, 4)]
+
+        with connect(db) as connection:
+            connection.insert_tvshow(tvshow, Quality.SD)
+            connection.insert_episodes(episodes)
+            connection.insert_files(
+                (episode, EpisodeFile(episode.title,
+                                      f"magnet:{episode.number}", Quality.SD))
+                for episode in episodes)
+
+        return episodes
+
+    def test_EpisodesPutInTheQueue_AreGottenInTheSameOrder(
+            self, queue, episodes):
+        queue.put(episodes)
+
+        assert [queue.get_nowait()[0] for _ in episodes] == episodes
+        with raises(Empty):
+            queue.get_nowait()
+
+    def test_GetManyWithLimit_LeavesTheRestAvailable(self, queue, episodes):
+        queue.put(episodes)
+
+        first = queue.get_many(limit=2)
+        rest = queue.get_many()
+
+        assert [episode for episode, _ in first + rest] == episodes
+        assert queue.get_many() == []
+
+    def test_EpisodesPutByOtherConnection_AreGottenAfterNotify(
+            self, db, queue, episodes):
+        assert queue.get_many() == []
+
+        with connect(db) as connection:
+            connection.enqueue_downloads(episodes[:1])
+
+        # The fast path skips the DB until it is notified
+        assert queue.get_many() == []
+        queue.notify()
+        assert [episode for episode, _ in queue.get_many()] == episodes[:1]
+
+    def test_EpisodesPutByOtherQueue_AreGottenAfterThePollPeriod(
+            self, db, episodes):
+        producer = DownloadQueue(db)
+        consumer = DownloadQueue(db, poll_period=0.05)
+        assert consumer.get_many() == []
+
+        producer.put(episodes[:1])
+        assert len(consumer) == 1
+
+        time.sleep(0.05)
+        assert [episode for episode, _ in consumer.get_many(3)] == \
+            episodes[:1]
+
+    def test_GettingEpisodePutByOtherQueue_DoesNotBlockUntilTheTimeout(
+            self, db, episodes):
+        producer = DownloadQueue(db)
+        consumer = DownloadQueue(db, poll_period=0.05)
+        assert consumer.get_many() == []
+
+        putter = Thread(target=producer.put, args=(episodes[:1],))
+        putter.start()
+
+        start = time.monotonic()
+        episode, _ = consumer.get(timeout=5.0)
+        putter.join()
+
+        assert episode == episodes[0]
+        assert time.monotonic() - start < 1.0
+
+    def test_GettingFromEmptyQueue_BlocksUntilAnEpisodeIsPut(
+            self, queue, episodes):
+        putter = Thread(target=queue.put, args=(episodes[:1],))
+        putter.start()
+
+        episode, file = queue.get(timeout=5.0)
+        putter.join()
+
+        assert episode == episodes[0]
+        assert file.link == "magnet:1"
+
+    def test_GettingFromEmptyQueueWithTimeout_RaisesEmpty(self, queue):
+        with raises(Empty):
+            queue.get(timeout=0.01)
+
+    def test_ReleasedEpisode_IsGottenAgain(self, queue, episodes):
+        queue.put(episodes[:1])
+        episode, _ = queue.get_nowait()
+
+        queue.release(episode)
+
+        assert queue.get_nowait()[0] == episode
+
+    def test_EpisodesNotAcknowledged_AreRecoveredByANewQueue(
+            self, db, queue, episodes):
+        queue.put(episodes)
+        queue.get_many()
+        queue.ack(episodes[1])
+
+        # Simulates a restart
+        new_queue = DownloadQueue(db)
+        new_queue.recover()
+
+        assert len(new_queue) == 2
+        assert [episode for episode, _ in new_queue.get_many()] == \
+            [episodes[0], episodes[2]]
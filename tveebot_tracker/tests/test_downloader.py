@@ -0,0 +1,246 @@
+import importlib
+import sys
+from types import ModuleType, SimpleNamespace
+
+from pytest import fixture
+
+from tveebot_tracker.download_queue import DownloadQueue
+from tveebot_tracker.episode import TVShow, Quality, Episode, EpisodeFile, \
+    State
+from tveebot_tracker.episode_db import connect
+
+
+class FakeHandle:
+    """ Handle of a torrent, whose info-hash is its magnet link """
+
+    def __init__(self, link: str):
+        self.link = link
+
+    def info_hash(self) -> str:
+        return self.link
+
+    def status(self):
+        return status(self.link)
+
+
+def status(link: str, rate: int = 0, downloaded: int = 0):
+    """ Status of the torrent of *link* """
+    return SimpleNamespace(info_hash=link, download_payload_rate=rate,
+                           total_payload_download=downloaded)
+
+
+class FakeSession:
+    """
+    Torrent session keeping the torrents added to it, which never post any
+    alerts. It calls *on_wait* every time the downloader waits for alerts.
+    It counts the requests for status updates of the torrents.
+    """
+
+    def __init__(self):
+        self.torrents = {}
+        self.on_wait = None
+        self.updates_requested = 0
+
+    def add_torrent(self, link: str) -> FakeHandle:
+        handle = FakeHandle(link)
+        self.torrents[link] = handle
+        return handle
+
+    def remove_torrent(self, handle: FakeHandle):
+        del self.torrents[handle.link]
+
+    def wait_for_alert(self, timeout: int):
+        if self.on_wait is not None:
+            self.on_wait()
+
+    def pop_alerts(self) -> list:
+        return []
+
+    def post_torrent_updates(self):
+        self.updates_requested += 1
+
+    def listen_on(self, *ports):
+        pass
+
+    def set_alert_mask(self, mask):
+        pass
+
+    def apply_settings(self, settings: dict):
+        pass
+
+
+class TorrentAlert:
+    def __init__(self, handle: FakeHandle):
+        self.handle = handle
+
+    def message(self) -> str:
+        return f"{type(self).__name__} for {self.handle.link}"
+
+
+class TorrentFinishedAlert(TorrentAlert):
+    pass
+
+
+class TorrentErrorAlert(TorrentAlert):
+    pass
+
+
+class MetadataReceivedAlert(TorrentAlert):
+    pass
+
+
+class StateUpdateAlert:
+    def __init__(self, statuses: list):
+        self.status = statuses
+
+    def message(self) -> str:
+        return f"{len(self.status)} torrents changed"
+
+
+def libtorrent_stub() -> ModuleType:
+    """ Returns a stub of the parts of libtorrent used by the downloader """
+    lt = ModuleType('libtorrent')
+    lt.session = FakeSession
+    lt.alert = SimpleNamespace(category_t=SimpleNamespace(
+        status_notification=1, error_notification=2))
+    lt.storage_mode_t = SimpleNamespace(storage_mode_sparse=0)
+    lt.add_magnet_uri = \
+        lambda session, link, params: session.add_torrent(link)
+    lt.torrent_alert = TorrentAlert
+    lt.torrent_finished_alert = TorrentFinishedAlert
+    lt.torrent_error_alert = TorrentErrorAlert
+    lt.metadata_received_alert = MetadataReceivedAlert
+    lt.state_update_alert = StateUpdateAlert
+    return lt
+
+
+@fixture
+def downloader_module(monkeypatch):
+    # The downloader is imported again with the stub in place of libtorrent,
+    # which may not even be installed
+    monkeypatch.setitem(sys.modules, 'libtorrent', libtorrent_stub())
+    monkeypatch.delitem(sys.modules, 'tveebot_tracker.downloader',
+                        raising=False)
+    return importlib.import_module('tveebot_tracker.downloader')
+
+
+@fixture
+def queue(db):
+    return DownloadQueue(db)
+
+
+@fixture
+def episodes(db, queue):
+    tvshow = TVShow("#1", "My Show")
+    episodes = [Episode(tvshow, f"Episode {i}", 1, i) for i in range(1, 4)]
+
+    with connect(db) as connection:
+        connection.insert_tvshow(tvshow, Quality.SD)
+        connection.insert_episodes(episodes)
+        connection.insert_files(
+            (episode, EpisodeFile(episode.title, f"magnet:{episode.number}",
+                                  Quality.SD))
+            for episode in episodes)
+
+    queue.put(episodes)
+    return episodes
+
+
+@fixture
+def downloader(downloader_module, db, config, queue):
+    return downloader_module.Downloader(db, config, queue)
+
+
+def start_download(downloader) -> tuple:
+    """ Starts downloading the next episode in the queue """
+    episode, file = downloader.queue.get_nowait()
+    downloader.download(episode, file)
+    return episode, downloader.session.torrents[file.link]
+
+
+def episodes_in_state(db, state: State) -> list:
+    with connect(db) as connection:
+        return list(connection.episodes_in_state(state))
+
+
+def test_FinishedAlert_AcksTheEpisodeAndMarksItDownloaded(
+        downloader, db, episodes):
+    episode, handle = start_download(downloader)
+
+    downloader._handle_alert(TorrentFinishedAlert(handle))
+
+    assert episodes_in_state(db, State.DOWNLOADED) == [episode]
+    assert len(downloader.queue) == len(episodes) - 1
+    assert downloader.session.torrents == {}
+    assert downloader._handles == {}
+
+
+def test_AlertOfUnknownTorrent_IsIgnored(downloader, db, episodes):
+    episode, handle = start_download(downloader)
+
+    downloader._handle_alert(TorrentFinishedAlert(FakeHandle("magnet:9")))
+    downloader._handle_alert(TorrentErrorAlert(FakeHandle("magnet:9")))
+
+    assert episodes_in_state(db, State.DOWNLOADING) == [episode]
+    assert downloader.session.torrents == {"magnet:1": handle}
+    assert len(downloader.queue) == len(episodes)
+
+
+def test_ErrorAlert_RemovesTheTorrentAndRequeuesTheEpisode(
+        downloader, db, episodes):
+    episode, handle = start_download(downloader)
+
+    downloader._handle_alert(TorrentErrorAlert(handle))
+
+    assert downloader.session.torrents == {}
+    assert downloader._handles == {}
+    assert episode in episodes_in_state(db, State.QUEUED)
+
+    # The episode is retried after the other episodes in the queue
+    leased = [episode for episode, _ in downloader.queue.get_many()]
+    assert leased == episodes[1:] + [episode]
+
+
+def test_Run_LeasesOnlyAsManyEpisodesAsFreeSlots(downloader, episodes):
+    downloader.session.on_wait = downloader.stop
+
+    downloader.run()
+
+    assert sorted(downloader.session.torrents) == ["magnet:1", "magnet:2"]
+    assert [episode for episode, _ in downloader.queue.get_many()] == \
+        episodes[2:]
+
+
+def sample(metric) -> float:
+    return metric.samples()[0][1]
+
+
+def test_UpdateMetrics_RequestsTheStatusInsteadOfPollingTorrents(
+        downloader_module, downloader, episodes):
+    start_download(downloader)
+    start_download(downloader)
+
+    downloader._update_metrics()
+    downloader._update_metrics()  # within the metrics period
+
+    assert downloader.session.updates_requested == 1
+    assert sample(downloader_module.active_torrents) == 2
+
+
+def test_StateUpdateAlert_UpdatesTheDownloadMetrics(
+        downloader_module, downloader, episodes):
+    start_download(downloader)
+    start_download(downloader)
+    downloaded = downloader_module.downloaded_bytes
+    before = sample(downloaded) if downloaded.samples() else 0
+
+    downloader._handle_alert(StateUpdateAlert(
+        [status("magnet:1", rate=10, downloaded=100),
+         status("magnet:2", rate=20, downloaded=50)]))
+    # Only the torrents that changed are posted, the others keep their rate
+    downloader._handle_alert(StateUpdateAlert(
+        [status("magnet:1", rate=5, downloaded=150),
+         status("magnet:9", rate=99, downloaded=999)]))
+
+    assert sample(downloader_module.download_rate) == 25
+    assert sample(downloaded) - before == 200
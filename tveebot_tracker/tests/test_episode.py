@@ -1,6 +1,7 @@
 import pytest
 
-from tveebot_tracker.episode import Episode, TVShow
+from tveebot_tracker.episode import Episode, TVShow, Quality, parse_title, \
+    parse_titles, parse_file_title, EpisodeFile
 from tveebot_tracker.exceptions import ParseError
 
 
@@ -32,7 +33,9 @@ def test_ParseEpisodeTitle_ReturnCorrespondingEpisode(
         expected_number
     )
 
-    assert Episode.from_title(title, tvshow_id="#1") == expected_episode
+    # Equal episodes may have different titles: compare all fields
+    assert tuple(Episode.from_title(title, tvshow_id="#1")) == \
+        tuple(expected_episode)
 
 
 @pytest.mark.parametrize("title", [
@@ -50,3 +53,109 @@ def test_ParseEpisodeTitle_RaisesParseError(title):
 
     with pytest.raises(ParseError):
         Episode.from_title(title, tvshow_id="#1")
+
+
+@pytest.mark.parametrize(
+    "title, expected_title, expected_quality, expected_flags", [
+        ("Prison Break 5x09 Behind Eyes", "Behind Eyes", Quality.SD, set()),
+        ("Prison Break 5x09 720p", "", Quality.HD, set()),
+        ("Prison Break 5x09 Eyes 1080p", "Eyes", Quality.FHD, set()),
+        ("Prison Break 5x09 Eyes 720p PROPER", "Eyes", Quality.HD,
+         {"PROPER"}),
+        ("Prison Break 5x09 Eyes REPACK 720p", "Eyes", Quality.HD,
+         {"REPACK"}),
+        ("Prison Break 5x09 PROPER Eyes", "PROPER Eyes", Quality.SD, set()),
+        ("Prison Break 5x09 Eyes 1080pA", "Eyes 1080pA", Quality.SD, set()),
+    ])
+def test_ParseTitle_ReturnsTitleQualityAndFlags(
+        title, expected_title, expected_quality, expected_flags):
+
+    info = parse_title(title)
+
+    assert (info.tvshow_name, info.season, info.number) == \
+        ("Prison Break", 5, 9)
+    assert info.title == expected_title
+    assert info.quality == expected_quality
+    assert info.flags == expected_flags
+
+
+def test_ParseTitles_ReturnsInformationOfEachTitleInOrder():
+    infos = parse_titles(["Show 1x02", "Show 1x01 720p"])
+
+    assert [(info.number, info.quality) for info in infos] == \
+        [(2, Quality.SD), (1, Quality.HD)]
+
+
+def test_ParseTitlesWithOneInvalidTitle_RaisesParseError():
+    with pytest.raises(ParseError):
+        parse_titles(["Show 1x02", "Show"])
+
+
+@pytest.mark.parametrize(
+    "title, expected_title, expected_quality, expected_flags", [
+        ("Show 1x01 Eyes 720p", "Show 1x01 Eyes", Quality.HD, set()),
+        ("Show 1x01 Eyes 1080p PROPER", "Show 1x01 Eyes PROPER",
+         Quality.FHD, {"PROPER"}),
+        ("Show 1x01 Eyes", "Show 1x01 Eyes", Quality.SD, set()),
+    ])
+def test_ParseFileTitle_SplitsTheQualityAndKeepsTheInfo(
+        title, expected_title, expected_quality, expected_flags):
+
+    file_title, quality, info = parse_file_title(title)
+
+    assert (file_title, quality) == (expected_title, expected_quality)
+    assert info == parse_title(title)
+    assert info.flags == expected_flags
+
+
+def test_ParseFileTitleWithoutEpisode_HasNoInfo():
+    assert parse_file_title("Show Eyes 720p") == \
+        ("Show Eyes", Quality.HD, None)
+
+
+def test_FilesWithDifferentInfo_AreEqual():
+    file = EpisodeFile("Show 1x01", "magnet:1", Quality.SD)
+    parsed = EpisodeFile("Show 1x01", "magnet:1", Quality.SD,
+                         parse_title("Show 1x01"))
+
+    assert file == parsed
+    assert hash(file) == hash(parsed)
+
+
+def test_EpisodesFromTitles_ShareTheTVShow():
+    episodes = Episode.from_titles(["Show 1x02", "Show 1x01"], tvshow_id="#1")
+
+    assert [tuple(episode) for episode in episodes] == [
+        (TVShow("#1", "Show"), "", 1, 2),
+        (TVShow("#1", "Show"), "", 1, 1),
+    ]
+    assert episodes[0].tvshow is episodes[1].tvshow
+
+
+def test_EpisodesWithTheSameKey_AreEqualAndHaveTheSameHash():
+    episode = Episode(TVShow("#1", "Show"), "Pilot", 1, 1)
+    same_key = Episode(TVShow("#1", "Other Name"), "Other Title", 1, 1)
+
+    assert episode == same_key
+    assert hash(episode) == hash(same_key)
+    assert {episode, same_key} == {episode}
+
+
+@pytest.mark.parametrize("other", [
+    Episode(TVShow("#2", "Show"), "Pilot", 1, 1),
+    Episode(TVShow("#1", "Show"), "Pilot", 2, 1),
+    Episode(TVShow("#1", "Show"), "Pilot", 1, 2),
+])
+def test_EpisodesWithDifferentKeys_AreNotEqual(other):
+    episode = Episode(TVShow("#1", "Show"), "Pilot", 1, 1)
+
+    assert episode != other
+    assert other not in {episode}
+
+
+def test_Episode_IsImmutable():
+    episode = Episode(TVShow("#1", "Show"), "Pilot", 1, 1)
+
+    with pytest.raises(AttributeError):
+        # noinspection PyPropertyAccess
+        episode.title = "Other Title"
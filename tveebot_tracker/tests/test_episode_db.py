@@ -1,8 +1,12 @@
+import inspect
+import sqlite3
+from datetime import datetime, timedelta
 from unittest.mock import MagicMock
 
 from pytest import fixture, raises
 
-from tveebot_tracker.episode import TVShow, Quality, Episode, State
+from tveebot_tracker.episode import TVShow, Quality, Episode, State, \
+    EpisodeFile
 from tveebot_tracker.episode_db import connect, EpisodeDB, EntryExistsError, \
     EntryNotFoundError
 
@@ -13,14 +17,32 @@ def assert_lists_equal(list1: list, list2: list):
         assert item in list2
 
 
-class TestEpisodeDB:
-    @fixture
-    def db(self, tmpdir):
-        config = MagicMock()
-        config.db_file = str(tmpdir.join("episodes.db"))
-        # noinspection PyTypeChecker
-        return EpisodeDB(config)
+def query_plan(conn, method, *args) -> list:
+    """
+    Calls a method of a connection and returns the query plan of each query
+    it executes, as a list of plan details
+    """
+    statements = []
+    # noinspection PyProtectedMember
+    sqlite_conn = conn._conn
+    sqlite_conn.set_trace_callback(statements.append)
+    try:
+        result = method(*args)
+        if inspect.isgenerator(result):
+            list(result)
+    finally:
+        sqlite_conn.set_trace_callback(None)
+
+    plan = []
+    for statement in statements:
+        if statement.split(None, 1)[0].upper() in ('SELECT', 'INSERT'):
+            plan.extend(row[3] for row in sqlite_conn.execute(
+                'EXPLAIN QUERY PLAN ' + statement))
+
+    return plan
 
+
+class TestEpisodeDB:
     @fixture
     def conn(self, db):
         with connect(db) as conn:
@@ -175,7 +197,7 @@ class TestEpisodeDB:
             Episode(tvshow1, "Show1-1x2", 1, 2)
         ]
 
-        assert_lists_equal(expected_episodes, conn.episodes_from('#1'))
+        assert_lists_equal(expected_episodes, list(conn.episodes_from('#1')))
 
     def test_SettingStateFromNullToDownloading_EpisodeStateIsDownloading(
             self, conn):
@@ -206,4 +228,427 @@ class TestEpisodeDB:
 
         conn.insert_episode(Episode(tvshow1, "Show1-1x2", 1, 2))
 
-        assert not conn.episode_exists(Episode(tvshow1, "Show1-1x1", 1, 2))
+        assert conn.episode_exists(Episode(tvshow1, "Show1-1x1", 1, 2))
+
+    def test_EpisodeInsertedAndCommitted_ExistsForOtherConnections(self, db):
+        tvshow1 = TVShow("#1", "My Show 1")
+        with connect(db) as conn:
+            conn.insert_tvshow(tvshow1, Quality.SD)
+            conn.insert_episode(Episode(tvshow1, "Show1-1x1", 1, 1))
+
+        with connect(db) as conn:
+            assert conn.episode_exists(Episode(tvshow1, "Show1-1x1", 1, 1))
+
+    def test_EpisodeInsertedAndRolledBack_DoesNotExist(self, db):
+        tvshow1 = TVShow("#1", "My Show 1")
+        with connect(db) as conn:
+            conn.insert_tvshow(tvshow1, Quality.SD)
+
+        with connect(db) as conn:
+            conn.insert_episode(Episode(tvshow1, "Show1-1x1", 1, 1))
+            conn.rollback()
+
+            assert not conn.episode_exists(Episode(tvshow1, "Show1-1x1", 1, 1))
+
+    def test_InsertingEpisodesWithOneAlreadyInDB_InsertsNone(self, conn):
+        tvshow1 = TVShow("#1", "My Show 1")
+        conn.insert_tvshow(tvshow1, Quality.SD)
+        conn.insert_episode(Episode(tvshow1, "Show1-1x2", 1, 2))
+
+        with raises(EntryExistsError):
+            conn.insert_episodes([
+                Episode(tvshow1, "Show1-1x1", 1, 1),
+                Episode(tvshow1, "Show1-1x2", 1, 2),
+            ])
+
+        assert list(conn.episodes()) == [Episode(tvshow1, "Show1-1x2", 1, 2)]
+        assert not conn.episode_exists(Episode(tvshow1, "Show1-1x1", 1, 1))
+
+    def test_SettingStatesOfMultipleEpisodes_AllStatesAreSet(self, conn):
+        tvshow1 = TVShow("#1", "My Show 1")
+        conn.insert_tvshow(tvshow1, Quality.SD)
+        episodes = [Episode(tvshow1, f"Show1-1x{n}", 1, n) for n in (1, 2)]
+        conn.insert_episodes(episodes)
+
+        conn.set_episode_states([(episodes[0], State.QUEUED),
+                                 (episodes[1], State.DOWNLOADED)])
+
+        states = conn.episodes(include_state=True)
+        assert sorted(state for _, state in states) == \
+            [State.DOWNLOADED.tag, State.QUEUED.tag]
+
+    def test_ChangesInTransactionThatFails_AreRolledBack(self, db):
+        tvshow1 = TVShow("#1", "My Show 1")
+        with connect(db) as conn:
+            conn.insert_tvshow(tvshow1, Quality.SD)
+
+        with connect(db) as conn:
+            with raises(EntryNotFoundError):
+                with conn.transaction():
+                    conn.insert_episodes([Episode(tvshow1, "Show1-1x1", 1, 1)])
+                    conn.set_episode_states(
+                        [(Episode(tvshow1, "Show1-1x2", 1, 2), State.QUEUED)])
+
+        with connect(db) as conn:
+            assert list(conn.episodes()) == []
+            assert not conn.episode_exists(Episode(tvshow1, "Show1-1x1", 1, 1))
+
+    def test_SettingDownloadTimestampOfEpisodeWithFile_DoesNotRaiseError(
+            self, conn):
+        tvshow1 = TVShow("#1", "My Show 1")
+        conn.insert_tvshow(tvshow1, Quality.SD)
+        episode = Episode(tvshow1, "Show1-1x1", 1, 1)
+        conn.insert_episode(episode)
+        conn.insert_file(episode, EpisodeFile("Show1-1x1", "magnet:1",
+                                              Quality.SD))
+
+        conn.set_download_timestamp(episode, datetime.now())
+
+    def test_SettingDownloadTimestampOfEpisodeWithoutFile_RaisesError(
+            self, conn):
+        tvshow1 = TVShow("#1", "My Show 1")
+        conn.insert_tvshow(tvshow1, Quality.SD)
+        episode = Episode(tvshow1, "Show1-1x1", 1, 1)
+        conn.insert_episode(episode)
+
+        with raises(EntryNotFoundError):
+            conn.set_download_timestamp(episode, datetime.now())
+
+    def test_ConnectionsOpenedOneAfterTheOther_ReuseTheSameSQLiteConnection(
+            self, db):
+        # noinspection PyProtectedMember
+        with connect(db) as conn1:
+            sqlite_conn1 = conn1._conn
+        # noinspection PyProtectedMember
+        with connect(db) as conn2, connect(db) as conn3:
+            assert conn2._conn is sqlite_conn1
+            assert conn3._conn is not sqlite_conn1
+
+    def test_ConnectionInUseWhenTheDBIsClosed_IsClosedOnceReturned(self, db):
+        conn = connect(db)
+        # noinspection PyProtectedMember
+        sqlite_conn = conn._conn
+
+        db.close()
+        conn.close()
+
+        with raises(sqlite3.ProgrammingError):
+            sqlite_conn.execute('SELECT 1')
+        # noinspection PyProtectedMember
+        assert db._idle_connections == []
+
+    def test_ConnectionClosedWithoutCommitting_ChangesAreDiscarded(self, db):
+        conn = connect(db)
+        conn.insert_tvshow(TVShow("#1", "My Show"), Quality.SD)
+        conn.close()
+
+        with connect(db) as conn:
+            assert list(conn.tvshows()) == []
+
+    def test_PerformanceProfile_DBUsesWriteAheadLog(self, config):
+        config.db_profile = "performance"
+        # noinspection PyTypeChecker
+        db = EpisodeDB(config)
+
+        # noinspection PyProtectedMember
+        with connect(db) as conn:
+            journal_mode, = \
+                conn._conn.execute('PRAGMA journal_mode').fetchone()
+
+        assert journal_mode == "wal"
+
+    def test_UnknownProfile_RaisesValueError(self, config):
+        config.db_profile = "turbo"
+
+        with raises(ValueError):
+            # noinspection PyTypeChecker
+            EpisodeDB(config)
+
+    def test_EpisodesInDBFile_AreIndexedWhenTheDBIsOpened(self, db, config):
+        tvshow1 = TVShow("#1", "My Show 1")
+        with connect(db) as conn:
+            conn.insert_tvshow(tvshow1, Quality.SD)
+            conn.insert_episode(Episode(tvshow1, "Show1-1x1", 1, 1))
+
+        # noinspection PyTypeChecker
+        reopened_db = EpisodeDB(config)
+
+        assert ("#1", 1, 1) in reopened_db.index
+        assert len(reopened_db.index) == 1
+
+    def queue_episodes(self, conn, count: int) -> list:
+        tvshow1 = TVShow("#1", "My Show 1")
+        conn.insert_tvshow(tvshow1, Quality.SD)
+
+        episodes = [Episode(tvshow1, f"Show1-1x{i}", 1, i)
+                    for i in range(1, count + 1)]
+        conn.insert_episodes(episodes)
+        conn.insert_files(
+            (episode, EpisodeFile(episode.title, f"magnet:{episode.number}",
+                                  Quality.SD))
+            for episode in episodes)
+        conn.enqueue_downloads(episodes)
+
+        return episodes
+
+    def test_LeasingDownloads_ReturnsEpisodesInQueueOrder(self, conn):
+        episodes = self.queue_episodes(conn, count=3)
+
+        leased = conn.lease_downloads(limit=2)
+
+        assert [episode for episode, _ in leased] == episodes[:2]
+        assert [file.link for _, file in leased] == ["magnet:1", "magnet:2"]
+
+    def test_LeasedDownloads_AreNotLeasedAgainUntilReleased(self, conn):
+        episodes = self.queue_episodes(conn, count=2)
+        conn.lease_downloads()
+
+        assert conn.lease_downloads() == []
+        assert conn.download_queue_size() == 2
+
+        conn.release_downloads()
+        assert [episode for episode, _ in conn.lease_downloads()] == episodes
+
+    def test_AcknowledgedDownload_LeavesTheQueue(self, conn):
+        episodes = self.queue_episodes(conn, count=2)
+        conn.lease_downloads()
+
+        conn.ack_download(episodes[0])
+        conn.release_downloads()
+
+        assert [episode for episode, _ in conn.lease_downloads()] == \
+            episodes[1:]
+
+    def test_ReleasedDownload_IsLeasedAgainAfterTheOthers(self, conn):
+        episodes = self.queue_episodes(conn, count=3)
+        conn.lease_downloads(limit=2)
+
+        conn.release_download(episodes[0])
+
+        assert [episode for episode, _ in conn.lease_downloads()] == \
+            [episodes[2], episodes[0]]
+        assert conn.download_queue_size() == 3
+
+    def test_ReleasingEpisodeNotInQueue_RaisesEntryNotFoundError(self, conn):
+        episodes = self.queue_episodes(conn, count=1)
+        conn.ack_download(episodes[0])
+
+        with raises(EntryNotFoundError):
+            conn.release_download(episodes[0])
+
+    def test_AcknowledgingEpisodeNotInQueue_RaisesEntryNotFoundError(
+            self, conn):
+        episodes = self.queue_episodes(conn, count=1)
+        conn.ack_download(episodes[0])
+
+        with raises(EntryNotFoundError):
+            conn.ack_download(episodes[0])
+
+    def test_RecoveringDownloads_RequeuesQueuedAndDownloadingEpisodes(
+            self, conn):
+        episodes = self.queue_episodes(conn, count=3)
+        conn.set_episode_states([(episodes[0], State.DOWNLOADING),
+                                 (episodes[1], State.DOWNLOADED),
+                                 (episodes[2], State.QUEUED)])
+        for episode, _ in conn.lease_downloads():
+            conn.ack_download(episode)
+
+        conn.recover_downloads()
+
+        assert [episode for episode, _ in conn.lease_downloads()] == \
+            [episodes[0], episodes[2]]
+
+    def test_DownloadQueue_SurvivesReopeningTheDB(self, db, config):
+        with connect(db) as conn:
+            episodes = self.queue_episodes(conn, count=2)
+            conn.lease_downloads(limit=1)
+        db.close()
+
+        # noinspection PyTypeChecker
+        reopened_db = EpisodeDB(config)
+        with connect(reopened_db) as conn:
+            conn.recover_downloads()
+            leased = conn.lease_downloads()
+
+        assert [episode for episode, _ in leased] == episodes
+
+    def test_LeasingDownloads_EpisodesOfHigherPriorityTVShowsComeFirst(
+            self, conn):
+        episodes = self.queue_episodes(conn, count=2)
+        tvshow2 = TVShow("#2", "My Show 2")
+        conn.insert_tvshow(tvshow2, Quality.SD, priority=1)
+        episode2 = Episode(tvshow2, "Show2-1x1", 1, 1)
+        conn.insert_episode(episode2)
+        conn.insert_file(episode2, EpisodeFile("Show2-1x1", "magnet:2-1",
+                                               Quality.SD))
+        conn.enqueue_downloads([episode2])
+
+        leased = conn.lease_downloads()
+
+        assert [episode for episode, _ in leased] == [episode2] + episodes
+
+    def test_ChangingTVShowPriority_ChangesTheOrderOfItsQueuedEpisodes(
+            self, conn):
+        episodes = self.queue_episodes(conn, count=1)
+        tvshow2 = TVShow("#2", "My Show 2")
+        conn.insert_tvshow(tvshow2, Quality.SD, priority=1)
+        episode2 = Episode(tvshow2, "Show2-1x1", 1, 1)
+        conn.insert_episode(episode2)
+        conn.insert_file(episode2, EpisodeFile("Show2-1x1", "magnet:2-1",
+                                               Quality.SD))
+        conn.enqueue_downloads([episode2])
+
+        conn.set_tvshow_priority("#1", 2)
+
+        assert [episode for episode, _ in conn.lease_downloads()] == \
+            episodes + [episode2]
+
+    def test_DBCreatedBeforeTVShowPriorities_IsUpgraded(self, config):
+        with sqlite3.connect(config.db_file) as sqlite_conn:
+            sqlite_conn.execute(
+                'CREATE TABLE tvshow (id TEXT PRIMARY KEY, name TEXT, '
+                '                     quality TEXT)')
+            sqlite_conn.execute(
+                "INSERT INTO tvshow VALUES ('#1', 'A', '480p')")
+        sqlite_conn.close()
+
+        # noinspection PyTypeChecker
+        db = EpisodeDB(config)
+        with connect(db) as conn:
+            conn.set_tvshow_priority("#1", 1)
+            assert list(conn.tvshows()) == [(TVShow("#1", "A"), Quality.SD)]
+
+    def test_ListingManyEpisodes_YieldsAllEpisodesSharingTheirTVShow(
+            self, conn):
+        tvshow1 = TVShow("#1", "My Show 1")
+        conn.insert_tvshow(tvshow1, Quality.SD)
+        conn.insert_episodes(Episode(tvshow1, f"Show1-{season}x{number}",
+                                     season, number)
+                             for season in range(1, 11)
+                             for number in range(1, 101))
+
+        episodes = list(conn.episodes())
+
+        assert len(episodes) == 1000
+        assert len(set(episodes)) == 1000
+        assert all(episode.tvshow is episodes[0].tvshow
+                   for episode in episodes)
+
+    def test_ListingEpisodesWithState_YieldsEachEpisodeAndItsState(
+            self, conn):
+        tvshow1 = TVShow("#1", "My Show 1")
+        conn.insert_tvshow(tvshow1, Quality.SD)
+        episode = Episode(tvshow1, "Show1-1x1", 1, 1)
+        conn.insert_episode(episode)
+        conn.set_episode_state(episode, State.QUEUED)
+
+        assert [(tuple(episode), state)
+                for episode, state in conn.episodes(include_state=True)] == \
+            [(tuple(episode), State.QUEUED.tag)]
+
+    def test_NewDB_IsMigratedToTheLatestSchemaVersion(self, db, conn):
+        assert conn.schema_version() == len(db.migrations())
+
+    def test_MigratingDBInTheLatestVersion_AppliesNoMigration(self, conn):
+        migration = MagicMock()
+
+        conn.migrate([migration] * conn.schema_version())
+
+        migration.assert_not_called()
+
+    def test_FailedMigration_IsRolledBackAndKeepsTheSchemaVersion(self, conn):
+        def add_table(connection):
+            # noinspection PyProtectedMember
+            connection._conn.execute('CREATE TABLE extra (id INTEGER)')
+
+        def fail(_):
+            raise sqlite3.OperationalError("failed migration")
+
+        version = conn.schema_version()
+        with raises(sqlite3.OperationalError):
+            conn.migrate([None] * version + [add_table, fail])
+
+        assert conn.schema_version() == version + 1
+        assert conn.table_columns('extra') == ['id']
+
+        with raises(sqlite3.OperationalError):
+            conn.migrate([None] * (version + 1) + [fail])
+        assert conn.schema_version() == version + 1
+
+    def test_DBCreatedBeforeSchemaVersions_GetsTheIndexes(self, config):
+        with sqlite3.connect(config.db_file) as sqlite_conn:
+            sqlite_conn.execute(
+                'CREATE TABLE episode (tvshow_id TEXT, season INTEGER, '
+                '  number INTEGER, title TEXT NOT NULL, state TEXT, '
+                '  PRIMARY KEY (tvshow_id, season, number))')
+        sqlite_conn.close()
+
+        # noinspection PyTypeChecker
+        db = EpisodeDB(config)
+        with connect(db) as conn:
+            plan = query_plan(conn, conn.episodes_in_state, State.QUEUED)
+
+        assert any('episode_state' in detail for detail in plan)
+
+    def test_SettingValidators_AreRetrievedUntilTheTVShowIsDeleted(
+            self, conn):
+        conn.insert_tvshow(TVShow("#1", "My Show 1"), Quality.SD)
+        conn.insert_tvshow(TVShow("#2", "My Show 2"), Quality.SD)
+
+        conn.set_validators([("#1", ('"v1"', None)),
+                             ("#2", (None, "Mon, 01 Jan 2018"))])
+        conn.set_validators([("#1", ('"v2"', None))])
+        conn.delete_tvshow("#2")
+
+        assert conn.validators() == {"#1": ('"v2"', None)}
+
+    def test_SettingValidatorsOfTVShowNotInDB_RaisesEntryNotFoundError(
+            self, conn):
+        with raises(EntryNotFoundError):
+            conn.set_validators([("#1", ('"v1"', None))])
+
+    def test_ListingEpisodesInState_YieldsOnlyEpisodesInThatState(
+            self, conn):
+        tvshow1 = TVShow("#1", "My Show 1")
+        conn.insert_tvshow(tvshow1, Quality.SD)
+        episodes = [Episode(tvshow1, f"Show1-1x{i}", 1, i) for i in (1, 2)]
+        conn.insert_episodes(episodes)
+        conn.set_episode_states([(episodes[0], State.DOWNLOADED),
+                                 (episodes[1], State.QUEUED)])
+
+        assert list(conn.episodes_in_state(State.QUEUED)) == episodes[1:]
+        assert list(conn.episodes_in_state(State.DOWNLOADING)) == []
+
+    def test_Downloads_YieldsDownloadedEpisodesMostRecentFirst(self, conn):
+        episodes = self.queue_episodes(conn, count=3)
+        now = datetime.now().replace(microsecond=0)
+        conn.set_download_timestamp(episodes[0], now - timedelta(days=2))
+        conn.set_download_timestamp(episodes[1], now)
+
+        assert list(conn.downloads()) == [(episodes[1], now),
+                                          (episodes[0], now - timedelta(2))]
+        assert list(conn.downloads(since=now - timedelta(days=1))) == \
+            [(episodes[1], now)]
+
+    def test_RecoveringDownloads_UsesThePartialIndexOfEpisodesToDownload(
+            self, conn):
+        plan = query_plan(conn, conn.recover_downloads)
+
+        assert 'SCAN episode USING INDEX episode_not_downloaded' in plan
+
+    def test_ListingEpisodesInState_SearchesTheStateIndex(self, conn):
+        plan = query_plan(conn, conn.episodes_in_state, State.QUEUED)
+
+        assert 'SEARCH episode USING INDEX episode_state (state=?)' in plan
+
+    def test_DownloadHistory_SearchesTheDownloadTimestampIndex(self, conn):
+        plan = query_plan(conn, conn.downloads, datetime.now())
+
+        assert 'SEARCH file USING INDEX file_download_timestamp ' \
+               '(download_timestamp>?)' in plan
+        assert not any('TEMP B-TREE' in detail for detail in plan)
+
+    def test_ListingEpisodesFromTVShow_DoesNotScanEpisodes(self, conn):
+        plan = query_plan(conn, conn.episodes_from, "#1")
+
+        assert not any(detail.startswith('SCAN') for detail in plan)
@@ -0,0 +1,197 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+
+import pytest
+
+from tveebot_tracker.guarded_source import TokenBucket, CircuitBreaker, \
+    CircuitOpenError, GuardedSource
+from tveebot_tracker.showrss_source import ShowRSSSource
+from tveebot_tracker.source import EpisodeSource, TVShowNotFoundError, \
+    UpstreamError
+
+
+class FakeClock:
+    """ Clock that only moves when told to, or when sleeping """
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+class FlakySource(EpisodeSource):
+    """ Source raising the errors it is given, in order, then succeeding """
+
+    def __init__(self, *errors: Exception):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def fetch(self, tvshow_reference: str) -> list:
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+
+        return []
+
+
+class UnavailableHandler(BaseHTTPRequestHandler):
+    """ Answers every request with 503 (Service Unavailable) """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests += 1
+        self.send_error(503)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def unavailable_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), UnavailableHandler)
+    server.requests = 0
+    server.url = "http://127.0.0.1:%d/show" % server.server_port
+
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def guarded(source: EpisodeSource, clock: FakeClock) -> GuardedSource:
+    return GuardedSource(
+        source,
+        TokenBucket(rate=1000, clock=clock, sleep=clock.sleep),
+        CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock))
+
+
+class TestTokenBucket:
+
+    def test_FullBucket_AllowsABurstWithoutWaiting(self, clock):
+        bucket = TokenBucket(rate=2, capacity=3, clock=clock,
+                             sleep=clock.sleep)
+
+        for _ in range(3):
+            bucket.acquire()
+
+        assert clock.now == 0.
+
+    def test_EmptyBucket_WaitsForTheNextToken(self, clock):
+        bucket = TokenBucket(rate=2, capacity=1, clock=clock,
+                             sleep=clock.sleep)
+
+        for _ in range(3):
+            bucket.acquire()
+
+        assert clock.now == pytest.approx(1.)
+
+    def test_IdleBucket_IsRefilledUpToItsCapacity(self, clock):
+        bucket = TokenBucket(rate=2, capacity=2, clock=clock,
+                             sleep=clock.sleep)
+        bucket.acquire()
+        bucket.acquire()
+
+        clock.now = 100.
+        for _ in range(3):
+            bucket.acquire()
+
+        assert clock.now == pytest.approx(100.5)
+
+
+class TestGuardedSource:
+
+    def test_ConnectionErrorsUpToTheThreshold_OpenTheBreaker(self, clock):
+        source = guarded(FlakySource(ConnectionError(), ConnectionError()),
+                         clock)
+
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                source.fetch("1")
+
+        assert source.breaker.state == CircuitBreaker.OPEN
+
+    def test_OpenBreaker_FailsWithoutCallingTheSource(self, clock):
+        flaky = FlakySource(ConnectionError(), ConnectionError())
+        source = guarded(flaky, clock)
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                source.fetch("1")
+
+        with pytest.raises(CircuitOpenError):
+            source.fetch("1")
+
+        assert flaky.calls == 2
+
+    def test_SuccessfulProbe_ClosesTheBreaker(self, clock):
+        flaky = FlakySource(ConnectionError(), ConnectionError())
+        source = guarded(flaky, clock)
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                source.fetch("1")
+
+        clock.now += 10
+        assert source.breaker.state == CircuitBreaker.HALF_OPEN
+
+        assert source.fetch("1") == []
+        assert source.breaker.state == CircuitBreaker.CLOSED
+
+    def test_FailedProbe_ReopensTheBreaker(self, clock):
+        flaky = FlakySource(*[ConnectionError()] * 3)
+        source = guarded(flaky, clock)
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                source.fetch("1")
+
+        clock.now += 10
+        with pytest.raises(ConnectionError):
+            source.fetch("1")
+
+        assert source.breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpenError):
+            source.fetch("1")
+
+        assert flaky.calls == 3
+
+    def test_HalfOpenBreaker_LetsASingleProbeThrough(self, clock):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10,
+                                 clock=clock)
+        breaker.failure()
+        clock.now += 10
+
+        assert breaker.allow()
+        assert not breaker.allow()
+
+    def test_TVShowNotFound_DoesNotCountAsAFailure(self, clock):
+        flaky = FlakySource(ConnectionError(), TVShowNotFoundError("1"),
+                            ConnectionError())
+        source = guarded(flaky, clock)
+
+        for error in (ConnectionError, TVShowNotFoundError, ConnectionError):
+            with pytest.raises(error):
+                source.fetch("1")
+
+        assert source.breaker.state == CircuitBreaker.CLOSED
+
+    def test_ShowRSSUnavailable_OpensTheBreaker(self, clock,
+                                                unavailable_server):
+        source = guarded(ShowRSSSource(unavailable_server.url), clock)
+
+        for _ in range(2):
+            with pytest.raises(UpstreamError):
+                source.fetch("1")
+
+        with pytest.raises(CircuitOpenError):
+            source.fetch("1")
+
+        assert source.breaker.state == CircuitBreaker.OPEN
+        assert unavailable_server.requests == 2
@@ -0,0 +1,175 @@
+import json
+from urllib.request import urlopen
+
+import pytest
+
+from tveebot_tracker import metrics
+from tveebot_tracker.episode import TVShow, Quality
+from tveebot_tracker.episode_db import connect, db_seconds
+from tveebot_tracker.metrics import Registry, MetricsServer
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+def value(metric, **labels):
+    for sample_labels, sample_value in metric.samples():
+        if sample_labels == {name: str(value)
+                             for name, value in labels.items()}:
+            return sample_value
+
+
+def test_Counter_IsIncrementedPerLabelValue(registry):
+    counter = metrics.counter('requests_total', "Requests", ['host'],
+                              registry=registry)
+
+    counter.inc(host='a')
+    counter.inc(2, host='a')
+    counter.inc(host='b')
+
+    assert value(counter, host='a') == 3
+    assert value(counter, host='b') == 1
+
+
+def test_Counter_CanNotBeDecremented(registry):
+    counter = metrics.counter('requests_total', "Requests", registry=registry)
+
+    with pytest.raises(ValueError):
+        counter.inc(-1)
+
+
+def test_MissingLabel_RaisesValueError(registry):
+    counter = metrics.counter('requests_total', "Requests", ['host'],
+                              registry=registry)
+
+    with pytest.raises(ValueError):
+        counter.inc()
+
+
+def test_Gauge_GoesUpAndDown(registry):
+    gauge = metrics.gauge('queue_depth', "Depth", registry=registry)
+
+    gauge.set(5)
+    gauge.inc(2)
+    gauge.dec()
+
+    assert value(gauge) == 6
+
+
+def test_Histogram_CountsObservationsInCumulativeBuckets(registry):
+    histogram = metrics.histogram('latency', "Latency", buckets=(1, 5),
+                                  registry=registry)
+
+    for observation in (0.5, 1, 3, 10):
+        histogram.observe(observation)
+
+    assert value(histogram) == {
+        'buckets': {'1': 2, '5': 3, '+Inf': 4},
+        'sum': 14.5,
+        'count': 4,
+    }
+
+
+def test_SameName_ReturnsTheSameMetric(registry):
+    first = metrics.counter('requests_total', "Requests", registry=registry)
+    second = metrics.counter('requests_total', "Requests", registry=registry)
+
+    assert first is second
+
+
+def test_SameNameWithAnotherType_RaisesValueError(registry):
+    metrics.counter('requests_total', "Requests", registry=registry)
+
+    with pytest.raises(ValueError):
+        metrics.gauge('requests_total', "Requests", registry=registry)
+
+
+def test_Timed_GeneratorFunction_ObservesOnceExhausted(registry):
+    histogram = metrics.histogram('duration', "Duration", registry=registry)
+
+    @metrics.timed(histogram)
+    def items():
+        yield from range(3)
+
+    generator = items()
+    assert value(histogram) is None
+
+    assert list(generator) == [0, 1, 2]
+    assert value(histogram)['count'] == 1
+
+
+def test_Timed_FunctionRaising_IsStillObserved(registry):
+    histogram = metrics.histogram('duration', "Duration", registry=registry)
+
+    @metrics.timed(histogram)
+    def fail():
+        raise RuntimeError()
+
+    with pytest.raises(RuntimeError):
+        fail()
+
+    assert value(histogram)['count'] == 1
+
+
+def test_ToPrometheus_FormatsEveryMetric(registry):
+    metrics.counter('requests_total', "Requests\nmade", ['host'],
+                    registry=registry).inc(host='a"b')
+    metrics.histogram('latency', "Latency", buckets=(1,),
+                      registry=registry).observe(0.5)
+
+    assert registry.to_prometheus() == (
+        '# HELP requests_total Requests\\nmade\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{host="a\\"b"} 1\n'
+        '# HELP latency Latency\n'
+        '# TYPE latency histogram\n'
+        'latency_bucket{le="1"} 1\n'
+        'latency_bucket{le="+Inf"} 1\n'
+        'latency_sum 0.5\n'
+        'latency_count 1\n'
+    )
+
+
+def test_Dump_JSONFile_WritesTheSnapshot(registry, tmpdir):
+    metrics.gauge('queue_depth', "Depth", registry=registry).set(3)
+    file = tmpdir.join("metrics.json")
+
+    registry.dump(str(file))
+
+    assert json.loads(file.read()) == {
+        'queue_depth': {
+            'type': 'gauge',
+            'help': "Depth",
+            'samples': [{'labels': {}, 'value': 3}],
+        }
+    }
+
+
+def test_MetricsServer_ServesBothFormats(registry):
+    metrics.gauge('queue_depth', "Depth", registry=registry).set(3)
+    server = MetricsServer(('127.0.0.1', 0), registry)
+    server.start()
+
+    try:
+        url = "http://%s:%d" % server.address
+        with urlopen(url + "/metrics") as response:
+            assert b"queue_depth 3" in response.read()
+
+        with urlopen(url + "/metrics.json") as response:
+            assert json.load(response)['queue_depth']['samples'][0] == \
+                {'labels': {}, 'value': 3}
+    finally:
+        server.stop()
+
+
+def test_ConnectionMethods_AreTimed(db):
+    before = value(db_seconds, method='tvshows') or {'count': 0}
+    with connect(db) as connection:
+        connection.insert_tvshow(TVShow("1", "Show"), Quality.SD)
+        list(connection.tvshows())
+
+    assert value(db_seconds, method='tvshows')['count'] == \
+        before['count'] + 1
+    assert value(db_seconds, method='insert_tvshow') is not None
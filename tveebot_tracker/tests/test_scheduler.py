@@ -0,0 +1,98 @@
+from pytest import fixture
+
+from tveebot_tracker.scheduler import PollScheduler
+
+DAY = 24 * 3600.0
+
+
+class TestPollScheduler:
+    @fixture
+    def scheduler(self):
+        return PollScheduler(min_period=60.0, max_period=DAY)
+
+    def test_NewTVShows_AreDueRightAway(self, scheduler):
+        scheduler.add("#1", now=0.)
+        scheduler.add("#2", now=0.)
+
+        assert sorted(scheduler.due(now=0.)) == ["#1", "#2"]
+        assert scheduler.due(now=0.) == []
+
+    def test_TVShowWithoutChanges_IsCheckedExponentiallyLessOften(
+            self, scheduler):
+        scheduler.add("#1", now=0.)
+        now = 0.
+
+        intervals = []
+        for _ in range(15):
+            assert scheduler.due(now) == ["#1"]
+            scheduler.checked("#1", changed=False, now=now)
+
+            intervals.append(scheduler.next_check() - now)
+            now = scheduler.next_check()
+
+        assert intervals[:4] == [120., 240., 480., 960.]
+        assert intervals[-1] == DAY
+
+    def test_FailedChecks_DoNotBackOff(self, scheduler):
+        scheduler.add("#1", now=0.)
+        scheduler.due(0.)
+        scheduler.checked("#1", changed=False, now=0.)
+
+        for now in (120., 240., 360.):
+            assert scheduler.due(now) == ["#1"]
+            scheduler.failed("#1", now=now)
+            assert scheduler.next_check() == now + 120.
+
+    def test_TVShowThatChanged_IsCheckedAtMinPeriodAgain(self, scheduler):
+        scheduler.add("#1", now=0.)
+        for now in (0., 120., 360.):
+            scheduler.due(now)
+            scheduler.checked("#1", changed=False, now=now)
+
+        scheduler.due(840.)
+        scheduler.checked("#1", changed=True, now=840.)
+
+        assert scheduler.next_check() == 900.
+
+    def test_DormantTVShowWithWeeklyEpisodes_IsCheckedWhenTheNextIsDue(
+            self, scheduler):
+        week = 7 * DAY
+        scheduler.add("#1", now=0.)
+        scheduler.due(0.)
+        scheduler.checked("#1", changed=True, now=0.)
+        scheduler.checked("#1", changed=True, now=week)
+
+        # Back off until the next check would be past the next episode
+        now = week
+        while scheduler.next_check() < 2 * week:
+            now = scheduler.next_check()
+            scheduler.due(now)
+            scheduler.checked("#1", changed=False, now=now)
+
+        assert scheduler.next_check() == 2 * week
+
+        # Once the episode is due, the TV show is checked often
+        scheduler.due(2 * week)
+        scheduler.checked("#1", changed=False, now=2 * week)
+        assert scheduler.next_check() == 2 * week + 60.
+
+    def test_RemovedTVShow_IsNoLongerDue(self, scheduler):
+        scheduler.add("#1", now=0.)
+        scheduler.add("#2", now=0.)
+
+        scheduler.remove("#1")
+
+        assert scheduler.due(now=0.) == ["#2"]
+        assert scheduler.next_check() is None
+
+    def test_SetPeriods_ChecksScheduledLaterAreBroughtForward(self, scheduler):
+        scheduler.add("#1", now=0.)
+        for now in (0., 120., 360.):
+            scheduler.due(now)
+            scheduler.checked("#1", changed=False, now=now)
+        assert scheduler.next_check() == 360. + 480.
+
+        scheduler.set_periods(min_period=10.0, max_period=100.0, now=400.)
+
+        assert scheduler.next_check() == 500.
+        assert scheduler.due(now=500.) == ["#1"]
@@ -0,0 +1,126 @@
+import os
+from functools import partial
+
+from tveebot_tracker.download_queue import DownloadQueue
+from tveebot_tracker.episode import TVShow, Quality, EpisodeFile
+from tveebot_tracker.episode_db import connect
+from tveebot_tracker.sharded_tracker import ShardedTracker, shard_of
+from tveebot_tracker.source import EpisodeSource, TVShowNotFoundError, \
+    Feed, Validators
+
+
+class FeedSource(EpisodeSource):
+    """
+    Source returning a file of a new episode of each TV show, except for
+    the TV shows listed in *errors*, which fail with the given exception,
+    and those listed in *crashes*, which kill the worker process
+    """
+
+    def __init__(self, errors: dict = None, crashes: set = None):
+        self.errors = errors or {}
+        self.crashes = crashes or set()
+
+    def fetch(self, tvshow_reference: str) -> list:
+        return self.fetch_until(tvshow_reference, stop=lambda file: False)
+
+    def fetch_until(self, tvshow_reference: str, stop,
+                    validators: Validators = None) -> list:
+        if tvshow_reference in self.crashes:
+            os._exit(1)
+
+        if tvshow_reference in self.errors:
+            raise self.errors[tvshow_reference]
+
+        # The feed of each TV show never changes
+        current = Validators(f'"{tvshow_reference}"', None)
+        if validators == current:
+            return Feed([], current)
+
+        title = f"Show {tvshow_reference} 1x01"
+        return Feed([EpisodeFile(title, f"magnet:{title}", Quality.SD)],
+                    current)
+
+
+def tracker(db, config, source_factory, tvshows: int) -> ShardedTracker:
+    tracker = ShardedTracker(source_factory, db, DownloadQueue(db), config)
+    for tvshow_id in range(1, tvshows + 1):
+        tracker.add_tvshow(TVShow(str(tvshow_id), f"Show {tvshow_id}"))
+    return tracker
+
+
+def queued(tracker: ShardedTracker) -> list:
+    return sorted(episode.tvshow.id
+                  for episode, _ in tracker._queue.get_many())
+
+
+def test_ShardOf_IsWithinRangeAndStable():
+    assert {shard_of(str(tvshow_id), 3) for tvshow_id in range(100)} == \
+        {0, 1, 2}
+    assert shard_of("1", 4) == shard_of("1", 4) == 3
+
+
+def test_Track_NewEpisodesFromAllShards_AreQueued(db, config):
+    sharded = tracker(db, config, FeedSource, tvshows=6)
+
+    try:
+        new_files = sharded.track()
+    finally:
+        sharded.close()
+
+    assert new_files == {str(tvshow_id): 1 for tvshow_id in range(1, 7)}
+    assert queued(sharded) == ["1", "2", "3", "4", "5", "6"]
+
+
+def test_ValidatorsReturnedByTheWorkers_AreStoredByTheCoordinator(
+        db, config):
+    sharded = tracker(db, config, FeedSource, tvshows=4)
+
+    try:
+        sharded.track()
+        with connect(db) as connection:
+            validators = connection.validators()
+
+        # The validators are sent back to the workers, whose feeds then
+        # have nothing new
+        new_files = sharded.track()
+    finally:
+        sharded.close()
+
+    assert validators == {str(tvshow_id): (f'"{tvshow_id}"', None)
+                          for tvshow_id in range(1, 5)}
+    assert new_files == {str(tvshow_id): 0 for tvshow_id in range(1, 5)}
+
+
+def test_ErrorsOfSomeTVShows_OtherTVShowsAreStillTracked(db, config):
+    sharded = tracker(db, config, partial(FeedSource, errors={
+        "2": TVShowNotFoundError("not found"),
+        "3": ConnectionRefusedError("unreachable"),
+    }), tvshows=4)
+
+    try:
+        new_files = sharded.track()
+    finally:
+        sharded.close()
+
+    assert set(new_files) == {"1", "4"}
+    assert queued(sharded) == ["1", "4"]
+
+
+def test_WorkerCrashes_OtherShardIsTrackedAndWorkerRestarted(db, config):
+    crashing = "1"
+    other = next(str(tvshow_id) for tvshow_id in range(2, 100)
+                 if shard_of(str(tvshow_id), 2) != shard_of(crashing, 2))
+    sharded = tracker(db, config, partial(FeedSource, crashes={crashing}),
+                      tvshows=int(other))
+
+    try:
+        assert other in sharded.track()
+        assert queued(sharded) == [other]
+
+        # The restarted worker checks the rest of the TV shows of its shard
+        sharded.remove_tvshow(crashing)
+        sharded.track()
+    finally:
+        sharded.close()
+
+    assert len(queued(sharded)) == int(other) - 2
@@ -1,8 +1,18 @@
+import asyncio
+import gzip
+import io
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+
 import pytest
 
 from tveebot_tracker.episode import EpisodeFile, Quality
 from tveebot_tracker.exceptions import ParseError
-from tveebot_tracker.showrss_source import parse_item, parse_feed
+from tveebot_tracker.showrss_source import parse_item, parse_items, \
+    parse_feed, iter_feed, ShowRSSSource, AsyncShowRSSSource
+from tveebot_tracker.source import TVShowNotFoundError, UpstreamError, \
+    Validators
 
 
 @pytest.mark.parametrize("feed, expected_files", [
@@ -64,6 +74,19 @@ def test_ParseFeed_RaisesParseError(feed):
         parse_feed(feed)
 
 
+def test_IterFeedFromStream_YieldsEachFileAsItsItemIsParsed():
+    items = "".join(f"<item><title>Show 1x{number:02d}</title>"
+                    f"<link>magnet_link{number}</link></item>"
+                    for number in range(1, 1001))
+    stream = io.BytesIO(f"<rss><channel>{items}</channel></rss>".encode())
+
+    files = iter_feed(stream)
+
+    assert next(files) == EpisodeFile("Show 1x01", "magnet_link1", Quality.SD)
+    assert stream.tell() < len(stream.getvalue())  # feed was not all read
+    assert len(list(files)) == 999
+
+
 @pytest.mark.parametrize("title, expected_title, expected_quality", [
     ("Prison Break 5x09", "Prison Break 5x09", Quality.SD),
     ("Prison Break 5x09 720", "Prison Break 5x09 720", Quality.SD),
@@ -79,6 +102,9 @@ def test_ParseFeed_RaisesParseError(feed):
     ("Prison Break 5x09 1080p REPACK", "Prison Break 5x09 REPACK", Quality.FHD),
     ("Prison Break 5x09 720p TBA", "Prison Break 5x09 TBA", Quality.HD),
     ("Prison Break 5x09 1080p TBA", "Prison Break 5x09 TBA", Quality.FHD),
+    ("Prison Break 5x09 Title 720p", "Prison Break 5x09 Title", Quality.HD),
+    ("Prison Break 720p", "Prison Break", Quality.HD),
+    ("720p", "", Quality.HD),
     ("", "", Quality.SD),
 ])
 def test_ParseItem_ReturnCorrespondingEpisodeFile(
@@ -90,3 +116,259 @@ def test_ParseItem_ReturnCorrespondingEpisodeFile(
 
     assert parse_item(item) == EpisodeFile(expected_title, 'magnet://link',
                                            expected_quality)
+
+
+def test_ParseItems_ReturnEpisodeFilesInTheSameOrder():
+    items = [
+        {'title': "Prison Break 5x09 720p", 'link': "magnet:1"},
+        {'title': "Prison Break 5x08", 'link': "magnet:2"},
+    ]
+
+    assert parse_items(items) == [
+        EpisodeFile("Prison Break 5x09", "magnet:1", Quality.HD),
+        EpisodeFile("Prison Break 5x08", "magnet:2", Quality.SD),
+    ]
+
+
+FEED = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<rss version="2.0" xmlns:tv="https://showrss.info">'
+    '<channel>'
+    '<item>'
+    '<title>Prison Break 5x09 720p</title>'
+    '<link>magnet_link1</link>'
+    '</item>'
+    '</channel>'
+    '</rss>'
+).encode()
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    """
+    Serves FEED for TV show '1' supporting conditional requests, persistent
+    connections and gzip encoding. For TV show '3' it serves FEED with
+    chunked transfer encoding. For TV show '5' it is unavailable, it
+    redirects the feed of TV show '6', and it sends an invalid length for
+    the feed of TV show '7'.
+    """
+
+    protocol_version = "HTTP/1.1"
+    ETAG = '"feed-1"'
+
+    def handle(self):
+        self.server.connections += 1
+        super().handle()
+
+    def do_GET(self):
+        if self.path == "/show/3.rss":
+            self.send_response(200)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for start in range(0, len(FEED), 50):
+                chunk = FEED[start:start + 50]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        elif self.path == "/show/5.rss":
+            self.send_error(503)
+        elif self.path == "/show/7.rss":
+            self.send_response(200)
+            self.send_header('Content-Length', "many")
+            self.end_headers()
+            self.wfile.write(FEED)
+        elif self.path == "/show/6.rss":
+            self.send_response(301)
+            self.send_header('Location', "/show/1.rss")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path != "/show/1.rss":
+            self.send_error(404)
+        elif self.headers.get('If-None-Match') == self.ETAG:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            body = FEED
+            self.send_response(200)
+            self.send_header('ETag', self.ETAG)
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body)
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+    server.connections = 0
+    server.url = "http://127.0.0.1:%d/show" % server.server_port
+
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_FetchUnchangedFeed_ReturnsNoFilesWithoutParsing(server):
+    source = ShowRSSSource(server.url)
+
+    feed = source.fetch("1")
+    assert feed == [
+        EpisodeFile("Prison Break 5x09", "magnet_link1", Quality.HD)]
+    assert feed.validators == (FeedHandler.ETAG, None)
+
+    unchanged = source.fetch("1", validators=feed.validators)
+    assert unchanged == []
+    assert unchanged.validators == feed.validators
+
+
+def test_FetchWithoutValidators_SourceDoesNotKeepThem(server):
+    source = ShowRSSSource(server.url)
+
+    source.fetch("1")
+
+    assert len(source.fetch("1")) == 1
+
+
+def test_FetchUnknownTVShow_RaisesTVShowNotFoundError(server):
+    source = ShowRSSSource(server.url)
+
+    with pytest.raises(TVShowNotFoundError):
+        source.fetch("2")
+
+
+def test_FetchWhileShowRSSIsUnavailable_RaisesUpstreamError(server):
+    source = ShowRSSSource(server.url)
+
+    with pytest.raises(UpstreamError):
+        source.fetch("5")
+
+
+def test_RedirectedFeed_RaisesUpstreamError(server):
+    source = ShowRSSSource(server.url)
+
+    with pytest.raises(UpstreamError):
+        source.fetch("6")
+
+
+@pytest.mark.parametrize("reference", [
+    "1.rss HTTP/1.1\r\nX-Injected: 1\r\n\r\nGET /show/1",
+    "../show/1",
+    "1?",
+])
+def test_FetchWithReferenceOutsideOfThePath_RaisesTVShowNotFoundError(
+        server, reference):
+    source = ShowRSSSource(server.url)
+
+    with pytest.raises(TVShowNotFoundError):
+        source.fetch(reference)
+
+    with pytest.raises(TVShowNotFoundError):
+        asyncio.run(AsyncShowRSSSource(server.url).fetch(reference))
+
+
+def test_FetchWithValidatorsInjectingHeaders_RaisesValueError(server):
+    validators = Validators('"1"\r\nX-Injected: 1', None)
+
+    with pytest.raises(ValueError):
+        ShowRSSSource(server.url).fetch("1", validators)
+
+    with pytest.raises(ValueError):
+        asyncio.run(AsyncShowRSSSource(server.url).fetch("1", validators))
+
+
+def test_MultipleFetches_ReuseTheSameConnection(server):
+    source = ShowRSSSource(server.url)
+
+    for _ in range(5):
+        source.fetch("1")
+
+    assert server.connections == 1
+
+
+def test_FetchFromMultipleThreads_AllFetchesSucceed(server):
+    source = ShowRSSSource(server.url)
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda _: source.fetch("1"), range(64)))
+
+    assert all(len(files) == 1 for files in results)
+    assert server.connections <= 8
+
+
+def test_FetchUntilKnownFile_ReturnsOnlyFilesBeforeIt(server):
+    source = ShowRSSSource(server.url)
+
+    files = source.fetch_until("1", stop=lambda f: f.link == "magnet_link1")
+
+    assert files == []
+    assert files.validators == (FeedHandler.ETAG, None)
+
+
+def test_AsyncFetchUnchangedFeed_ReturnsNoFilesWithoutParsing(server):
+    source = AsyncShowRSSSource(server.url)
+
+    async def fetch_twice():
+        feed = await source.fetch("1")
+        return feed, await source.fetch("1", feed.validators)
+
+    assert asyncio.run(fetch_twice()) == (
+        [EpisodeFile("Prison Break 5x09", "magnet_link1", Quality.HD)], [])
+    assert server.connections == 1
+
+
+def test_AsyncFetchChunkedFeed_ReturnsAllFiles(server):
+    source = AsyncShowRSSSource(server.url)
+
+    assert asyncio.run(source.fetch("3")) == [
+        EpisodeFile("Prison Break 5x09", "magnet_link1", Quality.HD)]
+
+
+def test_AsyncFetchUnknownTVShow_RaisesTVShowNotFoundError(server):
+    source = AsyncShowRSSSource(server.url)
+
+    with pytest.raises(TVShowNotFoundError):
+        asyncio.run(source.fetch("2"))
+
+
+def test_AsyncFetchWhileShowRSSIsUnavailable_RaisesUpstreamError(server):
+    source = AsyncShowRSSSource(server.url)
+
+    with pytest.raises(UpstreamError):
+        asyncio.run(source.fetch("5"))
+
+
+def test_AsyncRedirectedFeed_RaisesUpstreamError(server):
+    source = AsyncShowRSSSource(server.url)
+
+    with pytest.raises(UpstreamError):
+        asyncio.run(source.fetch("6"))
+
+
+def test_AsyncFetchWithInvalidContentLength_RaisesConnectionError(server):
+    source = AsyncShowRSSSource(server.url)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(source.fetch("7"))
+
+
+def test_AsyncFetchFromUnreachableHost_RaisesConnectionError():
+    source = AsyncShowRSSSource("http://127.0.0.1:1/show")
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(source.fetch("1"))
+
+
+def test_ConcurrentAsyncFetches_UpToMaxConnectionsAreOpen(server):
+    source = AsyncShowRSSSource(server.url, max_connections=4)
+
+    async def fetch_all():
+        return await asyncio.gather(*(source.fetch("1") for _ in range(64)))
+
+    results = asyncio.run(fetch_all())
+
+    assert all(len(files) == 1 for files in results)
+    assert server.connections <= 4
@@ -0,0 +1,363 @@
+import asyncio
+import time
+from itertools import takewhile
+
+from pytest import fixture
+
+from tveebot_tracker.config import Config
+from tveebot_tracker.download_queue import DownloadQueue
+from tveebot_tracker.episode import TVShow, Quality, EpisodeFile, State, \
+    parse_title
+from tveebot_tracker.episode_db import EpisodeDB, connect
+from tveebot_tracker.source import EpisodeSource, TVShowNotFoundError, \
+    AsyncEpisodeSource, Feed, Validators
+from tveebot_tracker.tracker import Tracker, AsyncTracker, select_files
+
+
+class FakeSource(EpisodeSource):
+    """ Source returning pre-defined files or errors for each TV show """
+
+    def __init__(self, feeds: dict):
+        self.feeds = feeds
+
+    def fetch(self, tvshow_reference: str) -> list:
+        feed = self.feeds[tvshow_reference]
+
+        if isinstance(feed, Exception):
+            raise feed
+
+        return feed
+
+
+class ConditionalSource(FakeSource):
+    """
+    Source returning pre-defined files for each TV show, as a Feed with an
+    ETag that changes only when the files of the TV show are replaced. No
+    files are returned when given the ETag of the current files.
+    """
+
+    def __init__(self, feeds: dict):
+        super().__init__(feeds)
+        self.received = []
+
+    def fetch_until(self, tvshow_reference: str, stop,
+                    validators: Validators = None) -> list:
+        self.received.append(validators)
+
+        files = self.fetch(tvshow_reference)
+        current = Validators(f'"{id(files)}"', None)
+        if validators == current:
+            return Feed([], current)
+
+        return Feed(takewhile(lambda file: not stop(file), files), current)
+
+
+class SlowAsyncSource(AsyncEpisodeSource):
+    """
+    Asynchronous source returning a file of a new episode of each TV show
+    after a *delay*, or never if the delay is None
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.fetches = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.cancelled = 0
+
+    async def fetch(self, tvshow_reference: str) -> list:
+        self.fetches += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.delay is None:
+                await asyncio.Event().wait()
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+        return [file(f"Show {tvshow_reference} 1x01")]
+
+
+def file(title: str, quality: Quality = Quality.SD) -> EpisodeFile:
+    return EpisodeFile(title, f"magnet:{title}", quality)
+
+
+class TestTracker:
+    def tracker(self, db, config, feeds: dict) -> Tracker:
+        tracker = Tracker(FakeSource(feeds), db, DownloadQueue(db), config)
+        for index, tvshow_id in enumerate(feeds):
+            tracker.add_tvshow(TVShow(tvshow_id, f"Show {index}"))
+
+        return tracker
+
+    @staticmethod
+    def queued(tracker: Tracker) -> list:
+        return [episode for episode, _ in tracker._queue.get_many()]
+
+    def test_NewEpisodesFromAllTVShows_AreQueued(self, db, config):
+        tracker = self.tracker(db, config, {
+            "#1": [file("Show 0 1x01")],
+            "#2": [file("Show 1 2x03")],
+            "#3": [],
+        })
+
+        tracker.track()
+
+        queued = self.queued(tracker)
+        assert sorted((e.tvshow.id, e.season, e.number) for e in queued) == \
+            [("#1", 1, 1), ("#2", 2, 3)]
+
+        with connect(db) as connection:
+            states = list(connection.episodes(include_state=True))
+
+        assert len(states) == 2
+        assert all(state == State.QUEUED.tag for _, state in states)
+
+    def test_TVShowNotFound_OtherTVShowsAreStillTracked(self, db, config):
+        tracker = self.tracker(db, config, {
+            "#1": TVShowNotFoundError("not found"),
+            "#2": [file("Show 1 1x01")],
+        })
+
+        tracker.track()
+
+        assert len(tracker._queue) == 1
+
+    def test_ConnectionError_OtherTVShowsAreStillTracked(self, db, config):
+        tracker = self.tracker(db, config, {
+            "#1": [file("Show 0 1x01")],
+            "#2": ConnectionRefusedError("connection failed"),
+            "#3": [file("Show 2 1x01")],
+        })
+
+        tracker.track()
+
+        queued = self.queued(tracker)
+        assert [episode.tvshow.id for episode in queued] == ["#1", "#3"]
+
+    def test_SecondTrack_StopsAtTheNewestFileSeenBefore(self, db, config):
+        tracker = self.tracker(db, config, {"#1": [file("Show 0 1x01")]})
+        tracker.track()
+
+        # The unparseable title would fail the track if it was processed
+        tracker.source.feeds["#1"] = [
+            file("Show 0 1x02"), file("Show 0 1x01"), file("not an episode")]
+        tracker.track()
+
+        queued = self.queued(tracker)
+        assert [(e.season, e.number) for e in queued] == [(1, 1), (1, 2)]
+
+    def test_SecondTrack_RequestsTheFeedConditionally(self, db, config):
+        source = ConditionalSource({"#1": [file("Show 0 1x01")]})
+        # noinspection PyTypeChecker
+        tracker = Tracker(source, db, DownloadQueue(db), config)
+        tracker.add_tvshow(TVShow("#1", "Show 0"))
+
+        assert tracker.track() == {"#1": 1}
+        assert tracker.track() == {"#1": 0}
+        assert source.received[-1] is not None
+
+    def test_TrackWithAnUnparseableTitle_OtherFilesAreQueued(
+            self, db, config):
+        files = [file("Show 0 1x02"), file("not an episode"),
+                 file("Show 0 1x01")]
+        source = ConditionalSource({"#1": files})
+        # noinspection PyTypeChecker
+        tracker = Tracker(source, db, DownloadQueue(db), config)
+        tracker.add_tvshow(TVShow("#1", "Show 0"))
+
+        assert tracker.track() == {"#1": 3}
+        queued = self.queued(tracker)
+        assert [(e.season, e.number) for e in queued] == [(1, 1), (1, 2)]
+
+        # The watermark and the validators moved past the bad title
+        assert tracker.track() == {"#1": 0}
+        assert source.received[-1] is not None
+
+    def test_TrackSomeTVShows_ReturnsNewFilesOfEachTVShowChecked(
+            self, db, config):
+        tracker = self.tracker(db, config, {
+            "#1": [file("Show 0 1x02"), file("Show 0 1x01")],
+            "#2": [],
+            "#3": [file("Show 2 1x01")],
+        })
+
+        assert tracker.track(["#1", "#2"]) == {"#1": 2, "#2": 0}
+
+    def test_NewEpisodesOfATVShow_AreQueuedOldestFirst(self, db, config):
+        tracker = self.tracker(db, config, {
+            "#1": [file("Show 0 2x01"), file("Show 0 1x02"),
+                   file("Show 0 1x01")],
+        })
+
+        tracker.track()
+
+        queued = self.queued(tracker)
+        assert [(e.season, e.number) for e in queued] == \
+            [(1, 1), (1, 2), (2, 1)]
+
+    def test_FilesOfTheSameEpisodeInDifferentQualities_EpisodeIsQueuedOnce(
+            self, db, config):
+        tracker = self.tracker(db, config, {
+            "#1": [file("Show 0 1x01", Quality.HD), file("Show 0 1x01")],
+        })
+
+        tracker.track()
+
+        queued = tracker._queue.get_many()
+        assert len(queued) == 1
+        assert queued[0][1].quality == Quality.SD
+
+
+class TestAsyncTracker:
+    @fixture
+    def config(self, config):
+        config.max_concurrent_fetches = 100
+        return config
+
+    @staticmethod
+    def tracker(db, config, source, tvshows: int) -> AsyncTracker:
+        tracker = AsyncTracker(source, db, DownloadQueue(db), config)
+        for tvshow_id in range(tvshows):
+            tracker.add_tvshow(TVShow(str(tvshow_id), f"Show {tvshow_id}"))
+
+        return tracker
+
+    def test_Track_FetchesAllTVShowsConcurrently(self, db, config):
+        source = SlowAsyncSource(delay=0.2)
+        tracker = self.tracker(db, config, source, tvshows=50)
+
+        start = time.monotonic()
+        new_files = asyncio.run(tracker.track())
+
+        assert time.monotonic() - start < 1.0
+        assert source.max_in_flight == 50
+        assert len(new_files) == 50 and len(tracker._queue) == 50
+
+    def test_Track_KeepsUpToMaxConcurrentFetchesInFlight(self, db, config):
+        config.max_concurrent_fetches = 5
+        source = SlowAsyncSource(delay=0.01)
+        tracker = self.tracker(db, config, source, tvshows=20)
+
+        asyncio.run(tracker.track())
+
+        assert source.max_in_flight == 5
+
+    def test_Stop_CancelsTheTrackInProgress(self, db, config):
+        source = SlowAsyncSource(delay=None)
+        tracker = self.tracker(db, config, source, tvshows=3)
+
+        async def run_and_stop():
+            running = asyncio.ensure_future(tracker.run())
+            while source.in_flight < 3:
+                await asyncio.sleep(0.01)
+
+            tracker.stop()
+            await asyncio.wait_for(running, timeout=1.0)
+
+        asyncio.run(run_and_stop())
+
+        assert source.cancelled == 3
+        assert len(tracker._queue) == 0
+
+    def test_ThreadedTracker_StopsWhileFetchesAreInFlight(self, db, config):
+        source = SlowAsyncSource(delay=None)
+        config.fetch_workers = 4
+        # noinspection PyTypeChecker
+        tracker = Tracker(source, db, DownloadQueue(db), config)
+        tracker.add_tvshow(TVShow("1", "Show 1"))
+
+        tracker.start()
+        while source.in_flight < 1:
+            time.sleep(0.01)
+        tracker.stop()
+        tracker.join(timeout=1.0)
+
+        assert not tracker.is_alive()
+        assert source.cancelled == 1
+
+    def test_ConfigReloadedWithShorterPeriods_ChecksAreRescheduled(
+            self, tmpdir):
+        config_file = tmpdir.join("config.ini")
+        db_file = tmpdir.join("episodes.db")
+        config_file.write(f"[tracker]\nTrackPeriod = 60.0\n"
+                          f"MaxTrackPeriod = 60.0\nDatabase = {db_file}\n")
+        config = Config()
+        config.load_defaults()
+        config.load(str(config_file))
+        source = SlowAsyncSource(delay=0)
+        # noinspection PyTypeChecker
+        tracker = self.tracker(EpisodeDB(config), config, source, tvshows=1)
+
+        async def run_and_reload():
+            running = asyncio.ensure_future(tracker.run())
+            while source.fetches < 1:
+                await asyncio.sleep(0.01)
+
+            config_file.write(f"[tracker]\nTrackPeriod = 0.05\n"
+                              f"MaxTrackPeriod = 0.1\nDatabase = {db_file}\n")
+            config.reload()
+            while source.fetches < 2:
+                await asyncio.sleep(0.01)
+
+            tracker.stop()
+            await running
+
+        asyncio.run(asyncio.wait_for(run_and_reload(), timeout=2.0))
+
+
+class TestSelectFiles:
+    def test_FileWithTheConfiguredQuality_IsSelected(self):
+        files = [file("Show 1x01", Quality.FHD), file("Show 1x01", Quality.HD),
+                 file("Show 1x01", Quality.SD)]
+
+        selected = select_files(files, "#1", Quality.HD)
+
+        assert [file for _, file in selected] == [files[1]]
+
+    def test_NoFileWithTheConfiguredQuality_ClosestQualityIsSelected(self):
+        files = [file("Show 1x01", Quality.FHD), file("Show 1x01", Quality.SD)]
+
+        selected = select_files(files, "#1", Quality.SD)
+
+        assert [file for _, file in selected] == [files[1]]
+
+    def test_ProperAndRepackFiles_ArePreferred(self):
+        files = [file("Show 1x01"), file("Show 1x01 REPACK"),
+                 file("Show 1x02 Title PROPER"), file("Show 1x02 Title")]
+
+        selected = select_files(files, "#1", Quality.SD)
+
+        assert [file for _, file in selected] == [files[1], files[2]]
+
+    def test_FlagInTheEpisodeTitle_IsNotAFix(self):
+        files = [file("Show 1x01 Eyes"), file("Show 1x01 PROPER Eyes")]
+
+        selected = select_files(files, "#1", Quality.SD)
+
+        assert [file for _, file in selected] == [files[0]]
+
+    def test_FilesWithTitleInfo_AreNotParsedAgain(self):
+        # The info is what the source parsed from the full title in the feed
+        files = [EpisodeFile("not parsed again", "magnet:1", Quality.SD,
+                             parse_title("Show 1x02 REPACK")),
+                 file("Show 1x02")]
+
+        selected = select_files(files, "#1", Quality.SD)
+
+        assert [(e.season, e.number, f) for e, f in selected] == \
+            [(1, 2, files[0])]
+
+    def test_OneFilePerEpisode_InTheOrderOfTheFeed(self):
+        files = [file("Show 1x03"), file("Show 1x02"), file("Show 1x03"),
+                 file("Show 1x01")]
+
+        selected = select_files(files, "#1", Quality.SD)
+
+        assert [(e.season, e.number) for e, _ in selected] == \
+            [(1, 3), (1, 2), (1, 1)]
+        assert selected[0][1] is files[0]
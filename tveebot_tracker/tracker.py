@@ -1,107 +1,355 @@
+import asyncio
 import logging
-from queue import Queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
+from tveebot_tracker import metrics
 from tveebot_tracker.config import Config
-from tveebot_tracker.episode import TVShow, Quality, State, Episode
+from tveebot_tracker.download_queue import DownloadQueue, queue_depth
+from tveebot_tracker.episode import TVShow, Quality, State, Episode, \
+    title_info
 from tveebot_tracker.episode_db import EpisodeDB, connect
-from tveebot_tracker.source import EpisodeSource, TVShowNotFoundError
+from tveebot_tracker.exceptions import ParseError
+from tveebot_tracker.scheduler import PollScheduler
+from tveebot_tracker.source import EpisodeSource, TVShowNotFoundError, \
+    AsyncEpisodeSource, AsyncSourceAdapter, Validators
 from tveebot_tracker.stoppable_thread import StoppableThread
 
 logger = logging.getLogger('tracker')
 logger.addHandler(logging.StreamHandler())
 logger.setLevel(logging.DEBUG)
 
+fetch_seconds = metrics.histogram(
+    'tveebot_fetch_seconds', "Time taken to fetch the feed of each TV show",
+    ['tvshow'])
+fetch_errors = metrics.counter(
+    'tveebot_fetch_errors_total',
+    "Failed fetches of the feed of each TV show, by type of error",
+    ['tvshow', 'error'])
+track_seconds = metrics.histogram(
+    'tveebot_track_seconds', "Time taken by each track, from the first fetch "
+                             "to the commit of the new episodes")
+title_parse_seconds = metrics.histogram(
+    'tveebot_title_parse_seconds', "Time spent parsing the titles of the "
+                                   "files fetched for each TV show")
+new_episodes_found = metrics.counter(
+    'tveebot_new_episodes_total', "New episodes found and queued")
 
-class Tracker(StoppableThread):
+
+class AsyncTracker:
     """
-    The Tracker is the main component of the application. It connects
-    everything together.
+    Asynchronous engine of the tracker, running in an asyncio event loop.
 
     Its job is to check episodes available to download, keep track of episodes
     that have already been downloaded, and download only new episodes. It does
     this for multiple TV Shows.
+
+    Each TV show is checked at its own pace, set by a PollScheduler: every
+    *check_period* seconds while its feed keeps changing, backing off up to
+    *max_check_period* seconds while it does not. When the configurations
+    are reloaded with other periods, the checks are rescheduled right away.
+
+    The feeds of all TV shows due are fetched at the same time, by the same
+    thread, up to *max_concurrent_fetches* at once. The DB is accessed from
+    the event loop, since its operations are short and it is only written at
+    the end of each track.
     """
 
-    def __init__(self, source: EpisodeSource, episode_db: EpisodeDB,
-                 download_queue: Queue, config: Config):
+    def __init__(self, source: AsyncEpisodeSource, episode_db: EpisodeDB,
+                 download_queue: DownloadQueue, config: Config):
         """
         Initialize the tracker with the necessary components.
 
-        :param source:         source to obtain episode files from
+        :param source:         asynchronous source to obtain episode files
+                               from
         :param episode_db:     DB used to track episodes
         :param download_queue: queue shared with downloader to place new
                                episodes to be downloaded
         :param config:         configuration used for the whole application
         """
-        super().__init__()
         self.source = source
         self.database = episode_db
         self._queue = download_queue
         self._config = config
 
+        self._scheduler = PollScheduler(self.check_period,
+                                        self.max_check_period)
+
+        # stop() may be called from any thread, before or while running
+        self._stop_requested = threading.Event()
+        self._loop = None
+        self._wakeup = None
+        self._running_track = None
+
     @property
     def check_period(self):
         return self._config.track_period
 
-    def run(self):
-        # TODO put all episodes in QUEUED state back in the download queue
+    @property
+    def max_check_period(self):
+        return self._config.max_track_period
+
+    @property
+    def max_concurrent_fetches(self):
+        return self._config.max_concurrent_fetches
+
+    def stop(self):
+        """
+        Signals the tracker to stop. The track in progress, if any, is
+        cancelled right away, together with the fetches in flight, and none
+        of its changes are stored. This may be called from any thread.
+        """
+        self._stop_requested.set()
 
-        while not self.stopped():
-            self.track()
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._interrupt)
 
-            logger.debug(f"will check again in {self.check_period} seconds")
-            self.wait_on_stop(timeout=self.check_period)
-            logger.debug(f"checking for new episodes")
+    def stopped(self) -> bool:
+        """ Indicates whether the tracker was stopped or not """
+        return self._stop_requested.is_set()
 
-    def track(self):
+    def _interrupt(self):
+        self._wakeup.set()
+        if self._running_track is not None:
+            self._running_track.cancel()
+
+    def _config_changed(self, old, new):
+        # Called by the thread reloading the configurations: wake up to
+        # reschedule the checks with the new periods
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def run(self):
+        """ Tracks the TV shows, as they are due, until stop() is called """
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._config.add_listener(self._config_changed)
+
+        try:
+            while not self.stopped():
+                periods = self.check_period, self.max_check_period
+                if periods != (self._scheduler.min_period,
+                               self._scheduler.max_period):
+                    self._scheduler.set_periods(*periods, time.monotonic())
+                self._update_schedule()
+
+                due = self._scheduler.due(time.monotonic())
+                if due:
+                    logger.debug(f"checking for new episodes")
+                    self._running_track = asyncio.ensure_future(
+                        self.track(due))
+                    try:
+                        new_files = await self._running_track
+                    except asyncio.CancelledError:
+                        if self.stopped():
+                            break
+                        raise
+                    finally:
+                        self._running_track = None
+
+                    now = time.monotonic()
+                    for tvshow_id in due:
+                        if tvshow_id not in new_files:
+                            # The check failed: it says nothing about how
+                            # often the feed changes
+                            self._scheduler.failed(tvshow_id, now)
+                        else:
+                            changed = new_files[tvshow_id] > 0
+                            self._scheduler.checked(tvshow_id, changed, now)
+
+                # Wake up at least every check period to schedule new TV shows
+                timeout = self.check_period
+                next_check = self._scheduler.next_check()
+                if next_check is not None:
+                    timeout = min(timeout,
+                                  max(0., next_check - time.monotonic()))
+
+                logger.debug(f"will check again in {timeout:.1f} seconds")
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+        finally:
+            self._loop = None
+            self._config.remove_listener(self._config_changed)
+
+    def _update_schedule(self):
+        """ Schedules new TV shows and unschedules removed ones """
+        with connect(self.database) as connection:
+            tvshow_ids = {tvshow.id for tvshow, _ in connection.tvshows()}
+
+        now = time.monotonic()
+        for tvshow_id in tvshow_ids:
+            self._scheduler.add(tvshow_id, now)
+
+        for tvshow_id in set(self._scheduler) - tvshow_ids:
+            self._scheduler.remove(tvshow_id)
+
+    async def track(self, tvshow_ids=None) -> dict:
         """
         Checks for new episodes that may have become available at the source
         since the last time track() was called. If new episodes are available
         they are put into the download queue.
+
+        By default, all TV shows are checked. To check only some of them,
+        specify their IDs in *tvshow_ids*.
+
+        The feeds of the TV shows are all fetched concurrently, up to
+        *max_concurrent_fetches* at a time. If the track is cancelled, so
+        are the fetches in flight, and nothing is stored in the DB.
+
+        Feeds list the newest files first. For each TV show, the tracker
+        keeps a watermark with the link of the newest file it has seen and
+        stops going through a feed as soon as it reaches that file. It also
+        keeps the validators of the feed, if the source returns any, to
+        request the feed conditionally. Both are only stored together with
+        the episodes found, so that a track whose results are discarded
+        does not make the next one skip those episodes.
+
+        :param tvshow_ids: IDs of the TV shows to check (all by default)
+        :return: dict mapping the ID of each TV show checked successfully to
+                 the number of new files found in its feed
         """
+        start = time.perf_counter()
+        if tvshow_ids is not None:
+            tvshow_ids = set(tvshow_ids)
+
         with connect(self.database) as connection:
-            for tvshow in connection.tvshows():
+            tvshows = [(tvshow, quality)
+                       for tvshow, quality in connection.tvshows()
+                       if tvshow_ids is None or tvshow.id in tvshow_ids]
+            watermarks = connection.watermarks()
+            validators = {tvshow_id: Validators(*pair) for tvshow_id, pair
+                          in connection.validators().items()}
 
-                try:
-                    logger.info(f"looking for episodes from ")
-                    files = self.source.fetch(tvshow.id)
-                    logger.debug(f"fetched {len(files)} episode files")
+            # New episodes, watermarks, and validators found during this track
+            # They are all stored in the DB at the end, in a single transaction
+            new_episodes = {}
+            new_watermarks = {}
+            new_validators = {}
+            new_files = {}
+
+            checks = self._start_checks(tvshows, watermarks, validators)
+            try:
+                for (tvshow, quality), check in zip(tvshows, checks):
+                    try:
+                        logger.info(f"looking for episodes from {tvshow.name}")
+                        result = await check
+                        logger.debug(f"fetched {result.file_count} new "
+                                     f"episode files")
+
+                    except ConnectionError as error:
+                        fetch_errors.inc(tvshow=tvshow.id,
+                                         error=type(error).__name__)
+
+                        # The upstream of this TV show may be down, but the
+                        # other TV shows may come from other upstreams
+                        # Sources guarded by a circuit breaker fail fast
+                        # while their upstream is down
+                        logger.warning(str(error))
+                        continue
+
+                    except (TVShowNotFoundError, ParseError) as error:
+                        fetch_errors.inc(tvshow=tvshow.id,
+                                         error=type(error).__name__)
+                        logger.error(str(error))
+                        continue
 
-                except ConnectionError as error:
-                    logger.warning(str(error))
+                    for episode, file in result.selected:
+                        if not connection.episode_exists(episode):
+                            logger.info("found new episode %dx%02d" %
+                                        (episode.season, episode.number))
+                            new_episodes[episode] = file
 
-                    # A connection error indicates that there might be some
-                    # problems with network or the server may be down
-                    # The best course here is to stop the current track and
-                    # try again later
-                    return
+                    new_files[tvshow.id] = result.file_count
+                    if result.newest_link is not None:
+                        new_watermarks[tvshow.id] = result.newest_link
+                    if result.validators is not None and \
+                            result.validators != validators.get(tvshow.id):
+                        new_validators[tvshow.id] = result.validators
 
-                except TVShowNotFoundError as error:
-                    logger.error(str(error))
-                    continue
+            finally:
+                # Only checks left in flight by an error or a cancellation
+                for check in checks:
+                    check.cancel()
 
-                for file in files:
-                    episode = Episode.from_title(file.title, tvshow.id)
-                    if not connection.episode_exists(episode):
-                        logger.info("found new episode %dx%02d" %
-                                    (episode.season, episode.number))
+            new_episodes = list(new_episodes.items())
+            self._store(connection, new_episodes, new_watermarks,
+                        new_validators)
+            if new_episodes:
+                queue_depth.set(connection.download_queue_size())
 
-                        connection.set_episode_state(episode, State.QUEUED)
-                        logger.debug("set episode's state to QUEUED")
+        track_seconds.observe(time.perf_counter() - start)
+        new_episodes_found.inc(len(new_episodes))
+
+        # Wake up the downloader only once the episodes are committed
+        if new_episodes:
+            self._queue.notify()
+        logger.debug(f"{len(new_episodes)} episodes were queued to be "
+                     f"downloaded")
+
+        return new_files
+
+    @staticmethod
+    def _store(connection, new_episodes: list, new_watermarks: dict,
+               new_validators: dict):
+        """
+        Stores the *new_episodes* and their files, as QUEUED, and the
+        *new_watermarks* and *new_validators* in the DB and puts the new
+        episodes in the download queue, all in a single transaction.
+        """
+        with connection.transaction():
+            connection.insert_episodes(
+                episode for episode, _ in new_episodes)
+            connection.insert_files(new_episodes)
+            connection.set_episode_states(
+                (episode, State.QUEUED) for episode, _ in new_episodes)
+
+            # Feeds list the newest files first, but the oldest episodes
+            # should be downloaded first
+            connection.enqueue_downloads(sorted(
+                (episode for episode, _ in new_episodes),
+                key=lambda episode: (episode.season, episode.number)))
+            connection.set_watermarks(new_watermarks.items())
+            connection.set_validators(new_validators.items())
+
+    def _start_checks(self, tvshows: list, watermarks: dict,
+                      validators: dict) -> list:
+        """
+        Starts checking each of the *tvshows*, given as (tvshow, quality)
+        pairs, for files newer than its watermark in *watermarks*, with its
+        feed requested conditionally on its *validators*.
 
-                        self._queue.put((episode, file))
-                        logger.debug("episode was queued to be downloaded")
+        :return: list with a future for each TV show, in the same order,
+                 resolving to the CheckResult of that TV show
+        """
+        slots = asyncio.Semaphore(self.max_concurrent_fetches)
+        return [
+            asyncio.ensure_future(check_tvshow(
+                self.source, tvshow.id, quality, watermarks.get(tvshow.id),
+                validators.get(tvshow.id), slots))
+            for tvshow, quality in tvshows
+        ]
 
-    def add_tvshow(self, tvshow: TVShow, quality: Quality = Quality.SD):
+    def add_tvshow(self, tvshow: TVShow, quality: Quality = Quality.SD,
+                   priority: int = 0):
         """
         Adds a new TV Show to be tracked.
 
-        :param tvshow:  TV show to be tracked
-        :param quality: episodes from this TV show will be downloaded with
-                        the quality specified here
+        :param tvshow:   TV show to be tracked
+        :param quality:  episodes from this TV show will be downloaded with
+                         the quality specified here
+        :param priority: episodes from TV shows with higher priority are
+                         downloaded first
         """
         with connect(self.database) as connection:
-            connection.insert_tvshow(tvshow, quality)
+            connection.insert_tvshow(tvshow, quality, priority)
 
     def remove_tvshow(self, tvshow_id: str):
         """
@@ -111,3 +359,204 @@ class Tracker(StoppableThread):
         """
         with connect(self.database) as connection:
             connection.delete_tvshow(tvshow_id)
+
+
+class Tracker(StoppableThread):
+    """
+    The Tracker is the main component of the application. It connects
+    everything together.
+
+    This is the threaded interface of the tracker, which runs an
+    AsyncTracker in an event loop of its own thread. See AsyncTracker for
+    how TV shows are tracked.
+
+    The *source* may be a blocking EpisodeSource or an AsyncEpisodeSource.
+    The fetches of blocking sources run in a pool of *fetch_workers*
+    threads, so those take a thread per fetch in flight.
+
+    The tracker keeps a single event loop, used by both run() and track(),
+    so that asynchronous sources keep their connections between tracks.
+    """
+
+    def __init__(self, source, episode_db: EpisodeDB,
+                 download_queue: DownloadQueue, config: Config):
+        """
+        Initialize the tracker with the necessary components.
+
+        :param source:         source to obtain episode files from, either
+                               an EpisodeSource or an AsyncEpisodeSource
+        :param episode_db:     DB used to track episodes
+        :param download_queue: queue shared with downloader to place new
+                               episodes to be downloaded
+        :param config:         configuration used for the whole application
+        """
+        super().__init__()
+        self.source = source
+        self.database = episode_db
+        self._queue = download_queue
+        self._config = config
+
+        self._engine = self._new_engine(source)
+        self._loop = None
+
+    @property
+    def check_period(self):
+        return self._config.track_period
+
+    @property
+    def max_check_period(self):
+        return self._config.max_track_period
+
+    @property
+    def fetch_workers(self):
+        return self._config.fetch_workers
+
+    def _new_engine(self, source) -> AsyncTracker:
+        """ Creates the engine run by this tracker, fetching from *source* """
+        if isinstance(source, EpisodeSource):
+            source = AsyncSourceAdapter(source)
+
+        return AsyncTracker(source, self.database, self._queue, self._config)
+
+    def run(self):
+        try:
+            self._run(self._engine.run())
+        finally:
+            self._close_loop()
+
+    def stop(self):
+        """
+        Signals the tracker to stop, cancelling the track in progress.
+        Fetches from blocking sources that are already running still finish
+        before the thread exits.
+        """
+        super().stop()
+        self._engine.stop()
+
+    def track(self, tvshow_ids=None) -> dict:
+        """
+        Checks for new episodes of the TV shows with IDs in *tvshow_ids*, or
+        of all TV shows by default, in the calling thread. See
+        AsyncTracker.track().
+        """
+        return self._run(self._engine.track(tvshow_ids))
+
+    def _run(self, coroutine):
+        """
+        Runs *coroutine* in the tracker's event loop, in which the fetches of
+        blocking sources run in a pool of *fetch_workers* threads
+        """
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._loop.set_default_executor(ThreadPoolExecutor(
+                self.fetch_workers, thread_name_prefix='tracker'))
+
+        return self._loop.run_until_complete(coroutine)
+
+    def _close_loop(self):
+        loop, self._loop = self._loop, None
+        if loop is not None:
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
+
+    def add_tvshow(self, tvshow: TVShow, quality: Quality = Quality.SD,
+                   priority: int = 0):
+        """ Adds a new TV Show to be tracked. See AsyncTracker.add_tvshow() """
+        self._engine.add_tvshow(tvshow, quality, priority)
+
+    def remove_tvshow(self, tvshow_id: str):
+        """
+        Signals the tracker to stop tracking the TV Show with the specified ID.
+
+        :param tvshow_id: ID corresponding to TV Show to stop tracking
+        """
+        self._engine.remove_tvshow(tvshow_id)
+
+
+# Outcome of checking a TV show for new files: the number of files newer
+# than its watermark, the link of the newest one (None if there is none),
+# the (episode, file) pairs selected among them, and the validators of its
+# feed (None if the source returned none)
+CheckResult = namedtuple("CheckResult",
+                         "file_count newest_link selected validators")
+
+
+async def check_tvshow(source: AsyncEpisodeSource, tvshow_id: str,
+                       quality: Quality, watermark: str,
+                       validators: Validators,
+                       slots: asyncio.Semaphore) -> CheckResult:
+    """
+    Fetches the files of a TV show from *source* that are newer than its
+    *watermark*, once one of the *slots* for fetches is free, and selects a
+    file for each of their episodes. See select_files(). The feed is
+    requested conditionally on the *validators* from a previous check.
+
+    :raise ConnectionError: if the source fails to fetch the files
+    :raise TVShowNotFoundError: if the source does not know the TV show
+    :raise ParseError: if the feed is not valid
+    """
+    async with slots:
+        with fetch_seconds.time(tvshow=tvshow_id):
+            files = await source.fetch_until(
+                tvshow_id, stop=lambda file: file.link == watermark,
+                validators=validators)
+
+    # Feeds list multiple files for the same episode, but only one of them
+    # is downloaded
+    with title_parse_seconds.time():
+        selected = select_files(files, tvshow_id, quality)
+
+    return CheckResult(len(files), files[0].link if files else None,
+                       selected, getattr(files, 'validators', None))
+
+
+# Flags marking a file that replaces a defective release of the same episode
+FIX_FLAGS = frozenset({'PROPER', 'REPACK'})
+
+
+def select_files(files: list, tvshow_id: str, quality: Quality) -> list:
+    """
+    Selects a single file for each episode among the *files* of a TV show.
+
+    Files with the *quality* configured for the TV show are preferred. If an
+    episode has no file with that quality, the file with the closest quality
+    is selected instead. Among files with the same quality, PROPER and
+    REPACK files are preferred, since they fix defects of the original
+    release. Any remaining tie is broken by the order of the files, which is
+    the order of the feed (newest first).
+
+    Files whose titles can not be parsed are logged and skipped, so that a
+    single bad item does not keep the other files of the feed from being
+    selected, on this check and on every later one.
+
+    :param files:     files of the TV show, in the order of its feed
+    :param tvshow_id: ID of the TV show the files belong to
+    :param quality:   quality configured for the TV show
+    :return: list of (episode, file) pairs, one per episode, in the order
+             in which each episode first appears in *files*
+    """
+    # Sources usually parsed the titles already, while reading the feed
+    parsed = []
+    infos = []
+    for position, file in enumerate(files):
+        try:
+            infos.append(title_info(file))
+        except ParseError as error:
+            logger.warning(f"skipped file of TV show {tvshow_id}: {error}")
+            continue
+
+        parsed.append((position, file))
+
+    episodes = Episode.from_infos(infos, tvshow_id)
+
+    selected = {}
+    for episode, info, (position, file) in zip(episodes, infos, parsed):
+        is_fix = not FIX_FLAGS.isdisjoint(info.flags)
+        rank = (abs(file.quality.value - quality.value), not is_fix, position)
+
+        # Episodes are equal if they have the same key (season and number,
+        # here). Replacing the value of a key keeps its position in the dict
+        if episode not in selected or rank < selected[episode][0]:
+            selected[episode] = rank, episode, file
+
+    return [(episode, file) for _, episode, file in selected.values()]
@@ -0,0 +1,9 @@
+-- HTTP cache validators of the feed of each TV show, which make the
+-- tracker's next request for that feed conditional
+CREATE TABLE IF NOT EXISTS validator (
+  tvshow_id          TEXT PRIMARY KEY,
+  etag               TEXT,
+  last_modified      TEXT,
+
+  FOREIGN KEY (tvshow_id) REFERENCES tvshow ON DELETE CASCADE
+);